@@ -0,0 +1,241 @@
+"""
+Solution of algebraic loops
+
+An algebraic loop is a cycle of wires through function blocks, whose outputs
+depend on their inputs at the same time, so that there is no order in which
+the blocks can be evaluated.  By default :meth:`BlockDiagram.compile`
+rejects them, and ``compile(algebraic=True)`` keeps them.
+
+Each strongly connected component of function blocks, see
+:meth:`BlockDiagram.algebraic_loops`, is replaced in the execution plan by
+an :class:`AlgebraicLoop` evaluator.  Enough of its blocks are *torn* that
+the others can be evaluated in order, given the output values of the torn
+blocks, the tear variables :math:`z`.  Evaluating the torn blocks then gives
+their outputs :math:`g(z)`, and the loop is solved when
+
+.. math::
+
+    z = g(z)
+
+This is solved by Newton's method, with a finite-difference Jacobian that is
+kept while it converges, or by fixed-point iteration, which is cheaper but
+only converges if the loop gain is less than one.  The solution at the last
+evaluation is the starting point of the next, so within an integration few
+iterations are needed.
+
+The blocks of the loop remain in the block diagram, the evaluator computes
+their output values, so sinks and watched ports are unaffected.
+"""
+
+import numpy as np
+
+from bdsim.components import FunctionBlock
+
+
+class AlgebraicLoop(FunctionBlock):
+    """
+    Evaluator for an algebraic loop
+
+    Created by :meth:`BlockDiagram.compile`, it is not a block of the diagram
+    but replaces the blocks of the loop in its execution plan.
+    """
+
+    nin = 0
+    nout = 0
+
+    tol = 1e-10  # convergence tolerance, relative to the tear variables
+    maxiter = 50  # maximum number of iterations
+
+    def __init__(self, members, edges, method='newton', **blockargs):
+        """
+        :param members: blocks of the loop, a strongly connected component
+        :type members: list of Block
+        :param edges: the blocks of the loop driven by each block of the loop
+        :type edges: dict
+        :param method: ``'newton'`` or ``'fixed'``, defaults to ``'newton'``
+        :type method: str, optional
+        :param blockargs: |BlockOptions|
+        :type blockargs: dict
+        :raises ValueError: unknown method
+        """
+        super().__init__(**blockargs)
+        if method not in ('newton', 'fixed'):
+            raise ValueError('unknown algebraic loop method ' + str(method))
+        self.method = method
+        self.members = members
+        self.blocks = members
+        self.pure = all([b.pure for b in members])
+        self.torn = tear(members, edges)
+
+        # the other blocks are evaluated in order given the torn outputs
+        inner = set(members) - set(self.torn)
+        self.order = _order({b: [c for c in edges[b] if c in inner] for b in members if b in inner})
+
+        # signals entering the loop
+        members = set(members)
+        self.sources = []
+        for b in self.members:
+            for p in b.sources:
+                if p is not None and p.block not in members and p not in self.sources:
+                    self.sources.append(p)
+
+        self.iterations = 0  # total number of iterations
+        self._z = None  # solution of the last evaluation
+        self._J = None  # Jacobian of the residual, kept between evaluations
+        self._shapes = None
+
+    def start(self, state=None):
+        self._z = None
+        self._J = None
+
+    def output(self, t=None):
+        if self._z is None:
+            # start from zero
+            for b in self.torn:
+                b.output_values = [0.0] * b.nout
+            self._shapes = None
+            self._z = self._g(t)
+        if self.method == 'newton':
+            self._z = self._newton(self._z, t)
+        else:
+            self._z = self._fixed(self._z, t)
+        return []
+
+    def _g(self, t, z=None):
+        # evaluate the loop given the tear variables, return the new values
+        # of the tear variables
+        if z is not None:
+            self._unpack(z)
+        for b in self.order:
+            b.output_values = b.output(t)
+        out = [b.output(t) for b in self.torn]
+        if self._shapes is None:
+            self._shapes = [[np.shape(v) for v in o] for o in out]
+        return np.concatenate([np.reshape(v, (-1,)) for o in out for v in o]).astype(float)
+
+    def _unpack(self, z):
+        # set the outputs of the torn blocks
+        i = 0
+        for b, shapes in zip(self.torn, self._shapes):
+            out = []
+            for shape in shapes:
+                n = int(np.prod(shape))
+                out.append(float(z[i]) if shape == () else z[i:i + n].reshape(shape))
+                i += n
+            b.output_values = out
+
+    def _converged(self, r, z):
+        return np.all(np.abs(r) <= self.tol * (1 + np.abs(z)))
+
+    def _fixed(self, z, t):
+        for i in range(self.maxiter):
+            self.iterations += 1
+            g = self._g(t, z)
+            if self._converged(g - z, z):
+                self._unpack(g)
+                return g
+            z = g
+        return self._failed(t)
+
+    def _newton(self, z, t):
+        # simplified Newton, the Jacobian is only updated when the residual
+        # is not reduced quickly enough
+        r = self._g(t, z) - z
+        for i in range(self.maxiter):
+            self.iterations += 1
+            if self._converged(r, z):
+                self._unpack(z + r)
+                return z + r
+            if self._J is None or self._J.shape[0] != z.shape[0]:
+                self._J = self._jacobian(z, r, t)
+            try:
+                dz = np.linalg.solve(self._J, -r)
+            except np.linalg.LinAlgError:
+                return self._failed(t)
+            znew = z + dz
+            rnew = self._g(t, znew) - znew
+            if not np.all(np.isfinite(rnew)):
+                return self._failed(t)
+            if np.max(np.abs(rnew)) > 0.5 * np.max(np.abs(r)):
+                self._J = None
+            z, r = znew, rnew
+        return self._failed(t)
+
+    def _jacobian(self, z, r, t):
+        # forward difference Jacobian of the residual g(z) - z
+        n = z.shape[0]
+        J = np.empty((n, n))
+        for j in range(n):
+            h = np.sqrt(np.finfo(float).eps) * max(1.0, abs(z[j]))
+            zh = z.copy()
+            zh[j] += h
+            J[:, j] = (self._g(t, zh) - zh - r) / h
+        return J
+
+    def _failed(self, t):
+        self._z = None
+        self._J = None
+        raise RuntimeError(f"algebraic loop through {', '.join([b.name for b in self.members])} "
+            f"did not converge at t={t}")
+
+
+def tear(members, edges):
+    """
+    Choose the blocks of an algebraic loop to tear
+
+    :param members: blocks of the loop
+    :type members: list of Block
+    :param edges: the blocks of the loop driven by each block of the loop
+    :type edges: dict
+    :return: torn blocks
+    :rtype: list of Block
+
+    Blocks are torn until the others have no cycle, choosing each time the
+    block with the most wires in and out of the cycles that remain, and of
+    those the one added last, which is usually in the feedback path.  The
+    number of tear variables is small, but not necessarily the least.
+
+    The tear variables start from zero, a scalar for each output port, which
+    is broadcast by the blocks they drive to the shape of their other
+    inputs.
+    """
+    from bdsim.blockdiagram import _strongly_connected
+
+    torn = []
+    remaining = set(members)
+    while True:
+        def successors(b):
+            return [c for c in edges[b] if c in remaining]
+
+        cyclic = []
+        for component in _strongly_connected([b for b in members if b in remaining], successors):
+            if len(component) > 1 or component[0] in successors(component[0]):
+                cyclic.extend(component)
+        if len(cyclic) == 0:
+            return torn
+
+        incycle = set(cyclic)
+        degree = {b: 0 for b in cyclic}
+        for b in cyclic:
+            for c in successors(b):
+                if c in incycle:
+                    degree[b] += 1
+                    degree[c] += 1
+        b = max(cyclic, key=lambda b: (degree[b], members.index(b)))
+        torn.append(b)
+        remaining.discard(b)
+
+
+def _order(edges):
+    # topological order of an acyclic graph, in the order of the dict
+    waiting = {b: 0 for b in edges}
+    for b, successors in edges.items():
+        for c in successors:
+            waiting[c] += 1
+    order = [b for b in edges if waiting[b] == 0]
+    for b in order:
+        for c in edges[b]:
+            waiting[c] -= 1
+            if waiting[c] == 0:
+                order.append(c)
+    return order
@@ -7,9 +7,17 @@ from collections import Counter, namedtuple
 import argparse
 import types
 import warnings
+import heapq
+import itertools
+import io
+import contextlib
+import concurrent.futures
+import multiprocessing
 
 from bdsim.blockdiagram import BlockDiagram
 from bdsim.components import OptionsBase, Block, Clock, BDStruct, Plug, clocklist
+from bdsim import solvers
+from bdsim.recording import Channel, Policy, Store
 import copy
 import tempfile
 import subprocess
@@ -17,6 +25,8 @@ import webbrowser
 
 import numpy as np
 import scipy.integrate as integrate
+import scipy.optimize
+import scipy.sparse
 import matplotlib.pyplot as plt
 import re
 from colored import fg, attr
@@ -95,15 +105,20 @@ class TimeQ:
     """
     Time-ordered queue for events
 
-    The list comprises tuples of (time, block) to reflect an event associated
+    The queue comprises tuples of (time, block) to reflect an event associated
     with the specified block at the specified time.
 
-    The list is not ordered, and is sorted on a pop event.
+    The queue is a binary heap, so pushing and popping an event is
+    O(log n).  An event source can also be pushed with an iterator over its
+    event times, see :meth:`push_source`, in which case the queue holds only
+    its next event and fetches the one after that when it is popped.  The
+    size of the queue is then proportional to the number of event sources,
+    not the number of events.
     """
 
     def __init__(self):
         self.q = []
-        self.dirty = False
+        self._count = itertools.count()  # tie breaker for simultaneous events
 
     def __len__(self):
         """
@@ -124,7 +139,7 @@ class TimeQ:
         if len(self) == 0:
             return f"TimeQ: len={len(self)}"
         else:
-            return f"TimeQ: len={len(self)}, first out {self.q[0]}"
+            return f"TimeQ: len={len(self)}, first out {self.q[0][0], self.q[0][2]}"
 
     def __repr__(self):
         return str(self)
@@ -138,8 +153,41 @@ class TimeQ:
 
         Push a block and a time onto the queue.
         """
-        self.q.append(value)
-        self.dirty = True
+        t, block = value
+        heapq.heappush(self.q, (t, next(self._count), block, None))
+
+    def push_source(self, block, events):
+        """
+        Push an event source onto time-ordered queue
+
+        :param block: the source of the events
+        :type block: Block or Clock
+        :param events: event times in ascending order
+        :type events: iterable of float
+
+        Only the first event is placed in the queue, the next event is taken
+        from ``events`` when that event is popped.
+        """
+        events = iter(events)
+        self._refill(block, events)
+
+    def _refill(self, block, events):
+        # push the next event from this source, if there is one
+        if events is not None:
+            t = next(events, None)
+            if t is not None:
+                heapq.heappush(self.q, (t, next(self._count), block, events))
+
+    def peek(self):
+        """
+        Time of the next event
+
+        :return: time of the first event in the queue, None if empty
+        :rtype: float
+        """
+        if len(self) == 0:
+            return None
+        return self.q[0][0]
 
     def pop(self, dt=0):
         """
@@ -156,15 +204,17 @@ class TimeQ:
         if len(self) == 0:
             return None, []
 
-        if self.dirty:
-            self.q.sort(key=lambda x: x[0])
-            self.dirty = False
-
-        qfirst = self.q.pop(0)
-        t = qfirst[0]
-        blocks = [qfirst[1]]
+        t, _, block, events = heapq.heappop(self.q)
+        blocks = [block]
+        sources = [(block, events)]
         while len(self.q) > 0 and self.q[0][0] < (t + dt):
-            blocks.append(self.q.pop(0)[1])
+            _, _, block, events = heapq.heappop(self.q)
+            blocks.append(block)
+            sources.append((block, events))
+
+        # schedule the next event from each source that was popped
+        for block, events in sources:
+            self._refill(block, events)
         return t, blocks
 
     def pop_until(self, t):
@@ -173,25 +223,17 @@ class TimeQ:
 
         :param t: time
         :type t: float
-        :return: list of blocks remaining sorted by receding time
+        :return: list of (time, block) tuples in order of increasing time
         :rtype: list
 
         Pops all items with time less than or equal to ``t``.
         """
-        if len(self) == 0:
-            return []
-
-        if self.dirty:
-            self.q.sort(key=lambda x: x[0])
-            self.dirty = False
-
-        i = 0
-        while True:
-            if self.q[i][0] > t:
-                out = self.q[:i]
-                self.q = self.q[i:]
-                return out
-            i += 1
+        out = []
+        while len(self.q) > 0 and self.q[0][0] <= t:
+            tq, _, block, events = heapq.heappop(self.q)
+            out.append((tq, block))
+            self._refill(block, events)
+        return out
 
 # convert class name to BLOCK name
 # strip underscores and capitalize
@@ -228,10 +270,50 @@ class BDSimState:
         self.debugger = True
         self.t_stop = None  # time-based breakpoint
         self.eventq = TimeQ()
+        self.schedule = None  # clock events, see ClockSchedule
 
     def declare_event(self, block, t):
         self.eventq.push((t, block))
 
+    def declare_events(self, block, events):
+        self.eventq.push_source(block, events)
+
+# state of a parameter sweep worker process, inherited when the process
+# is forked so the block diagram is not pickled
+_sweep_context = None
+
+def _sweep_init(sim, bd, runargs):
+    global _sweep_context
+    sim.options.graphics = False
+    sim.options.progress = False
+    _sweep_context = (sim, bd, runargs)
+
+def _sweep_run(point):
+    # run the block diagram for one point of a parameter sweep
+    sim, bd, runargs = _sweep_context
+    with contextlib.redirect_stdout(io.StringIO()):
+        for key, value in point.items():
+            block, name = _sweep_param(bd, key)
+            block.set_param(name, value)
+        _sweep_recompile(bd)
+        return sim.run(bd, **runargs)
+
+def _sweep_recompile(bd):
+    # the optimizer and Numba compile parameter values into the plan
+    if bd.optimized is not None or bd.jitted is not None:
+        bd.compile(verbose=False, **bd.compileargs)
+
+def _sweep_param(bd, key):
+    # resolve "blockname.param" to a block and parameter name
+    blockname, _, name = key.rpartition('.')
+    try:
+        block = bd.blocknames[blockname]
+    except KeyError:
+        raise ValueError(f"unknown block in parameter {key}") from None
+    if name not in block._parameters:
+        raise ValueError(f"block {blockname} has no parameter {name}")
+    return block, name
+
 class BDSim:
 
     _blocklibrary = None
@@ -315,7 +397,8 @@ class BDSim:
 
     def run(self, bd, T=5, dt=None, solver='RK45', solver_args={}, debug='',
             block=None, checkfinite=True, minstepsize=1e-12, watch=[],
-            ):
+            warmstart=False, zerocross=False, t_eval=None, sample_dt=None, record=None,
+            store=None, jacobian=False):
         """
         Run the block diagram
         
@@ -335,10 +418,29 @@ class BDSim:
         :type watch: list
         :param solver_args: arguments passed to ``scipy.integrate``
         :type solver_args: dict
+        :param warmstart: continue the integrator across discrete events, default False
+        :type warmstart: bool
+        :param zerocross: locate the zero crossings of block guards, default False
+        :type zerocross: bool
+        :param t_eval: times at which results are recorded, defaults to every step
+        :type t_eval: array_like(M), optional
+        :param sample_dt: interval at which results are recorded, defaults to every step
+        :type sample_dt: float, optional
+        :param record: recording policy for the state, and default for the watched ports
+        :type record: Policy, optional
+        :param store: directory to which results are written during the run,
+            defaults to keeping them in memory
+        :type store: str, Path or Store, optional
+        :param jacobian: give the Jacobian assembled from the blocks to the solver, default False
+        :type jacobian: bool
+        :raises ValueError: ``t_eval`` is not increasing or not within the simulation time
         :return: time history of signals and states
         :rtype: Sim class
         
-        Assumes that the network has been compiled.
+        Assumes that the network has been compiled.  If it was compiled with
+        ``optimize=True`` and a watched block was removed from the plan by the
+        optimizer, the diagram is compiled again with the watched ports added
+        to ``keep``.
 
         The system is simulated from time 0 to ``T``.
 
@@ -347,6 +449,19 @@ class BDSim:
         ``first_step`` parameters to the underlying integrator using the
         ``solver_args`` parameter.
 
+        ``solver`` is the name of a ``scipy.integrate`` solver, or one of the
+        native fixed-step solvers ``'euler'``, ``'heun'`` or ``'rk4'`` which
+        take steps of exactly ``dt``, see :mod:`bdsim.solvers`.
+
+        If ``solver`` is ``'auto'`` the explicit method ``RK45`` is used
+        until the problem is detected to be stiff, from the spectral radius
+        estimated from its stages, its rejected steps and the collapse of its
+        step size, and then the implicit method ``BDF`` until it is no longer
+        stiff, see :class:`~bdsim.solvers.Stiffness`.  At each switch the new
+        solver continues from the last step, which has been recorded, and the
+        switch is logged.  The time and new method of each switch are in
+        ``sim.state.stiffness.switches``.
+
         Results are returned in a class with attributes:
             
         - ``t`` the time vector: ndarray, shape=(M,)
@@ -354,6 +469,7 @@ class BDSim:
         - ``xnames`` is a list of the names of the states corresponding to columns of `x`, eg. "plant.x0",
             defined for the block using the ``snames`` argument
         - ``yN`` for a watched input where N is the index of the port mentioned in the ``watch`` argument
+        - ``yN_t`` the times at which ``yN`` was recorded, the same as ``t`` unless it has a recording policy
         - ``ynames`` is a list of the names of the input ports being watched, same order as in ``watch`` argument
         
         If there are no dynamic elements in the diagram, ie. no states, then ``x`` and ``xnames`` are not
@@ -364,6 +480,25 @@ class BDSim:
             - a ``Block`` reference, which is interpretted as input port 0
             - a ``Plug`` reference, ie. a block with an index or attribute
             - a string of the form "block[i]" which is port i of the block named block.
+            - a tuple ``(port, policy)`` where ``port`` is any of the above
+              and ``policy`` is a :class:`~bdsim.recording.Policy`
+
+        By default the state and watched ports are recorded at every time
+        step.  For long simulations a :class:`~bdsim.recording.Policy`
+        selects which values are recorded, for example every N'th value, on
+        a change of value, around a trigger condition, or only the last K
+        values, which bounds the memory used.  The policy ``record`` applies
+        to ``t`` and ``x``, and to the watched ports that do not have their
+        own policy, given in ``watch`` or to the ``WATCH`` block, and each
+        such port is recorded with its own times ``yN_t``.
+
+        If ``store`` is given the time, state, clock states and watched ports
+        are written to files in that directory as the simulation runs, and the
+        results returned are memory-mapped from those files, see
+        :class:`~bdsim.recording.Store`.  They can be loaded again by
+        :func:`~bdsim.recording.load`, and ``out.column(name)`` gives the
+        time history of a state or watched port by its name in ``xnames`` or
+        ``ynames``.
 
         The debug string comprises single letter flags:
                 
@@ -371,6 +506,50 @@ class BDSim:
                 - 's' debug state vector
                 - 'd' debug state derivative 
         
+        If the block diagram has clocks but no continuous states, the clocks
+        are stepped by a dedicated event loop, unless the class attribute
+        ``discrete_engine`` is False.
+
+        If the block diagram has clocks or other event sources, the simulation
+        is split into intervals that end at each event, and by default a new
+        solver is created for each interval.  If ``warmstart`` is True, a
+        single solver is continued across the events, keeping its step size,
+        see :func:`bdsim.solvers.restart`.  This is supported by the native
+        solvers and ``RK23``, ``RK45`` and ``DOP853``, other solvers are
+        recreated, and the number of solver restarts avoided is reported.
+
+        Blocks with discontinuities, such as ``CLIP``, ``INTEGRATOR`` with
+        limits, ``STOP`` or a ``FUNCTION`` with a ``guard``, provide
+        zero-crossing guards, see :meth:`Block.guard`.  If ``zerocross`` is
+        True and a guard changes sign during a solver step, the time of the
+        crossing is found by root finding on the solver's dense output, the
+        step is shortened to end just after it, and a new solver is started
+        there.  The solver can then take large steps between the
+        discontinuities, but a guard that changes sign twice within one step
+        is not seen, so ``dt`` should be less than the shortest time between
+        crossings.  Zero crossings are not located by default, which keeps
+        the time steps of existing diagrams, nor for a diagram compiled with
+        ``jit=True``.
+
+        By default the results are recorded, and the sink blocks are stepped,
+        after every solver step, and so that they are dense enough the solver
+        step is limited to ``dt``.  If ``t_eval``, an increasing sequence of
+        times, or ``sample_dt`` is given, the results are recorded and the
+        sinks stepped only at those times, using the solver's dense output,
+        and the solver step is only limited if ``dt`` is given.  The number of
+        steps then depends on the accuracy required, not the number of
+        results.  This applies to diagrams with continuous states, and a
+        diagram compiled with ``jit=True`` is simulated by the interpreter.
+
+        The implicit solvers ``BDF``, ``Radau`` and ``LSODA`` need the
+        Jacobian of the state derivative.  By default they estimate it by
+        evaluating the block diagram with each state perturbed, or for
+        ``BDF`` and ``Radau`` each group of states that do not share a
+        derivative, see :meth:`BlockDiagram.jacobian_sparsity`.  If
+        ``jacobian`` is True it is instead assembled from the partial
+        derivatives of the blocks, see :meth:`BlockDiagram.jacobian`, which
+        is exact for blocks that know them in closed form.
+
         .. note:: Simulation stops if the step time falls below ``minsteplength``
             which typically indicates that the solver is struggling with a very
             harsh non-linearity.
@@ -393,17 +572,55 @@ class BDSim:
         # T = T or 5
         # dt = dt or 0.01
 
+        # the optimizer may have removed watched blocks from the plan
+        watchlist, watchnamelist, watchpolicies = self._watchlist(bd, watch)
+        self._keep(bd, watchlist)
+
         state = BDSimState()
         self.state = state
         state.T = T
 
-        if dt is None and not 'max_step' in solver_args:
+        # times at which results are recorded, if not every step
+        if t_eval is not None and sample_dt is not None:
+            raise ValueError('specify only one of t_eval and sample_dt')
+        if sample_dt is not None:
+            t_eval = np.minimum(sample_dt * np.arange(int(T / sample_dt + 1e-9) + 1), T)
+        if t_eval is not None:
+            t_eval = np.array(t_eval, dtype=float).ravel()
+            if np.any(np.diff(t_eval) <= 0):
+                raise ValueError('t_eval must be increasing')
+            if len(t_eval) > 0 and (t_eval[0] < 0 or t_eval[-1] > T):
+                raise ValueError('t_eval must be within the simulation time')
+        state.samples = t_eval
+        state.nsamples = 0  # number of samples recorded
+
+        if dt is None and not 'max_step' in solver_args \
+                and (t_eval is None or solver in solvers.fixedstep):
             dt = T / 100
         state.dt = dt
         state.count = 0
         state.solver = solver
-        state.solver_args = solver_args
+        state.solver_args = dict(solver_args)  # max_step is set from dt
+        state.stiffness = None
+        if solver == 'auto':
+            # switched between an explicit and an implicit method
+            state.stiffness = solvers.Stiffness()
+            state.implicit_args = self._jacobian_args(bd, state.stiffness.implicit, solver_args, jacobian)
+        else:
+            state.solver_args.update(self._jacobian_args(bd, solver, solver_args, jacobian))
         state.minstepsize = minstepsize
+        state.warmstart = warmstart
+        state.integrator = None  # solver continued across intervals
+        state.restarts_avoided = 0
+        state.h_abs = None  # step size proposed before the last step
+        # blocks that may have zero-crossing guards
+        state.guarded = [b for b in bd.blocklist
+            if zerocross and bd.jitted is None and type(b).guard is not Block.guard
+                and not self._dead(bd, b)]
+        state.zerocrossings = 0
+        state.crossings_missed = 0  # guard sign changes that were not bracketed
+        for b in bd.blocklist:
+            b.__dict__.pop('_sides', None)  # left by an interrupted run
         state.stop = None # allow any block to stop.BlockDiagram by setting this to the block's name
         state.checkfinite = checkfinite
         # state.options = copy.copy(self.options)
@@ -421,61 +638,58 @@ class BDSim:
         if block is not None:
             self.options.hold = block
 
-        # process the watchlist
-        #  elements can be:
-        #   - block or Plug reference
-        #   - str in the form BLOCKNAME[PORT]
-        watchlist = []
-        watchnamelist = []
-        re_block = re.compile(r'(?P<name>[^[]+)(\[(?P<port>[0-9]+)\])')
-        for w in watch:
-            if isinstance(w, str):
-                # a name was given, with optional port number
-                m = re_block.match(w)
-                if m is None:
-                    raise ValueError('watch block[port] not found: ' + w)
-                name = m.group('name')
-                port = int(m.group('port'))
-                b = bd.blocknames[name]
-                plug = b[port]
-            elif isinstance(w, Block):
-                # a block was given, defaults to port 0
-                plug = w[0]
-            elif isinstance(w, Plug):
-                # a plug was given
-                plug = w
-            watchlist.append(plug)
-            watchnamelist.append(str(plug))
         state.watchlist = watchlist
         state.watchnamelist = watchnamelist
+        state.watchpolicies = watchpolicies  # policy of each watched port, by index
 
-        x0 = bd.getstate0()
+        x0 = bd.getstate0().copy()
         print('initial state  x0 = ', x0)
 
-        # get the number of discrete states from all clocks
-        ndstates = 0
+        # set the initial discrete state of all clocks
         for clock in bd.clocklist:
-            nds = 0
-            for b in clock.blocklist:
-                nds += b.ndstates
-            ndstates += nds
-            print(clock.name, 'initial dstate x0 = ', clock.getstate())
+            clock._x = clock.getstate0()
+            print(clock.name, 'initial dstate x0 = ', clock._x)
+
+        # clock events are taken from the schedule built by compile, if any,
+        # rather than the event queue
+        state.schedule = bd.schedule
+        if state.schedule is not None:
+            state.schedule.start()
 
         # tell all blocks we're starting a BlockDiagram
         self.bd.start(state=state, graphics=self.state.options.graphics)
 
-        # initialize list of time and states
-        state.tlist = []
-        state.xlist = []
-        state.plist = [[] for p in state.watchlist]
+        # initialize the recording of time, states and watched ports, blocks
+        # may have added ports to the watchlist
+        if store is not None and not isinstance(store, Store):
+            store = Store(store)
+        state.store = store
+        if store is None:
+            state.trace = Channel(record)
+            state.plist = [Channel(state.watchpolicies.get(i, record), timed=False)
+                for i in range(len(state.watchlist))]
+        else:
+            state.trace = store.channel('x', record, tname='t')
+            state.plist = [store.channel('y' + str(i), state.watchpolicies.get(i, record), timed=False)
+                for i in range(len(state.watchlist))]
+            state.clocktrace = {}
+            for c in bd.clocklist:
+                name = c.name.replace('.', '')
+                state.clocktrace[c] = store.channel(name + '/x', tname=name + '/t')
+        # ports added by the blocks must also be computed by the plan
+        self._keep(bd, state.watchlist, recompile=False)
 
         self.progress = Progress(enable=self.options.progress)
         self.progress.start(T)
 
-        if len(self.state.eventq) == 0:
+        if len(self.state.eventq) == 0 and state.schedule is None:
             # no simulation events, solve it in one go
             self.run_interval(bd, 0, T, x0, state=state)
             nintervals = 1
+        elif self.discrete_engine and bd.nstates == 0 and len(bd.clocklist) > 0 \
+                and 'i' not in state.options.debug:
+            # only discrete states, step the clocks directly
+            nintervals = self._run_discrete(bd, T, state)
         else:
             # we have simulation events, solve it in chunks
             self.state.declare_event(None, T)  # add an event at end of simulation
@@ -491,7 +705,7 @@ class BDSim:
             while True:
                 # get next event from the queue and the list of blocks or
                 # clocks at that time
-                tnext, sources = self.state.eventq.pop(dt=1e-6)
+                tnext, sources = self._next_event(state, dt=1e-6)
                 if tnext is None:
                     break
                 # run system until next event time
@@ -502,15 +716,20 @@ class BDSim:
                 for source in sources:
                     if isinstance(source, Clock):
                         # clock ticked, save its state
-                        clock.savestate(tnext)
-                        clock.next_event(self.state)
+                        source.savestate(tnext)
 
-                        # get the new state
-                        clock._x = clock.getstate()
+                        # the saved state is the new state
+                        source._x = source.x[-1]
+
+                        if state.store is not None:
+                            # stream the clock state to the store
+                            state.clocktrace[source].append(tnext, source._x)
+                            source.t.clear()
+                            source.x.clear()
                 tprev = tnext
 
-                # are we done?
-                if state.t is not None and state.t >= T:
+                # are we done?  Event sources may generate events forever
+                if tnext >= T or (state.t is not None and state.t >= T):
                     break
 
         # finished integration
@@ -520,28 +739,45 @@ class BDSim:
         # print some info about the integration
         print(fg('yellow'))
         print(f"integrator steps:      {state.count}")
-        print(f"time steps:            {len(state.tlist)}")
+        print(f"time steps:            {state.trace.offered}")
         print(f"integration intervals: {nintervals}")
+        if warmstart:
+            print(f"solver restarts avoided: {state.restarts_avoided}")
+        if state.stiffness is not None:
+            print(f"solver switches:       {len(state.stiffness.switches)}")
+        if len(state.guarded) > 0:
+            print(f"zero crossings:        {state.zerocrossings}")
+            if state.crossings_missed > 0:
+                print(f"zero crossings missed: {state.crossings_missed}")
         print(attr(0))
 
         # save buffered data in a Struct
         out = BDStruct(name='results')
-        out.t = np.array(state.tlist)
-        out.x = np.array(state.xlist)
+        out.t, out.x = state.trace.arrays()
         out.xnames = bd.statenames
 
         # save clocked states
         for c in bd.clocklist:
             name = c.name.replace('.', '')
             clockdata = BDStruct(name)
-            clockdata.t = np.array(c.t)
-            clockdata.x = np.array(c.x)
+            if state.store is None:
+                clockdata.t = np.array(c.t)
+                clockdata.x = np.array(c.x)
+            else:
+                # the discrete engine keeps the clock states until the end
+                channel = state.clocktrace[c]
+                channel.extend(c.t, c.x)
+                clockdata.t, clockdata.x = channel.arrays()
             out.add(name, clockdata)
 
         # save the watchlist into variables named y0, y1 etc.
-        for i, p in enumerate(watchlist):
-            out['y'+str(i)] = np.array(state.plist[i])
-        out.ynames = watchnamelist
+        for i, p in enumerate(state.watchlist):
+            t, y = state.plist[i].arrays()
+            out['y'+str(i)] = y
+            out['y'+str(i)+'_t'] = out.t if t is None else t
+        out.ynames = state.watchnamelist
+        if state.store is not None:
+            out = state.store.close(out)
 
         # pause until all graphics blocks close
         if self.options.graphics:
@@ -549,6 +785,796 @@ class BDSim:
 
         return out
         
+    def run_ensemble(self, bd, x0_batch=None, params_batch=None, T=5, dt=None,
+                     solver='RK45', solver_args={}, watch=[]):
+        """
+        Run the block diagram for an ensemble of initial states and parameters
+
+        :param bd: the system blockdiagram 
+        :type bd: BlockDiagram
+        :param x0_batch: initial state of each member, defaults to the initial state of the blocks
+        :type x0_batch: array_like(N, nstates), optional
+        :param params_batch: parameter values of each member
+        :type params_batch: dict, optional
+        :param T: maximum integration time, defaults to 5
+        :type T: float, optional
+        :param dt: maximum time step, defaults to ``T/100``
+        :type dt: float, optional
+        :param solver: integration method, defaults to ``RK45``
+        :type solver: str, optional
+        :param solver_args: arguments passed to the solver
+        :type solver_args: dict
+        :param watch: list of output ports to log
+        :type watch: list
+        :raises ValueError: the ensemble is not consistently defined
+        :return: time history of signals and states
+        :rtype: BDStruct
+
+        Simulate ``N`` copies of the block diagram, the members of an
+        ensemble, which differ in their initial state or parameter values,
+        for example for Monte Carlo analysis.  The members are integrated
+        together as one system whose state is an array of shape
+        ``(N, nstates)``.  Blocks that support batch evaluation compute
+        all members with one NumPy call, other blocks are evaluated once per
+        member.
+
+        ``params_batch`` is a dictionary whose keys are strings of the form
+        ``"blockname.param"`` and whose values are sequences of ``N`` values,
+        for example::
+
+            out = sim.run_ensemble(bd, params_batch={'gain.0.K': np.linspace(1, 2, 10)})
+
+        The parameter must have been declared by the block using
+        :meth:`Block.add_param`.
+
+        Results are returned in a class with attributes:
+
+        - ``t`` the time vector: ndarray, shape=(M,)
+        - ``x`` is the state of each member: ndarray, shape=(M,N,nstates)
+        - ``xnames`` is a list of the names of the states
+        - ``yN`` for a watched output port, with a second axis of length N
+        - ``ynames`` is a list of the names of the ports being watched
+
+        .. note::
+            - The members share the integration time steps.
+            - Sink blocks are not executed, record signals using ``watch``.
+            - Clocked blocks are not supported.
+            - The diagram must not be compiled with ``optimize`` or ``jit``.
+
+        :seealso: :meth:`run` :attr:`Block.batch`
+        """
+        assert bd.compiled, 'Network has not been compiled'
+        if len(bd.clocklist) > 0:
+            raise ValueError('ensemble simulation does not support clocked blocks')
+        if bd.nstates == 0:
+            raise ValueError('ensemble simulation requires continuous states')
+        if len(bd.loops) > 0:
+            raise ValueError('ensemble simulation does not support algebraic loops')
+        if bd.optimized is not None or bd.jitted is not None:
+            # the optimizer and Numba compile parameter values into the plan
+            raise ValueError('ensemble simulation does not support optimized or jitted diagrams')
+        if solver == 'auto':
+            raise ValueError('ensemble simulation does not support solver switching')
+
+        # determine the ensemble size
+        sizes = set()
+        if x0_batch is not None:
+            x0_batch = np.array(x0_batch, dtype=float)
+            if x0_batch.ndim != 2 or x0_batch.shape[1] != bd.nstates:
+                raise ValueError(f"x0_batch must have shape (N, {bd.nstates})")
+            sizes.add(x0_batch.shape[0])
+
+        memberparams = {}
+        if params_batch is not None:
+            for key, values in params_batch.items():
+                blockname, _, name = key.rpartition('.')
+                try:
+                    block = bd.blocknames[blockname]
+                except KeyError:
+                    raise ValueError(f"unknown block in parameter {key}") from None
+                if name not in block._parameters:
+                    raise ValueError(f"block {blockname} has no parameter {name}")
+                try:
+                    values = np.array(values, dtype=float)
+                except (ValueError, TypeError):
+                    values = list(values)  # non-numeric or ragged values
+                sizes.add(len(values))
+                memberparams.setdefault(block, {})[name] = values
+
+        if len(sizes) != 1:
+            raise ValueError('ensemble size is undefined or inconsistent')
+        N = sizes.pop()
+        if x0_batch is None:
+            x0_batch = np.tile(bd.getstate0(), (N, 1))
+
+        state = BDSimState()
+        self.state = state
+        state.T = T
+        if dt is None and not 'max_step' in solver_args:
+            dt = T / 100
+        state.dt = dt
+        state.count = 0
+        state.solver = solver
+        state.solver_args = solver_args
+        state.options = self.options
+        self.bd = bd
+
+        watchlist, watchnamelist, _ = self._watchlist(bd, watch)
+        state.watchlist = watchlist
+        state.watchnamelist = watchnamelist
+        state.trace = Channel()
+        state.plist = [Channel(timed=False) for p in watchlist]
+
+        # decide which blocks are batch evaluated and set batched parameters,
+        # parameter values are restored at the end
+        saved = {}
+        for b in bd.blocklist:
+            b._memberparams = memberparams.get(b, {})
+            b._batched = b.batch and all(
+                name in b.batchparams and isinstance(values, np.ndarray)
+                    for name, values in b._memberparams.items())
+            for name, values in b._memberparams.items():
+                saved[b, name] = getattr(b, name)
+                if b._batched:
+                    b._parameters[name](b, name, values)
+
+        try:
+            bd.start(state=state, graphics=False)
+
+            # integrate piecewise between events
+            state.declare_event(None, T)
+            state.eventq.pop_until(0)
+            t = 0
+            y = x0_batch.flatten()
+            while t < T:
+                tnext, sources = state.eventq.pop(dt=1e-6)
+                if tnext is None:
+                    break
+                tnext = min(tnext, T)
+                if tnext > t:
+                    y = self._ensemble_interval(bd, t, tnext, y, N, state)
+                t = tnext
+        finally:
+            for (b, name), value in saved.items():
+                b._parameters[name](b, name, value)
+            for b in bd.blocklist:
+                b.__dict__.pop('_memberparams', None)
+                b.__dict__.pop('_batched', None)
+
+        # save buffered data in a Struct
+        out = BDStruct(name='results')
+        out.t, out.x = state.trace.arrays()
+        out.xnames = bd.statenames
+
+        # save the watchlist into variables named y0, y1 etc.
+        for i, p in enumerate(watchlist):
+            out['y'+str(i)] = state.plist[i].arrays()[1]
+        out.ynames = watchnamelist
+
+        return out
+
+    def _ensemble_interval(self, bd, t0, T, y0, N, state):
+        # integrate the ensemble over an interval, the state of all members is
+        # flattened into a single vector for the solver
+
+        def ydot(t, y):
+            state.t = t
+            return bd.evaluate_batch(y.reshape((N, -1)), t).ravel()
+
+        if state.solver in solvers.fixedstep:
+            solver = solvers.fixedstep[state.solver]
+        else:
+            solver = integrate.__dict__[state.solver]
+
+        solver_args = dict(state.solver_args)
+        if state.dt is not None:
+            solver_args['max_step'] = state.dt
+        if state.solver in ('BDF', 'Radau') and bd.sparsity is not None \
+                and 'jac' not in solver_args and 'jac_sparsity' not in solver_args:
+            # the members are independent, the Jacobian is block diagonal
+            solver_args['jac_sparsity'] = scipy.sparse.kron(
+                scipy.sparse.identity(N, dtype=bool), bd.sparsity, format='csc')
+        integrator = solver(ydot, t0=t0, y0=y0, t_bound=T, **solver_args)
+
+        while integrator.status == 'running':
+            message = integrator.step()
+            if integrator.status == 'failed':
+                print(fg('red') + f"\nintegration completed with failed status: {message}" + attr(0))
+                break
+
+            # stash the results
+            X = integrator.y.reshape((N, -1))
+            state.trace.append(integrator.t, X)
+
+            # record the ports on the watchlist, at the state just computed
+            if len(state.watchlist) > 0:
+                bd.evaluate_batch(X, integrator.t)
+                for i, p in enumerate(state.watchlist):
+                    state.plist[i].append(integrator.t, p.block.output_values[p.port])
+            state.count += 1
+
+        return integrator.y
+
+    def sweep(self, bd, grid, T=5, workers=None, callback=None, **runargs):
+        """
+        Run the block diagram over a grid of parameter values
+
+        :param bd: the system blockdiagram 
+        :type bd: BlockDiagram
+        :param grid: parameter values
+        :type grid: dict or list of dict
+        :param T: maximum integration time, defaults to 5
+        :type T: float, optional
+        :param workers: number of worker processes, defaults to number of CPUs
+        :type workers: int, optional
+        :param callback: function called as each run completes
+        :type callback: callable, optional
+        :param runargs: other arguments passed to :meth:`run`
+        :raises ValueError: unknown block or parameter
+        :return: parameter values and results of every run
+        :rtype: BDStruct
+
+        The block diagram is compiled once, if it has not been already, and
+        each combination of parameter values is simulated in a pool of
+        worker processes, which inherit the compiled block diagram.
+
+        If ``grid`` is a dictionary, its keys are strings of the form
+        ``"blockname.param"`` and its values are sequences of parameter
+        values, and all combinations are simulated, for example::
+
+            out = sim.sweep(bd, {'gain.K': [1, 2, 3], 'plant.num': [[1], [2]]}, T=10)
+
+        performs six runs.  Alternatively ``grid`` is a list of
+        dictionaries, each giving the parameter values for one run.
+        Parameters are set using :meth:`Block.set_param`.  A diagram compiled
+        with ``optimize=True``, or by Numba with ``jit=True``, has parameter
+        values compiled into its plan, and is compiled again for each run.
+
+        Results are collected as each run completes, and returned in a class
+        with attributes:
+
+        - ``params`` a list of dictionaries, the parameter values of each run
+        - ``results`` a list of the results returned by :meth:`run`, one per run,
+          in the same order as ``params``
+
+        ``callback(i, params, result)`` is called as the result of run ``i``
+        arrives.
+
+        .. note::
+            - Graphics are disabled for the runs.
+            - Worker processes are forked, on platforms which cannot fork, or
+              if ``workers`` is 1, the runs are performed sequentially in
+              this process.
+        """
+        if isinstance(grid, dict):
+            keys = list(grid.keys())
+            points = [dict(zip(keys, values)) for values in itertools.product(*grid.values())]
+        else:
+            points = [dict(point) for point in grid]
+
+        if not bd.compiled:
+            bd.compile()
+
+        # check the parameters before starting any runs
+        for point in points:
+            for key in point:
+                _sweep_param(bd, key)
+
+        runargs['T'] = T
+        results = [None] * len(points)
+
+        if workers is None:
+            workers = os.cpu_count()
+        if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                    mp_context=context, initializer=_sweep_init,
+                    initargs=(self, bd, runargs)) as executor:
+                futures = {executor.submit(_sweep_run, point): i for i, point in enumerate(points)}
+                for future in concurrent.futures.as_completed(futures):
+                    i = futures[future]
+                    results[i] = future.result()
+                    if callback is not None:
+                        callback(i, points[i], results[i])
+        else:
+            # run sequentially, restore the options and parameters afterwards
+            graphics = self.options.graphics
+            progress = self.options.progress
+            saved = {}
+            for point in points:
+                for key in point:
+                    block, name = _sweep_param(bd, key)
+                    saved[block, name] = getattr(block, name)
+            try:
+                _sweep_init(self, bd, runargs)
+                for i, point in enumerate(points):
+                    results[i] = _sweep_run(point)
+                    if callback is not None:
+                        callback(i, point, results[i])
+            finally:
+                self.options.graphics = graphics
+                self.options.progress = progress
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for (block, name), value in saved.items():
+                        block.set_param(name, value)
+                    _sweep_recompile(bd)
+
+        out = BDStruct(name='sweep')
+        out.params = points
+        out.results = results
+        return out
+
+    def _watchlist(self, bd, watch):
+        # process the watchlist
+        #  elements can be:
+        #   - block or Plug reference
+        #   - str in the form BLOCKNAME[PORT]
+        #   - tuple of one of the above and a recording policy
+        watchlist = []
+        watchnamelist = []
+        watchpolicies = {}
+        re_block = re.compile(r'(?P<name>[^[]+)(\[(?P<port>[0-9]+)\])')
+        for w in watch:
+            if isinstance(w, tuple):
+                w, policy = w
+                if not isinstance(policy, Policy):
+                    raise TypeError('watch policy must be a Policy')
+                watchpolicies[len(watchlist)] = policy
+            if isinstance(w, str):
+                # a name was given, with optional port number
+                m = re_block.match(w)
+                if m is None:
+                    raise ValueError('watch block[port] not found: ' + w)
+                name = m.group('name')
+                port = int(m.group('port'))
+                b = bd.blocknames[name]
+                plug = b[port]
+            elif isinstance(w, Block):
+                # a block was given, defaults to port 0
+                plug = w[0]
+            elif isinstance(w, Plug):
+                # a plug was given
+                plug = w
+            watchlist.append(plug)
+            watchnamelist.append(str(plug))
+        return watchlist, watchnamelist, watchpolicies
+
+    def _jit_interval(self, bd, t0, T, x0, state):
+        # integrate over the interval using the compiled engine, Python only
+        # records the results and steps the sinks
+        engine = bd.jitted
+        engine.start_interval()
+
+        if state.dt is not None:
+            state.solver_args['max_step'] = state.dt
+
+        print(f"run interval (jit): from {t0} to {t0+T}, args={state.solver_args}, x0={x0}")
+        if state.solver in solvers.fixedstep:
+            h = state.solver_args.get('first_step') or state.solver_args['max_step']
+            tout, yout, sout = engine.integrate(t0, T, h, x0, solvers.fixedstep[state.solver])
+            steps = zip(tout, yout, sout)
+        else:
+            ydot = lambda t, y: engine.ydot(t, y).copy()
+
+            def scipy_steps():
+                integrator = self._integrator(self._method(state), ydot, t0, T, x0, state)
+                while integrator.status == 'running':
+                    state.h_abs = getattr(integrator, 'h_abs', None)
+                    message = integrator.step()
+                    if integrator.status == 'failed':
+                        print(fg('red') + f"\nintegration completed with failed status: {message}" + attr(0))
+                        state.integrator = None
+                        return
+                    yield integrator.t, integrator.y, engine.signals(integrator.t, integrator.y)
+                    if integrator.status == 'running':
+                        integrator = self._switch(integrator, ydot, integrator.t, T, integrator.y, state) \
+                            or integrator
+
+            steps = scipy_steps()
+
+        sinks = [b for b in bd.blocklist if b.blockclass in ('sink', 'graphics')]
+        t, x = t0, x0
+        for t, x, s in steps:
+            state.t = t
+
+            # stash the results
+            state.trace.append(t, x)
+
+            # record the ports on the watchlist
+            for i, p in enumerate(state.watchlist):
+                state.plist[i].append(t, engine.value(s, p.block, p.port))
+
+            # update all blocks that need to know
+            engine.setinputs(s, sinks)
+            bd.step(state=state)
+
+            self.progress.update(state.t)  # update the progress bar
+
+            # has any block called a stop?
+            if state.stop is not None:
+                print(fg('red') + f"\n--- stop requested at t={state.t:.4f} by {state.stop}" + attr(0))
+                break
+
+        # leave all blocks consistent with the final state, for the clocked
+        # blocks and any event handling, this also unbinds the sink inputs
+        bd.evaluate_plan(np.array(x, dtype=float), t)
+        return x
+
+    discrete_engine = True  # use _run_discrete for diagrams with only discrete states
+
+    def _run_discrete(self, bd, T, state):
+        # event loop for a block diagram with no continuous states, it has
+        # the same events and results as run_interval, but the clocks are
+        # ticked directly, only the held blocks of the clocks that ticked
+        # are evaluated, only blocks with a step method are stepped, and the
+        # clock states are written into preallocated arrays
+        state.declare_event(None, T)  # add an event at end of simulation
+        state.eventq.pop_until(0)  # ignore all the events at zero
+
+        checkfinite = state.checkfinite
+        stepped = [b for b in bd.blocklist if type(b).step is not Block.step
+            and not (b.isgraphics and not state.options.graphics)]
+
+        if bd.jitted is not None:
+            return self._jit_discrete(bd, T, state, stepped)
+
+        # blocks and the outputs they read, evaluated at every event or when
+        # a clock they depend on ticks, the block outputs were checked when
+        # the diagram was compiled
+        def bind(blocks):
+            # the output of a clocked block depends only on its state, its
+            # inputs are read from the wires when its next state is computed,
+            # and the evaluators created by the optimizer gather their own
+            # inputs
+            return [(b, [] if b.blockclass == 'clocked' or hasattr(b, 'external')
+                else [(p.block, p.port) for p in b.sources]) for b in blocks]
+        plan = bind([b for group in bd._plans[0] for b in group])
+        held = bind(bd.held)
+        heldby = {}  # held blocks to evaluate, by set of clocks that ticked
+
+        def evaluate(blocks, t):
+            for b, inputs in blocks:
+                if len(inputs) > 0:
+                    b._inputs = [src.output_values[port] for src, port in inputs]
+                try:
+                    b.output_values = b.output(t)
+                except Exception:
+                    bd._evaluate_block(b, t, checkfinite)  # report the error
+
+        # state history of each clock, grown if the estimate is short
+        history = {}
+        ticks = {}
+        for clock in bd.clocklist:
+            n = max(int((T - clock.offset) / clock.T) + 2, 1)
+            history[clock] = np.empty((n, clock.ndstates))
+            ticks[clock] = 0
+
+        bd.reset()
+        t = 0.0
+        for clock in bd.clocklist:
+            clock.setstate()
+        evaluate(held, t)
+
+        nintervals = 0
+        while True:
+            tnext, sources = self._next_event(state, dt=1e-6)
+            if tnext is None:
+                break
+
+            # evaluate the block diagram
+            state.t = t
+            evaluate(plan, t)
+
+            # stash the results
+            state.trace.append(t)
+            for i, p in enumerate(state.watchlist):
+                state.plist[i].append(t, p.block.output_values[p.port])
+
+            # update all blocks that need to know
+            for b in stepped:
+                try:
+                    b.step(state=state)
+                except:
+                    bd._error_handler('step', b)
+            state.count += 1
+            nintervals += 1
+            self.progress.update(t)
+
+            if state.stop is not None:
+                print(fg('red') + f"\n--- stop requested at t={state.t:.4f} by {state.stop}" + attr(0))
+                break
+
+            # clocks that ticked save their next state, which is the new state
+            ticked = frozenset([c for c in sources if isinstance(c, Clock)])
+            for clock in ticked:
+                X = history[clock]
+                k = ticks[clock]
+                if k == X.shape[0]:
+                    X = history[clock] = np.concatenate((X, np.empty_like(X)))
+                for b in clock.blocklist:
+                    X[k, b._xslice] = np.asarray(b.next()).reshape(-1)
+                clock.t.append(tnext)
+                ticks[clock] = k + 1
+            for clock in ticked:
+                clock._x = history[clock][ticks[clock] - 1]
+                clock.setstate()
+            t = tnext
+
+            if len(ticked) > 0:
+                if ticked not in heldby:
+                    heldby[ticked] = [(b, inputs) for b, inputs in held
+                        if not ticked.isdisjoint(bd._heldclocks[b])]
+                evaluate(heldby[ticked], t)
+
+            if tnext >= T:
+                break
+
+        for clock in bd.clocklist:
+            clock.x = list(history[clock][:ticks[clock]])
+        bd.reset()  # unbind the inputs
+        bd._heldstate = None  # the held outputs are evaluated again
+        return nintervals
+
+    def _jit_discrete(self, bd, T, state, stepped):
+        # the event times and the clocks that tick are found first, then the
+        # compiled engine evaluates and ticks the whole run, Python only
+        # records the results and steps the sinks
+        engine = bd.jitted
+        engine.start_interval()
+        index = {clock: i for i, clock in enumerate(bd.clocklist)}
+
+        teval = []
+        tnext = []
+        masks = []
+        t = 0.0
+        while True:
+            tn, sources = self._next_event(state, dt=1e-6)
+            if tn is None:
+                break
+            mask = [False] * len(index)
+            for source in sources:
+                if isinstance(source, Clock):
+                    mask[index[source]] = True
+            teval.append(t)
+            tnext.append(tn)
+            masks.append(mask)
+            t = tn
+            if tn >= T:
+                break
+
+        masks = np.array(masks, dtype=bool).reshape((-1, len(index)))
+        sout, dout = engine.discrete(teval, masks)
+
+        if len(stepped) == 0:
+            # nothing to step, record all the results at once
+            nintervals = len(teval)
+            state.trace.extend(teval)
+            for j, p in enumerate(state.watchlist):
+                offset, shape = engine.slots[p.block, p.port]
+                if shape == ():
+                    state.plist[j].extend(teval, sout[:, offset])
+                else:
+                    state.plist[j].extend(teval, sout[:, offset:offset + shape[0]])
+            state.count += nintervals
+            state.t = teval[-1] if nintervals > 0 else 0.0
+            self.progress.update(state.t)
+        else:
+            nintervals = 0
+            for i, t in enumerate(teval):
+                state.t = t
+
+                # stash the results
+                state.trace.append(t)
+                for j, p in enumerate(state.watchlist):
+                    state.plist[j].append(t, engine.value(sout[i], p.block, p.port))
+
+                # update all blocks that need to know
+                engine.setinputs(sout[i], stepped)
+                for b in stepped:
+                    try:
+                        b.step(state=state)
+                    except:
+                        bd._error_handler('step', b)
+                state.count += 1
+                nintervals += 1
+                self.progress.update(t)
+
+                if state.stop is not None:
+                    print(fg('red') + f"\n--- stop requested at t={state.t:.4f} by {state.stop}" + attr(0))
+                    break
+
+        # the state history of each clock, up to the last event
+        tnext = np.array(tnext[:nintervals])
+        for clock, j in index.items():
+            ticked = masks[:nintervals, j]
+            offset = engine._doffset[clock]
+            clock.t = list(tnext[ticked])
+            clock.x = list(dout[:nintervals][ticked, offset:offset + clock.ndstates])
+            if len(clock.x) > 0:
+                clock._x = clock.x[-1]
+
+        # leave all blocks consistent with the final state
+        bd.reset()
+        bd._heldstate = None
+        bd.evaluate_plan([], state.t)
+        return nintervals
+
+    def _next_event(self, state, dt=0):
+        # pop the next events from the clock schedule and the event queue,
+        # events no more than dt apart are grouped
+        schedule = state.schedule
+        if schedule is None:
+            return state.eventq.pop(dt=dt)
+
+        tq = state.eventq.peek()
+        if tq is not None and tq < schedule.peek() - dt:
+            return state.eventq.pop(dt=dt)
+
+        t, sources = schedule.pop()
+        if tq is not None and tq < t + dt:
+            sources = sources + state.eventq.pop(dt=t + dt - tq)[1]
+        return t, sources
+
+    def _dead(self, bd, b):
+        # the block's output is not computed, the optimizer removed it from
+        # the plan
+        if bd.optimized is None:
+            return False
+        return b in bd.optimized.eliminated or any(
+            [b in f.blocks and b not in f.members for f in bd.optimized.merged])
+
+    def _keep(self, bd, watchlist, recompile=True):
+        # the optimizer removes blocks whose outputs are unused, or absorbs
+        # them into merged evaluators, so watched ports that were not given
+        # to compile by keep are not computed, compile again keeping them
+        dead = [p for p in watchlist if self._dead(bd, p.block)]
+        if len(dead) > 0 and recompile:
+            args = dict(bd.compileargs)
+            args['keep'] = list(args['keep']) + dead
+            bd.compile(verbose=False, **args)
+            dead = [p for p in dead if self._dead(bd, p.block)]
+        if len(dead) > 0:
+            raise ValueError(f"watched port {dead[0]} is not computed by the optimized plan, "
+                "give it to compile by keep=")
+
+    def _watch(self, state, t):
+        # record the ports on the watchlist, reading the outputs computed by
+        # the plan rather than evaluating the blocks again
+        for i, p in enumerate(state.watchlist):
+            state.plist[i].append(t, p.block.output_values[p.port])
+
+    def _guards(self, blocks, t):
+        # the guard values of the blocks, as one vector
+        return np.concatenate([np.zeros((0,))] + [np.ravel(b.guard(t)) for b in blocks]).astype(float)
+
+    def _crossing(self, bd, integrator, guarded, sides, state):
+        # find the first zero crossing of a guard during the last solver step,
+        # sides is the sign of each guard before the step and is updated
+        t = integrator.t
+        g = self._guards(guarded, t)
+        crossed = np.flatnonzero(sides * g < 0)
+        if len(crossed) == 0:
+            sides[g != 0] = np.sign(g[g != 0])
+            return None
+
+        # find the earliest root on the dense output, in the style of the
+        # events of solve_ivp
+        sol = integrator.dense_output()
+
+        def guard(t, k):
+            bd.evaluate_plan(sol(t), t)
+            return self._guards(guarded, t)[k]
+
+        tc = t
+        missed = []
+        for k in crossed:
+            try:
+                tc = min(tc, scipy.optimize.brentq(guard, integrator.t_old, t, args=(k,), xtol=1e-12))
+            except ValueError:
+                # sign change not seen on the dense output, the guard takes
+                # its value at the end of the step
+                missed.append(k)
+        state.crossings_missed += len(missed)
+
+        # end the step just after the root, so the guard has changed sign
+        tc = min(tc + 2 * (1e-12 + 4 * np.finfo(float).eps * abs(tc)), t)
+        if tc < t:
+            y = sol(tc)
+        else:
+            tc, y = t, integrator.y
+        gend = g[missed]
+        bd.evaluate_plan(y, tc)
+        g = self._guards(guarded, tc)
+        g[missed] = gend
+        sides[g != 0] = np.sign(g[g != 0])
+        if len(missed) < len(crossed):
+            state.zerocrossings += 1
+        if tc == t:
+            # at the end of the step, continue the solver
+            return None
+        return tc, y
+
+    def _sample(self, bd, integrator, t, state):
+        # record the results, and step the sinks, at the requested times up
+        # to t, interpolated on the solver's dense output for the last step
+        samples = state.samples
+        sol = None
+        while state.nsamples < len(samples) and samples[state.nsamples] <= t:
+            ts = samples[state.nsamples]
+            state.nsamples += 1
+            if sol is None:
+                if integrator.t_old is None:
+                    # the solver has not stepped, its state is at t
+                    sol = lambda ts: integrator.y
+                else:
+                    sol = integrator.dense_output()
+            y = sol(ts)
+            state.t = ts
+            bd.evaluate_plan(y, ts)
+
+            # stash the results
+            state.trace.append(ts, y)
+
+            # record the ports on the watchlist
+            self._watch(state, ts)
+
+            # update all blocks that need to know
+            bd.step(state=state)
+            if state.stop is not None:
+                break
+
+    def _jacobian_args(self, bd, solver, solver_args, jacobian):
+        # the Jacobian, or its sparsity pattern, for an implicit solver
+        args = {}
+        if 'jac' in solver_args:
+            return args
+        if jacobian and solver in ('BDF', 'Radau', 'LSODA'):
+            if solver == 'LSODA':
+                # does not accept a sparse Jacobian
+                args['jac'] = lambda t, y: bd.jacobian(y, t).toarray()
+            else:
+                args['jac'] = lambda t, y: bd.jacobian(y, t)
+        elif solver in ('BDF', 'Radau') and bd.sparsity is not None \
+                and bd.sparsity.nnz < bd.nstates ** 2 and 'jac_sparsity' not in solver_args:
+            # estimate the Jacobian over groups of independent states
+            args['jac_sparsity'] = bd.sparsity
+        return args
+
+    @staticmethod
+    def _method(state):
+        # the scipy solver, chosen by the stiffness detector for solver='auto'
+        if state.stiffness is not None:
+            return integrate.__dict__[state.stiffness.method]
+        return integrate.__dict__[state.solver]
+
+    def _integrator(self, solver, ydot, t0, T, x0, state):
+        # create a solver for the interval, or if warm starting continue the
+        # solver that finished the previous interval at the same point
+        integrator = state.integrator
+        if integrator is not None and integrator.t == t0 and np.array_equal(integrator.y, x0) \
+                and solvers.restart(integrator, T, h_abs=state.h_abs):
+            state.restarts_avoided += 1
+        else:
+            args = state.solver_args
+            if state.stiffness is not None and state.stiffness.method == state.stiffness.implicit:
+                args = {**args, **state.implicit_args}
+            integrator = solver(ydot, t0=t0, y0=x0, t_bound=T, **args)
+        if state.warmstart:
+            state.integrator = integrator
+        if state.stiffness is not None:
+            state.stiffness.start(integrator)
+        return integrator
+
+    def _switch(self, integrator, ydot, t, T, y, state):
+        # for solver='auto', a solver of the other method continuing from
+        # the last step if the problem has become, or is no longer, stiff
+        if state.stiffness is None or state.stiffness.update(integrator) is None:
+            return None
+        if self.options.verbose:
+            print(f"--- switching to {state.stiffness.method} at t={t:.4f}")
+        state.integrator = None
+        return self._integrator(self._method(state), ydot, t, T, y, state)
+
     def run_interval(self, bd, t0, T, x0, state):
         """
         Integrate system over interval
@@ -576,43 +1602,99 @@ class BDSim:
 
                 # block diagram contains states, solve it using numerical integration
 
-                scipy_integrator = integrate.__dict__[state.solver]  # get user specified integrator
+                if bd.jitted is not None and state.samples is None:
+                    # compiled simulation engine, see compile(jit=True)
+                    return self._jit_interval(bd, t0, T, x0, state)
 
-                def ydot(t, y):
-                    state.t = t
-                    return bd.evaluate_plan(y, t)
+                if bd.generated is not None:
+                    # generated evaluation code, see compile(codegen=True)
+                    evaluate = bd.generated
+                else:
+                    # the stages only need the blocks the derivative depends on
+                    evaluate = lambda t, y: bd.evaluate_plan(y, t, cone=True)
+
+                if state.solver in solvers.fixedstep:
+                    # native fixed-step solver, copies the derivative into
+                    # its own stage buffers
+                    scipy_integrator = solvers.fixedstep[state.solver]
+
+                    def ydot(t, y):
+                        state.t = t
+                        return evaluate(t, y)
+                else:
+                    scipy_integrator = self._method(state)  # get user specified integrator
+
+                    def ydot(t, y):
+                        state.t = t
+                        # the integrator retains the derivative, so it must
+                        # not alias the blockdiagram's derivative buffer
+                        return evaluate(t, y).copy()
 
                 if state.dt is not None:
                     state.solver_args['max_step'] = state.dt
 
                 print(f"run interval: from {t0} to {t0+T}, args={state.solver_args}, x0={x0}")
-                integrator = scipy_integrator(ydot,
-                    t0=t0, y0=x0, t_bound=T, **state.solver_args)
+                integrator = self._integrator(scipy_integrator, ydot, t0, T, x0, state)
+                t, y = integrator.t, integrator.y
+
+                # the zero-crossing guards, and the sign of each guard
+                guarded = state.guarded
+                if len(guarded) > 0:
+                    bd.evaluate_plan(y, t)
+                    guarded = [b for b in guarded if b.guard(t) is not None]
+                    sides = np.sign(self._guards(guarded, t))
+
+                    # the blocks switch on the sign of their guards
+                    offset = 0
+                    for b in guarded:
+                        n = np.size(b.guard(t))
+                        b._sides = sides[offset:offset + n]
+                        offset += n
+
+                if state.samples is not None:
+                    # the requested times at the start of the interval
+                    self._sample(bd, integrator, t, state)
 
                 # integrate
                 while integrator.status == 'running':
 
                     # step the integrator, calls _deriv and evaluate block diagram multiple times
+                    state.h_abs = getattr(integrator, 'h_abs', None)
                     message = integrator.step()
 
                     if integrator.status == 'failed':
                         print(fg('red') + f"\nintegration completed with failed status: {message}" + attr(0))
+                        state.integrator = None
                         break
 
-                    # stash the results
-                    state.tlist.append(integrator.t)
-                    state.xlist.append(integrator.y)
-                    
-                    # record the ports on the watchlist
-                    for i, p in enumerate(state.watchlist):
-                        state.plist[i].append(p.block.output(integrator.t)[p.port])
-                    
-                    # # update all blocks that need to know
-                    bd.step(state=self.state)
+                    # evaluate the blocks skipped by the stages, which only
+                    # feed the sinks
+                    t, y = integrator.t, integrator.y
+                    bd.evaluate_rest(t)
+
+                    # end the step at the first zero crossing within it
+                    crossing = None
+                    if len(guarded) > 0:
+                        crossing = self._crossing(bd, integrator, guarded, sides, state)
+                        if crossing is not None:
+                            t, y = crossing
+
+                    if state.samples is None:
+                        # stash the results
+                        state.trace.append(t, y)
+
+                        # record the ports on the watchlist
+                        self._watch(state, t)
+
+                        # # update all blocks that need to know
+                        bd.step(state=self.state)
+                    else:
+                        # record the requested times within the step
+                        self._sample(bd, integrator, t, state)
 
                     self.progress.update(self.state.t)  # update the progress bar
 
-                    if integrator.status == 'finished':
+                    if integrator.status == 'finished' and crossing is None:
                         break
 
                     # has any block called a stop?
@@ -627,7 +1709,18 @@ class BDSim:
                     if 'i' in state.options.debug:
                         bd._debugger(integrator)
 
-                return integrator.y  # return final state vector
+                    if crossing is not None:
+                        # restart the solver at the crossing
+                        integrator = self._integrator(scipy_integrator, ydot, t, T, y, state)
+                    else:
+                        switched = self._switch(integrator, ydot, t, T, y, state)
+                        if switched is not None:
+                            integrator = switched
+                            scipy_integrator = type(integrator)
+
+                for b in guarded:
+                    b.__dict__.pop('_sides', None)
+                return y  # return final state vector
 
             elif len(clocklist) == 0:
                 # block diagram has no continuous or discrete states
@@ -640,11 +1733,10 @@ class BDSim:
                     bd.evaluate_plan([], t)
 
                     # stash the results
-                    state.tlist.append(t)
+                    state.trace.append(t)
                     
                     # record the ports on the watchlist
-                    for i, p in enumerate(state.watchlist):
-                        state.plist[i].append(p.block.output(t)[p.port])
+                    self._watch(state, t)
 
                     # update all blocks that need to know
                     bd.step(state=state)
@@ -668,11 +1760,10 @@ class BDSim:
                 bd.evaluate_plan([], t)
 
                 # stash the results
-                state.tlist.append(t)
+                state.trace.append(t)
                 
                 # record the ports on the watchlist
-                for i, p in enumerate(state.watchlist):
-                    state.plist[i].append(p.block.output(t)[p.port])
+                self._watch(state, t)
 
                 # update all blocks that need to know
                 bd.step(state=state)
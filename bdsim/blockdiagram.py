@@ -11,18 +11,135 @@ import sys
 import importlib
 import inspect
 import traceback
-from collections import Counter, namedtuple
+import numbers
+import math
+import time
+import concurrent.futures
+from collections import Counter, namedtuple, deque
 from copy import deepcopy
 import numpy as np
+import scipy.sparse
 from colored import fg, attr
 
 
 from ansitable import ANSITable, Column
 
 from bdsim.components import *
+from bdsim import codegen as _codegen
+from bdsim import jit as _jit
+from bdsim import optimize as _optimize
+from bdsim.algebraic import AlgebraicLoop
 
 
 
+# ------------------------------------------------------------------------- #    
+
+class _MemberPlug:
+    # a plug that presents one member of an ensemble signal, so that a block
+    # can read its input via Block.input()
+
+    def __init__(self, plug, i):
+        self.block = self
+        self.port = 0
+        self.output_values = [plug.block.output_values[plug.port][i]]
+
+def _stack(values):
+    # stack per-member values along a new leading axis, values that are not
+    # numeric are kept as a list
+    if all(isinstance(v, (numbers.Number, np.ndarray)) for v in values):
+        return np.stack(values)
+    return values
+
+def _flatten(values):
+    # concatenate scalar and array values into a float vector
+    if len(values) == 0:
+        return np.zeros((0,))
+    return np.concatenate([np.ravel(np.asarray(v, dtype=float)) for v in values])
+
+def _unflatten(flat, like):
+    # split a float vector into values of the shapes of those in a list
+    values = []
+    i = 0
+    for v in like:
+        n = np.size(v)
+        if np.ndim(v) == 0:
+            values.append(float(flat[i]))
+        else:
+            values.append(flat[i:i + n].reshape(np.shape(v)))
+        i += n
+    return values
+
+def _vstack(matrices, n):
+    # stack sparse matrices with n columns, there may be none
+    if len(matrices) == 0:
+        return scipy.sparse.csr_matrix((0, n))
+    return scipy.sparse.vstack(matrices, format='csr')
+
+# ------------------------------------------------------------------------- #    
+
+def _strongly_connected(nodes, successors):
+    # strongly connected components of a graph by Tarjan's algorithm, with an
+    # explicit stack so that long paths do not exhaust the recursion limit
+    index = {}
+    lowlink = {}
+    stack = []
+    onstack = set()
+    components = []
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        onstack.add(root)
+        work = [(root, iter(successors(root)))]
+        while len(work) > 0:
+            v, edges = work[-1]
+            for w in edges:
+                if w not in index:
+                    index[w] = lowlink[w] = len(index)
+                    stack.append(w)
+                    onstack.add(w)
+                    work.append((w, iter(successors(w))))
+                    break
+                elif w in onstack:
+                    lowlink[v] = min(lowlink[v], index[w])
+            else:
+                # all successors of v visited
+                work.pop()
+                if len(work) > 0:
+                    u = work[-1][0]
+                    lowlink[u] = min(lowlink[u], lowlink[v])
+                if lowlink[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        onstack.discard(w)
+                        component.append(w)
+                        if w is v:
+                            break
+                    components.append(component[::-1])
+    return components
+
+def _cycle(component, successors):
+    # a cycle through the first node of a strongly connected component, found
+    # by a breadth first search back to it
+    start = component[0]
+    members = set(component)
+    parent = {}
+    queue = deque([start])
+    while len(queue) > 0:
+        v = queue.popleft()
+        for w in successors(v):
+            if w is start:
+                path = [v]
+                while path[-1] is not start:
+                    path.append(parent[path[-1]])
+                return path[::-1]
+            if w in members and w not in parent:
+                parent[w] = v
+                queue.append(w)
+    return component
+
 # ------------------------------------------------------------------------- #    
 
 class BlockDiagram:
@@ -64,6 +181,23 @@ class BlockDiagram:
         self.n_auto_prod = 0
         self.n_auto_const = 0
         self.n_auto_gain = 0
+        self._parallel = None   # per plan group, evaluate in thread pool
+        self.cone = None        # plan restricted to the derivative cone
+        self.rest = None        # plan blocks outside the derivative cone
+        self.held = []          # blocks whose outputs only change at clock ticks
+        self.schedule = None    # firing table for the clocks
+        self._plans = None      # plan, cone and rest without the held blocks
+        self._heldclocks = None # clocks that each held block depends on
+        self._heldstate = None  # clock states the held outputs were computed for
+        self.fused = []         # evaluators created by the optimizer
+        self.loops = []         # evaluators of algebraic loops
+        self.sparsity = None    # sparsity pattern of the Jacobian
+        self.optimized = None   # optimizer report
+        self.compileargs = None # options given to compile
+        self.generated = None   # generated evaluation function
+        self.jitted = None      # compiled simulation engine
+        self.jit_fallback = None  # why the compiled engine is not used
+        self._executor = None
         
     def __getitem__(self, b):
         return self.blocknames[b]
@@ -231,7 +365,7 @@ class BlockDiagram:
         
     # ---------------------------------------------------------------------- #
 
-    def compile(self, subsystem=False, doimport=True, evaluate=True, report=False, verbose=True):
+    def compile(self, subsystem=False, doimport=True, evaluate=True, report=False, verbose=True, parallel=False, codegen=False, jit=False, optimize=False, keep=[], algebraic=False):
         """
         Compile the block diagram
         
@@ -239,6 +373,20 @@ class BlockDiagram:
         :type subsystem: bool, optional
         :param doimport: import subsystems, defaults to True
         :type doimport: bool, optional
+        :param parallel: evaluate independent blocks using a thread pool, True
+            or the number of threads, defaults to False
+        :type parallel: bool or int, optional
+        :param codegen: generate a specialised evaluation function, defaults to False
+        :type codegen: bool, optional
+        :param jit: compile the block diagram to machine code using Numba, defaults to False
+        :type jit: bool, optional
+        :param optimize: optimize the execution plan, defaults to False
+        :type optimize: bool, optional
+        :param keep: blocks or ports whose outputs the optimizer must keep, defaults to []
+        :type keep: list of Block, Plug or str, optional
+        :param algebraic: solve algebraic loops, True or the method ``'newton'``
+            or ``'fixed'``, defaults to False
+        :type algebraic: bool or str, optional
         :raises RuntimeError: various block diagram errors
         :return: Compile status
         :rtype: bool
@@ -247,15 +395,66 @@ class BlockDiagram:
             
             - Check sanity of block parameters
             - Recursively clone and import subsystems
-            - Check for loops without dynamics
+            - Check for loops without dynamics, algebraic loops
             - Check for inputs driven by more than one wire
             - Check for unconnected inputs and outputs
             - Link all output ports to outgoing wires
             - Link all input ports to incoming wires
             - Evaluate all blocks in the network
 
+        If ``parallel`` is given, the blocks in each group of the execution
+        plan are evaluated concurrently by a persistent pool of threads.  This
+        is only worthwhile for blocks that release the GIL, such as those
+        performing heavy NumPy or SciPy computation, so the evaluation time of
+        each block is measured, and groups are only parallelised when the
+        expected saving exceeds the dispatch overhead.
+
+        If ``codegen`` is True, Python code that evaluates the plan is
+        generated and used by the simulator in place of :meth:`evaluate_plan`,
+        see :mod:`bdsim.codegen`.
+
+        If ``jit`` is True, and every block in the plan is supported, the
+        plan is compiled to machine code by Numba and the simulator runs it
+        in place of the interpreter, see :mod:`bdsim.jit`.  Otherwise the
+        interpreter is used and ``jit_fallback`` describes the reason.
+
+        If ``optimize`` is True, constant sub-graphs are folded, blocks whose
+        outputs are unused are eliminated, chains of operator-created blocks
+        are merged and sub-graphs of linear blocks are fused into state-space
+        evaluators, see :mod:`bdsim.optimize`.  Blocks whose outputs will be
+        watched should be given by ``keep``, otherwise :meth:`BDSim.run`
+        compiles the diagram again to keep them.  The attribute ``optimized``
+        reports what was changed.
+
+        The states that each state derivative depends on are found from the
+        wiring, and the attribute ``sparsity`` is the pattern of the
+        Jacobian, see :meth:`jacobian_sparsity`.
+
+        The blocks that the state derivative depends on, its cone, are found
+        and the integrator evaluates only those blocks at each stage, the rest
+        of the plan is evaluated once per accepted step, see
+        :meth:`derivative_cone`.  The outputs of clocked blocks, and of the
+        pure function blocks computed only from them, are held between clock
+        ticks, see :meth:`hold`.
+
+        If the periods and offsets of all clocks are multiples of a common
+        tick, the times at which they fire are tabulated in the attribute
+        ``schedule``, see :class:`ClockSchedule`.
+
+        An algebraic loop, a cycle of function blocks, is an error unless
+        ``algebraic`` is given.  Each loop is then solved by an evaluator in
+        the execution plan, see :mod:`bdsim.algebraic`, listed in the
+        attribute ``loops``.
+
+        The options are kept in the attribute ``compileargs``, so that the
+        diagram can be compiled again in the same way, for example after
+        parameters that the optimizer or Numba compiled into the plan have
+        been changed.
         """
-        
+        if not subsystem:
+            self.compileargs = dict(parallel=parallel, codegen=codegen, jit=jit,
+                optimize=optimize, keep=keep, algebraic=algebraic)
+
         # name the elements
         self.nblocks = len(self.blocklist)
         self.nwires = len(self.wirelist)
@@ -280,10 +479,11 @@ class BlockDiagram:
         self.blocklist, self.wirelist = self._subsystem_import(self, None)
 
         # check that wires all point to valid blocks
+        blocks = set(self.blocklist)
         for w in self.wirelist:
-            if w.start.block not in self.blocklist:
+            if w.start.block not in blocks:
                 raise RuntimeError(f"wire {w} starts at unreferenced block {w.start.block}")
-            if w.end.block not in self.blocklist:
+            if w.end.block not in blocks:
                 raise RuntimeError(f"wire {w} ends at unreferenced block {w.end.block}")
 
         # run block specific checks
@@ -297,9 +497,11 @@ class BlockDiagram:
         for b in self.blocklist:
             self.blocknames[b.name] = b
         
-        # visit all stateful blocks
+        # visit all stateful blocks, each transfer block is allocated a fixed
+        # slice of the state vector
         for b in self.blocklist:
             if b.blockclass == 'transfer':
+                b._xslice = slice(self.nstates, self.nstates + b.nstates)
                 self.nstates += b.nstates
                 if b._state_names is not None:
                     assert len(b._state_names) == b.nstates, 'number of state names not consistent with number of states'
@@ -310,11 +512,16 @@ class BlockDiagram:
             if b.blockclass == 'clocked':
                 self.ndstates += b.ndstates
                 if b._state_names is not None:
-                    assert len(b._state_names) == b.nstates, 'number of state names not consistent with number of states'
+                    assert len(b._state_names) == b.ndstates, 'number of state names not consistent with number of states'
                     self.dstatenames.extend(b._state_names)
                 else:
                     # create default state names
-                    self.statenames.extend([b.name + 'X' + str(i) for i in range(0, b.nstates)])
+                    self.dstatenames.extend([b.name + 'X' + str(i) for i in range(0, b.ndstates)])
+
+        # preallocate the state and derivative vectors
+        self.transferblocks = [b for b in self.blocklist if b.blockclass == 'transfer']
+        self._x0 = np.zeros((self.nstates,))
+        self._xd = np.zeros((self.nstates,))
 
         # initialize lists of input and output ports
         for b in self.blocklist:
@@ -360,30 +567,36 @@ class BlockDiagram:
                 assert len(b._state_names) == b.nstates, 'incorrect number of state names given: ' + str(b)
                     
         # check for cycles of function blocks
-        def _DFS(path):
-            start = path[0]
-            tail = path[-1]
-            for outgoing in tail.output_wires:
-                # for every port on this block
-                for w in outgoing:
-                    dest = w.end.block
-                    if dest == start:
-                        print('  ERROR: cycle found: ', ' - '.join([str(x) for x in path + [dest]]))
-                        return True
-                    if dest.blockclass == 'function':
-                        return _DFS(path + [dest]) # recurse
-            return False
-
-        for b in self.blocklist:
-            if b.blockclass == 'function':
-                # do depth first search looking for a cycle
-                if _DFS([b]):
-                    error = True
+        self.loops = []
+        edges = self._function_graph()
+        for component in self.algebraic_loops():
+            if algebraic:
+                method = algebraic if isinstance(algebraic, str) else 'newton'
+                loop = AlgebraicLoop(component, edges, method=method, name=f"loop.{len(self.loops)}")
+                self.blocknames[loop.name] = loop
+                self.loops.append(loop)
+                if verbose:
+                    print(f"  algebraic loop through {', '.join([b.name for b in component])}, "
+                        f"torn at {', '.join([b.name for b in loop.torn])}")
+            else:
+                cycle = _cycle(component, edges.__getitem__)
+                print('  ERROR: cycle found: ', ' - '.join([str(x) for x in cycle + cycle[:1]]))
+                error = True
 
         if error:
             if not subsystem:
                 raise RuntimeError('could not compile system')
 
+        # discard the plans derived from a previous compilation, the plan is
+        # evaluated below as it is being compiled
+        self.cone = None
+        self.rest = None
+        self.held = []
+        self._plans = None
+        self._heldclocks = None
+        self._heldstate = None
+        self._parallel = None
+
         # create the execution plan/schedule
         self.execution_plan()
 
@@ -393,6 +606,11 @@ class BlockDiagram:
         for clock in self.clocklist:
             clock._x = clock.getstate0()
 
+        # tabulate the clock events over their hyperperiod
+        self.schedule = None if subsystem else ClockSchedule.build(self.clocklist)
+        if verbose and self.schedule is not None:
+            print(self.schedule)
+
         if report:
             self.report()
             self.plan_print()
@@ -414,9 +632,75 @@ class BlockDiagram:
                 raise RuntimeError('could not compile system')
         else:
             self.compiled = True
+
+        self.fused = []
+        self.optimized = None
+        if self.compiled and optimize and not subsystem:
+            self.optimized = _optimize.optimize(self, keep=keep, verbose=verbose or report)
+            self.fused = self.optimized.merged + self.optimized.fused
+
+        self.sparsity = None
+        if self.compiled and not subsystem:
+            self.derivative_cone()
+            self._hold_plan()
+            self.sparsity = self.jacobian_sparsity()
+
+        if self.compiled and parallel and not subsystem:
+            self._parallel_plan(parallel, x)
+
+        self.generated = None
+        if self.compiled and codegen and not subsystem:
+            self.generated = _codegen.bind(self)
+
+        self.jitted = None
+        self.jit_fallback = None
+        if self.compiled and jit and not subsystem:
+            try:
+                self.jitted = _jit.lower(self)
+            except _jit.Unsupported as err:
+                self.jit_fallback = str(err)
+                print(fg('red') + f"JIT not used, falling back to the interpreter: {err}" + attr(0))
         
         return self.compiled
 
+    parallel_overhead = 50e-6  # time to dispatch a block to a thread (s)
+
+    def _parallel_plan(self, workers, x, repeats=3):
+        # estimate the evaluation time of each block, and decide which plan
+        # groups are worth evaluating in the thread pool
+        if workers is True:
+            workers = os.cpu_count()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._workers = workers
+
+        self.evaluate_plan(x, 0.0)
+        for group in self.plan:
+            for b in group:
+                cost = math.inf
+                for i in range(repeats):
+                    t0 = time.perf_counter()
+                    self._evaluate_block(b, 0.0)
+                    cost = min(cost, time.perf_counter() - t0)
+                b._cost = cost
+
+        # a group is parallelised if the time saved, the cost of all but its
+        # most expensive block, exceeds the cost of dispatching its blocks
+        self._parallel = []
+        for group in self.plan:
+            costs = [b._cost for b in group]
+            self._parallel.append(len(group) > 1 and
+                sum(costs) - max(costs) > self.parallel_overhead * len(group))
+
+    def _pool(self):
+        # persistent thread pool, a process forked from this one has no
+        # threads so it needs its own pool
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._workers)
+            self._executor_pid = os.getpid()
+        return self._executor
+
     def _subsystem_import(self, bd, sspath):
         
         blocks = []
@@ -467,13 +751,15 @@ class BlockDiagram:
     
     # ---------------------------------------------------------------------- #
     
-    def evaluate_plan(self, x, t, checkfinite=True, debuglist=[], sinks=True):
+    def evaluate_plan(self, x, t, checkfinite=True, debuglist=[], sinks=True, cone=False):
         """
         Evaluate all blocks in the network
 
         :param x: state :type x: numpy.ndarray :param t: current time :type t:
         float :param checkfinite: check for Inf or Nan values in block outputs
-        :type checkfinite: bool :return: state derivative :rtype: numpy.ndarray
+        :type checkfinite: bool :param cone: only evaluate the blocks the
+        derivative depends on :type cone: bool :return: state derivative
+        :rtype: numpy.ndarray
 
         Performs the following steps:
 
@@ -482,7 +768,8 @@ class BlockDiagram:
            outputs are "sent" to their connected inputs.
 
         Sink blocks are not executed here, but after completion their inputs
-        will all be valid.
+        will all be valid.  If ``cone`` is True, that is only the case after
+        :meth:`evaluate_rest` has been called.
         """
 
         # TODO: don't copy outputs to inputs of next block, have inputs
@@ -498,76 +785,200 @@ class BlockDiagram:
         # reset all the blocks ready for the evalation
         self.reset()
         
-        # split the state vector to stateful blocks
-        for b in self.blocklist:
-            if b.blockclass == 'transfer':
-                x = b.setstate(x)
+        # give each stateful block a view of its slice of the state vector
+        if self.nstates > 0:
+            x = np.asarray(x)
+            for b in self.transferblocks:
+                b._x = x[b._xslice]
 
-        # split the discrete state vector to clocked blocks
-        for clock in self.clocklist:
-            clock.setstate()
+        # split the discrete state vector to clocked blocks, and evaluate the
+        # blocks held since the last clock tick
+        self.hold(t, checkfinite)
 
         self.runtime.DEBUG('propagate', 't={:.3f}', t)
 
-        for sequence, group in enumerate(self.plan):
+        if self._plans is None:
+            plan = self.plan  # being compiled
+        elif cone and self.cone is not None:
+            plan = self._plans[1]
+        else:
+            plan = self._plans[0]
+        for sequence, group in enumerate(plan):
 
             # self.runtime.DEBUG('propagate', '---- sequence = ', sequence)
 
+            if self._parallel is not None and self._parallel[sequence]:
+                # blocks in a group are independent, evaluate them in the
+                # thread pool and wait for all of them to complete
+                for _ in self._pool().map(lambda b: self._evaluate_block(b, t, checkfinite), group):
+                    pass
+            else:
+                for b in group:
+                    self._evaluate_block(b, t, checkfinite)
+
+        # gather the derivative
+        YD = self.deriv()
+
+        self.runtime.DEBUG('deriv', YD)
+        return YD
+
+    def evaluate_rest(self, t, checkfinite=True):
+        """
+        Evaluate the blocks outside the derivative cone
+
+        :param t: current time
+        :type t: float
+        :param checkfinite: check for Inf or Nan values in block outputs
+        :type checkfinite: bool
+
+        Completes an evaluation by :meth:`evaluate_plan` with ``cone=True``,
+        using the outputs it computed, after which the inputs of all sink
+        blocks are valid.
+
+        :seealso: :meth:`derivative_cone`
+        """
+        if self.rest is None:
+            return
+        for group in self._plans[2]:
             for b in group:
-                # ask the block for output, check for errors
-                try:
-                    out = b.output(t)
-                except Exception as err:
-                    # output method failed, report it
-                    print(fg('red'))
-                    print('--Error at t={:f} when computing output of [{:s}::{:s}]'.format(t, b.type, str(b)))
-                    print()
-                    # print('  {}'.format(err))
-                    traceback.print_exc(limit=-1, file=sys.stderr)
-
-                    print()
-                    for i, input in enumerate(b.inputs):
-                        print(f"Input[{i}] = {input}")
-
-                    if b.nstates > 0:
-                        print(f"Block state x = {b._x}")
-                    print(attr(0))
-                    raise RuntimeError from None
-
-                self.runtime.DEBUG('propagate', 'block {:s}: output = {}', b, out)
-
-                # check that output is a list of correct length
-                if not isinstance(out, (tuple, list)):
-                    raise AssertionError(f"block {b} output {b} must be a list: {type(out)}")
-                if len(out) != b.nout:
-                    raise AssertionError(f"block {b} output {b} has incorrect length: {len(out)} instead of {b.nout}")
-
-                # TODO check output validity once at the startq
+                self._evaluate_block(b, t, checkfinite)
+
+    def _evaluate_block(self, b, t, checkfinite=True):
+        # ask the block for output, check for errors
+        try:
+            out = b.output(t)
+        except Exception as err:
+            # output method failed, report it
+            print(fg('red'))
+            print('--Error at t={:f} when computing output of [{:s}::{:s}]'.format(t, b.type, str(b)))
+            print()
+            # print('  {}'.format(err))
+            traceback.print_exc(limit=-1, file=sys.stderr)
+
+            print()
+            for i, input in enumerate(b.inputs):
+                print(f"Input[{i}] = {input}")
+
+            if b.nstates > 0:
+                print(f"Block state x = {b._x}")
+            print(attr(0))
+            raise RuntimeError from None
+
+        self.runtime.DEBUG('propagate', 'block {:s}: output = {}', b, out)
+
+        # check that output is a list of correct length
+        if not isinstance(out, (tuple, list)):
+            raise AssertionError(f"block {b} output {b} must be a list: {type(out)}")
+        if len(out) != b.nout:
+            raise AssertionError(f"block {b} output {b} has incorrect length: {len(out)} instead of {b.nout}")
+
+        # TODO check output validity once at the startq
+        
+        # check it has no nan or inf values
+        if checkfinite and isinstance(out, (int, float, np.ndarray)) and not np.isfinite(out).any():
+            raise RuntimeError(f"block {b} output contains NaN")
+
+        # # send block outputs to all downstream connected blocks
+        # for (port, outwires) in enumerate(b.outports): # every port
+        #     value = out[port]
+        #     for w in outwires:     # every wire
                 
-                # check it has no nan or inf values
-                if checkfinite and isinstance(out, (int, float, np.ndarray)) and not np.isfinite(out).any():
-                    raise RuntimeError(f"block {b} output contains NaN")
-
-                # # send block outputs to all downstream connected blocks
-                # for (port, outwires) in enumerate(b.outports): # every port
-                #     value = out[port]
-                #     for w in outwires:     # every wire
-                        
-                #         self.DEBUG('propagate', '  [{}] = {} -->  {}[{}]', port, value, w.end.block.name, w.end.port)
+        #         self.DEBUG('propagate', '  [{}] = {} -->  {}[{}]', port, value, w.end.block.name, w.end.port)
 
-                #         # send value to wire
-                #         w.send(value)
+        #         # send value to wire
+        #         w.send(value)
 
-                #         # TODO send return status no longer needed
-                #         # TODO use common error handler in all cases above
+        #         # TODO send return status no longer needed
+        #         # TODO use common error handler in all cases above
+        b.output_values = out
+
+    def evaluate_batch(self, X, t):
+        """
+        Evaluate all blocks in the network for an ensemble
+
+        :param X: state vectors, one row per ensemble member
+        :type X: ndarray(N, nstates)
+        :param t: current time
+        :type t: float
+        :return: state derivatives, one row per ensemble member
+        :rtype: ndarray(N, nstates)
+
+        Batch counterpart of :meth:`evaluate_plan`.  Every signal has a
+        leading axis of length ``N``.  Blocks that support batch evaluation
+        compute all members in one call, other blocks are evaluated once per
+        member.
+
+        Sink blocks are not executed.
+
+        :seealso: :meth:`BDSim.run_ensemble`
+        """
+        N = X.shape[0]
+
+        # reset all the blocks ready for the evalation
+        self.reset()
+
+        # give each stateful block a view of its columns of the state array
+        for b in self.transferblocks:
+            b._x = X[:, b._xslice]
+
+        for group in self.plan:
+            for b in group:
+                try:
+                    if b._batched:
+                        out = b.output_batch(t, N)
+                    else:
+                        out = self._member_eval(b, lambda: b.output(t), X)
+                        out = [_stack([o[port] for o in out]) for port in range(b.nout)]
+                except:
+                    self._error_handler('output_batch', b)
+
+                if not isinstance(out, (tuple, list)) or len(out) != b.nout:
+                    raise AssertionError(f"block {b} output must be a list of length {b.nout}")
                 b.output_values = out
 
-        # gather the derivative
-        YD = self.deriv()
+        return self.deriv_batch(X)
 
-        self.runtime.DEBUG('deriv', YD)
+    def deriv_batch(self, X):
+        """
+        Harvest derivatives from all blocks for an ensemble
+
+        :param X: state vectors, one row per ensemble member
+        :type X: ndarray(N, nstates)
+        :return: state derivatives, one row per ensemble member
+        :rtype: ndarray(N, nstates)
+        """
+        N = X.shape[0]
+        YD = np.empty(X.shape)
+        for b in self.transferblocks:
+            try:
+                if b._batched:
+                    yd = b.deriv_batch(N)
+                else:
+                    yd = self._member_eval(b, b.deriv, X)
+                YD[:, b._xslice] = np.reshape(yd, (N, b.nstates))
+            except:
+                self._error_handler('deriv_batch', b)
         return YD
 
+    def _member_eval(self, b, method, X):
+        # evaluate a block that doesn't support batch evaluation, once per
+        # ensemble member, with that member's inputs, state and parameters
+        sources = b.sources
+        out = []
+        try:
+            for i in range(X.shape[0]):
+                b.sources = [_MemberPlug(plug, i) for plug in sources]
+                for name, values in b._memberparams.items():
+                    b._parameters[name](b, name, values[i])
+                if b.blockclass == 'transfer':
+                    b._x = X[i, b._xslice]
+                out.append(method())
+        finally:
+            b.sources = sources
+            if b.blockclass == 'transfer':
+                b._x = X[:, b._xslice]
+        return out
+
     def execution_plan(self):
         """
         Create execution plan
@@ -582,8 +993,8 @@ class BlockDiagram:
 
         .. note::
             - The plan is essentially a dataflow graph. 
-            - The blocks in list ``Li`` could potentially be executed in
-              parallel.
+            - The blocks in list ``Li`` are independent and can be executed
+              in parallel, see the ``parallel`` option of :meth:`compile`.
             - Constant blocks and stateful blocks are all executed in ``L0``
             - The block attribute ``_sequence`` is ``i`` and indicates its
               execution order
@@ -591,36 +1002,479 @@ class BlockDiagram:
         :seealso: :func:`plan_print`, :func:`plan_dotfile`
         """
 
-        plan = []
-        group = []
-        for b in self.blocklist:
-            b._sequence = None
-            if b.blockclass in ('source', 'transfer', 'clocked'):
-                b._sequence = 0
-                group.append(b)
-        plan.append(group)
-        sequence = len(plan)
-
-        while True:
-            group = []
-            for b in self.blocklist:
-                if b._sequence is not None:
-                    continue  # already has a sequence assigned
-                
-                if all([p._sequence < sequence if p._sequence is not None else False for p in b._parents]):
-                    group.append(b)
-
-            for b in group.copy():
-                b._sequence = sequence
-                if b.blockclass in ('sink', 'graphics'):
-                    group.remove(b)
-            if len(group) == 0:
-                break
-            plan.append(group)
-            sequence += 1
+        # Kahn's algorithm, a block is scheduled once all its parents have
+        # been, and its sequence is one more than that of its last parent.
+        # The blocks of an algebraic loop are scheduled as its evaluator
+        owner = {b: loop for loop in self.loops for b in loop.members}
+        units = list(dict.fromkeys([owner.get(b, b) for b in self.blocklist]))
+
+        children = {u: [] for u in units}
+        parents = {}
+        waiting = {}  # number of parents not yet scheduled
+        ready = deque()
+        for u in units:
+            u._sequence = None
+            if u.blockclass in ('source', 'transfer', 'clocked'):
+                u._sequence = 0
+                ready.append(u)
+            else:
+                if u in self.loops:
+                    parents[u] = [owner.get(p.block, p.block) for p in u.sources]
+                else:
+                    parents[u] = [owner.get(p, p) for p in u._parents]
+                waiting[u] = len(parents[u])
+                for p in parents[u]:
+                    if p is not None:
+                        children[p].append(u)
+                if waiting[u] == 0:
+                    u._sequence = 1
+                    ready.append(u)
+
+        while len(ready) > 0:
+            u = ready.popleft()
+            for c in children[u]:
+                if c._sequence == 0:
+                    continue
+                waiting[c] -= 1
+                if waiting[c] == 0:
+                    c._sequence = max([p._sequence for p in parents[c]]) + 1
+                    ready.append(c)
+        for loop in self.loops:
+            for b in loop.members:
+                b._sequence = loop._sequence
+
+        # the units in each group are in the order they were added, sinks
+        # are not in the plan
+        nsequence = max([u._sequence for u in units if u._sequence is not None], default=0) + 1
+        plan = [[] for i in range(nsequence)]
+        for u in units:
+            if u._sequence is not None and u.blockclass not in ('sink', 'graphics'):
+                plan[u._sequence].append(u)
+        while len(plan) > 1 and len(plan[-1]) == 0:
+            plan.pop()
 
         self.plan = plan
     
+    def algebraic_loops(self):
+        """
+        Find the algebraic loops
+
+        :return: algebraic loops
+        :rtype: list of lists of Block
+
+        An algebraic loop is a cycle of wires through function blocks, whose
+        outputs depend on their inputs at the same time.  Each loop is a
+        strongly connected component of the graph of function blocks, the
+        blocks that share a cycle, in the order they were added.
+
+        The components are found by Tarjan's algorithm, which takes time
+        proportional to the number of blocks and wires.
+
+        :seealso: :meth:`compile`
+        """
+        edges = self._function_graph()
+        order = {b: i for i, b in enumerate(edges)}
+        loops = []
+        for component in _strongly_connected(list(edges), edges.__getitem__):
+            if len(component) > 1 or component[0] in edges[component[0]]:
+                loops.append(sorted(component, key=order.__getitem__))
+        return loops
+
+    def _function_graph(self):
+        # the function blocks driven by each function block
+        edges = {b: [] for b in self.blocklist if b.blockclass == 'function'}
+        for w in self.wirelist:
+            if w.start.block in edges and w.end.block in edges:
+                edges[w.start.block].append(w.end.block)
+        return edges
+
+    def derivative_cone(self):
+        """
+        Find the blocks that the state derivative depends on
+
+        The plan is split into the attributes ``cone``, the blocks whose
+        outputs are needed to compute the derivative of the continuous state,
+        and ``rest``, the blocks that only feed sinks, clocked blocks or
+        nothing at all.  Both are lists of groups, parallel to ``plan``.  If
+        every block is in the cone, both attributes are None.
+
+        The integrator evaluates only the cone at each of its stages, see the
+        ``cone`` option of :meth:`evaluate_plan`, and :meth:`evaluate_rest`
+        is called once per accepted step, before the sinks are stepped.
+
+        :seealso: :func:`execution_plan`
+        """
+        owner = self._owners()
+
+        # search back from the inputs of the transfer blocks, stopping at
+        # clocked blocks whose output does not depend on their input
+        cone = set()
+        stack = [u for group in self.plan for u in group if u.blockclass == 'transfer']
+        while len(stack) > 0:
+            u = stack.pop()
+            if u in cone:
+                continue
+            cone.add(u)
+            if u.blockclass == 'clocked':
+                continue
+            for p in self._unit_sources(u):
+                if p.block in owner:
+                    stack.append(owner[p.block])
+
+        if all([u in cone for group in self.plan for u in group]):
+            return
+        self.cone = [[u for u in group if u in cone] for group in self.plan]
+        self.rest = [[u for u in group if u not in cone] for group in self.plan]
+
+    def jacobian_sparsity(self):
+        """
+        Find which states the state derivative depends on
+
+        :return: sparsity pattern of the Jacobian of the state derivative,
+            element ``[i,j]`` is nonzero if the derivative of state ``i``
+            may depend on state ``j``
+        :rtype: scipy.sparse.csc_matrix(nstates, nstates)
+
+        The pattern follows from the wiring.  The output of a transfer block
+        depends only on its own state, the output of a function block on
+        its inputs, and the outputs of source and clocked blocks on no
+        continuous state.  The derivative of a transfer block depends on its
+        own state and on its inputs.
+
+        It is given to the ``BDF`` and ``Radau`` solvers, as their
+        ``jac_sparsity`` argument, so that they estimate the Jacobian by
+        finite differences over groups of states that do not share a
+        derivative, with one evaluation of the plan per group rather than
+        per state.
+        """
+        owner = self._owners()
+        deps = {}  # transfer units that the outputs of a unit depend on
+
+        def inputs(u):
+            d = set()
+            for p in self._unit_sources(u):
+                d |= deps.get(owner.get(p.block), set())
+            return d
+
+        for group in self.plan:
+            for u in group:
+                if u.blockclass == 'transfer':
+                    # a fused evaluator may feed its inputs through
+                    deps[u] = {u} | inputs(u) if any(getattr(u, 'feedthrough', [])) else {u}
+                elif u.blockclass == 'function':
+                    deps[u] = inputs(u)
+
+        rows = []
+        cols = []
+        for u in self.transferblocks:
+            i = np.arange(u._xslice.start, u._xslice.stop)
+            j = np.concatenate([np.arange(v._xslice.start, v._xslice.stop)
+                for v in sorted({u} | inputs(u), key=lambda v: v._xslice.start)])
+            rows.append(np.repeat(i, len(j)))
+            cols.append(np.tile(j, len(i)))
+        if len(rows) == 0:
+            rows = cols = [np.zeros((0,), dtype=int)]
+        rows = np.concatenate(rows)
+        return scipy.sparse.csc_matrix((np.ones(rows.shape, dtype=bool), (rows, np.concatenate(cols))),
+            shape=(self.nstates, self.nstates))
+
+    def jacobian(self, x, t=0.0):
+        """
+        Compute the Jacobian of the state derivative
+
+        :param x: continuous state
+        :type x: array_like(nstates)
+        :param t: current time, defaults to 0.0
+        :type t: float, optional
+        :return: Jacobian, element ``[i,j]`` is the partial derivative of
+            the derivative of state ``i`` with respect to state ``j``
+        :rtype: scipy.sparse.csc_matrix(nstates, nstates)
+
+        The plan is evaluated once, at ``x`` and ``t``, and then the partial
+        derivatives of each block, see :meth:`Block.jacobian`, are combined
+        by the chain rule in plan order, giving the derivative of each signal
+        with respect to the state, and finally of the state derivative.
+        Signals from source, clocked and held blocks do not depend on the
+        continuous state.
+
+        Blocks that do not know their partial derivatives in closed form are
+        differentiated by forward differences of that block alone, perturbing
+        each element of its inputs and state in turn, which requires their
+        signals to be numeric.  The evaluators created by the optimizer give
+        their own matrices, and for an algebraic loop the linearized loop
+        equations are solved for the derivatives of its tear variables.
+
+        It is given to implicit solvers by ``BDSim.run(jacobian=True)``,
+        which then do not estimate the Jacobian by evaluating the whole
+        block diagram for each perturbed state.
+
+        :seealso: :meth:`jacobian_sparsity`
+        """
+        n = self.nstates
+        x = np.array(x, dtype=float)
+        self.evaluate_plan(x, t, cone=True)
+
+        dy = {}  # derivative of each output port with respect to the state
+
+        def signals(plugs):
+            return _vstack([dy.get((p.block, p.port),
+                scipy.sparse.csr_matrix((np.size(p.block.output_values[p.port]), n))) for p in plugs], n)
+
+        def states(u):
+            if u.nstates == 0:
+                return scipy.sparse.csr_matrix((0, n))
+            i = np.arange(u._xslice.start, u._xslice.stop)
+            return scipy.sparse.csr_matrix((np.ones(i.shape), (np.arange(len(i)), i)), shape=(len(i), n))
+
+        plan = self._plans[1] if self.cone is not None else self._plans[0]
+        partials = {}
+        for group in plan:
+            for u in group:
+                if isinstance(u, AlgebraicLoop):
+                    self._loop_jacobian(u, dy, t)
+                elif u.blockclass in ('function', 'transfer'):
+                    inputs, outputs = self._unit_ports(u)
+                    A, B, C, D = partials[u] = self._block_jacobian(u, t, inputs, outputs)
+                    Y = (C @ states(u) + D @ signals(inputs)).tocsr()
+                    for b, port, rows in outputs:
+                        dy[b, port] = Y[rows]
+
+        rows = []
+        for u in sorted(self.transferblocks, key=lambda u: u._xslice.start):
+            A, B, C, D = partials[u]
+            rows.append(A @ states(u) + B @ signals(self._unit_ports(u)[0]))
+        return _vstack(rows, n).tocsc()
+
+    @staticmethod
+    def _unit_ports(u):
+        # the plugs whose values a plan unit reads, in the order of its
+        # input vector, and the output ports it computes, with their rows in
+        # its output vector
+        if hasattr(u, 'external'):
+            inputs = [p for p, _, _ in sorted(u.external, key=lambda e: e[1])]
+            outputs = [(b, port, slice(start, start + 1 if stop is None else stop))
+                for b, port, start, stop in u.internal]
+            return inputs, outputs
+        outputs = []
+        start = 0
+        for port, value in enumerate(u.output_values):
+            outputs.append((u, port, slice(start, start + np.size(value))))
+            start += np.size(value)
+        return [p for p in u.sources if p is not None], outputs
+
+    def _block_jacobian(self, b, t, inputs, outputs):
+        # partial derivatives of a block, or evaluator, as sparse matrices
+        # over its flattened inputs and outputs
+        partials = b.jacobian(t)
+        if partials is None:
+            partials = self._difference_jacobian(b, t)
+        nx = b.nstates
+        nu = sum([np.size(p.block.output_values[p.port]) for p in inputs])
+        ny = max([rows.stop for _, _, rows in outputs], default=0)
+        shapes = ((nx, nx), (nx, nu), (ny, nx), (ny, nu))
+        return [scipy.sparse.csr_matrix(shape) if M is None else
+            scipy.sparse.csr_matrix(np.reshape(np.asarray(M, dtype=float), shape))
+            for M, shape in zip(partials, shapes)]
+
+    def _difference_jacobian(self, b, t):
+        # partial derivatives of a block by forward differences, its inputs
+        # are bound to perturbed values and its state replaced, then both
+        # are restored
+        inputs = list(b.inputs)
+        bound = b._inputs
+        x0 = b._x if b.nstates > 0 else None
+        transfer = b.blockclass == 'transfer'
+
+        def evaluate():
+            y = _flatten(b.output(t))
+            return y, _flatten([b.deriv()]) if transfer else None
+
+        def step(v):
+            return np.sqrt(np.finfo(float).eps) * max(1.0, abs(v))
+
+        try:
+            try:
+                u0 = _flatten(inputs)
+                y0, xd0 = evaluate()
+            except (TypeError, ValueError):
+                raise TypeError(f"block {b.name} has signals that are not numeric, "
+                    "its Jacobian cannot be estimated") from None
+            nx = b.nstates
+            A = np.zeros((nx, nx))
+            B = np.zeros((nx, u0.shape[0]))
+            C = np.zeros((y0.shape[0], nx))
+            D = np.zeros((y0.shape[0], u0.shape[0]))
+
+            for j in range(u0.shape[0]):
+                h = step(u0[j])
+                uh = u0.copy()
+                uh[j] += h
+                b._inputs = _unflatten(uh, inputs)
+                y, xd = evaluate()
+                D[:, j] = (y - y0) / h
+                if transfer:
+                    B[:, j] = (xd - xd0) / h
+            b._inputs = bound
+
+            for j in range(nx):
+                xh = np.array(x0, dtype=float).reshape((-1,))
+                h = step(xh[j])
+                xh[j] += h
+                b._x = xh.reshape(np.shape(x0))
+                y, xd = evaluate()
+                C[:, j] = (y - y0) / h
+                if transfer:
+                    A[:, j] = (xd - xd0) / h
+        finally:
+            b._inputs = bound
+            if x0 is not None:
+                b._x = x0
+        return A, B, C, D
+
+    def _loop_jacobian(self, loop, dy, t):
+        # the outputs of the blocks of an algebraic loop are linearized as
+        # P + Q dz, where dz is the derivative of the tear variables with
+        # respect to the state, which follows from the loop equation z = g(z)
+        n = self.nstates
+        members = set(loop.members)
+        torn = [(b, port) for b in loop.torn for port in range(b.nout)]
+        nz = sum([np.size(b.output_values[port]) for b, port in torn])
+        P = {}
+        Q = {}
+        i = 0
+        for b, port in torn:
+            w = np.size(b.output_values[port])
+            P[b, port] = scipy.sparse.csr_matrix((w, n))
+            Q[b, port] = np.eye(nz)[i:i + w]
+            i += w
+
+        def linearize(b):
+            inputs, outputs = self._unit_ports(b)
+            Pu = []
+            Qu = []
+            for p in inputs:
+                if p.block in members:
+                    Pu.append(P[p.block, p.port])
+                    Qu.append(Q[p.block, p.port])
+                else:
+                    w = np.size(p.block.output_values[p.port])
+                    Pu.append(dy.get((p.block, p.port), scipy.sparse.csr_matrix((w, n))))
+                    Qu.append(np.zeros((w, nz)))
+            D = self._block_jacobian(b, t, inputs, outputs)[3]
+            return (D @ _vstack(Pu, n)).tocsr(), D @ np.vstack(Qu + [np.zeros((0, nz))]), outputs
+
+        for b in loop.order:
+            Pb, Qb, outputs = linearize(b)
+            for _, port, rows in outputs:
+                P[b, port] = Pb[rows]
+                Q[b, port] = Qb[rows]
+
+        G = [linearize(b) for b in loop.torn]
+        GP = _vstack([g[0] for g in G], n)
+        GQ = np.vstack([g[1] for g in G])
+        Z = scipy.sparse.csr_matrix(np.linalg.solve(np.eye(nz) - GQ, GP.toarray()))
+
+        i = 0
+        for b, port in torn:
+            w = np.size(b.output_values[port])
+            dy[b, port] = Z[i:i + w]
+            i += w
+        for b in loop.order:
+            for port in range(b.nout):
+                dy[b, port] = (P[b, port] + scipy.sparse.csr_matrix(Q[b, port]) @ Z).tocsr()
+
+    def _owners(self):
+        # each block is evaluated by a unit of the plan, itself or an
+        # evaluator created by the optimizer
+        owner = {}
+        for group in self.plan:
+            for u in group:
+                owner[u] = u
+                for b in getattr(u, 'blocks', []):
+                    owner[b] = u
+        return owner
+
+    @staticmethod
+    def _unit_sources(u):
+        # the plugs whose values a plan unit reads
+        if hasattr(u, 'external'):
+            return [p for p, _, _ in u.external]
+        return [p for p in u.sources if p is not None]
+
+    def _hold_plan(self):
+        # find the blocks whose outputs only change when a clock ticks, the
+        # clocked blocks and pure function blocks computed only from held or
+        # constant values, and the clocks that each depends on
+        owner = self._owners()
+        folded = self.optimized.folded if self.optimized is not None else []
+        clocks = {}
+        for group in self.plan:
+            for u in group:
+                if u.blockclass == 'clocked':
+                    clocks[u] = {u.clock}
+                elif type(u).__name__ == 'Constant' and u.nin == 0:
+                    clocks[u] = set()
+                elif u.blockclass == 'function' and u.pure and len(self._unit_sources(u)) > 0:
+                    deps = set()
+                    for p in self._unit_sources(u):
+                        if p.block in folded:
+                            continue
+                        if owner.get(p.block) not in clocks:
+                            break
+                        deps |= clocks[owner[p.block]]
+                    else:
+                        clocks[u] = deps
+
+        self.held = [u for group in self.plan for u in group if u in clocks]
+        self._heldclocks = clocks
+
+        def without(plan):
+            if plan is None:
+                return None
+            return [[u for u in group if u not in clocks] for group in plan]
+
+        self._plans = (without(self.plan), without(self.cone), without(self.rest))
+        self._heldstate = None
+
+    def hold(self, t, checkfinite=True):
+        """
+        Evaluate the held blocks whose clock has ticked
+
+        :param t: current time
+        :type t: float
+        :param checkfinite: check for Inf or Nan values in block outputs
+        :type checkfinite: bool
+
+        The outputs of clocked blocks only change when their clock ticks, and
+        are held in between, as are the outputs of function blocks computed
+        only from them and from constants, see the attribute ``held``, if the
+        block declares that it is pure by its ``pure`` attribute.  These
+        blocks are evaluated by this method, which is called by
+        :meth:`evaluate_plan`, only when the state of a clock they depend on
+        has changed since their last evaluation, or after :meth:`start`.
+        """
+        if self._heldclocks is None:
+            # being compiled, evaluate everything
+            for clock in self.clocklist:
+                clock.setstate()
+            return
+
+        first = self._heldstate is None
+        if first:
+            self._heldstate = {}
+        ticked = set()
+        for clock in self.clocklist:
+            if first or self._heldstate.get(clock) is not clock._x:
+                # split the discrete state vector to clocked blocks
+                clock.setstate()
+                self._heldstate[clock] = clock._x
+                ticked.add(clock)
+
+        if first or len(ticked) > 0:
+            for b in self.held:
+                if first or not ticked.isdisjoint(self._heldclocks[b]):
+                    self._evaluate_block(b, t, checkfinite)
+
     def plan_print(self):
         """
         Display execution plan in tabular form
@@ -895,13 +1749,19 @@ class BlockDiagram:
         raise RuntimeError('Fatal failure') from None
 
     def getstate0(self):
-        # get the state from each stateful block
-        x0 = np.array([])
-        for b in self.blocklist:
+        """
+        Get the initial state vector
+
+        :return: initial state vector
+        :rtype: ndarray(nstates)
+
+        The initial state of each transfer block is written into its slice
+        of the preallocated state vector.
+        """
+        x0 = self._x0
+        for b in self.transferblocks:
             try:
-                if b.blockclass == 'transfer':
-                    x0 = np.r_[x0, b.getstate0()]
-                #print('x0', x0)
+                x0[b._xslice] = b.getstate0()
             except:
                 self._error_handler('getstate0', b)
         return x0
@@ -952,20 +1812,28 @@ class BlockDiagram:
 
     def deriv(self):
         """
-        Harvest derivatives from all blocks .
+        Harvest derivatives from all blocks
+
+        :return: state derivative vector
+        :rtype: ndarray(nstates)
+
+        The derivative of each transfer block is written into its slice of
+        the preallocated derivative vector, which is returned.
+
+        .. note:: The same array is returned by every call, copy it if the
+            value needs to be retained.
         """
-        YD = np.array([])
-        for b in self.blocklist:
-            if b.blockclass == 'transfer':
-                try:
-                    yd = b.deriv().flatten()
-                    if not isinstance(yd, np.ndarray):
-                        raise AssertionError(f"deriv: block {b} did not return ndarray")
-                    if yd.ndim != 1 or yd.shape[0] != b.nstates:
-                        raise AssertionError(f"deriv: block {b} returns wrong shape {yd.shape}, should be ({b.nstates},)")
-                    YD = np.r_[YD, yd]
-                except:
-                    self._error_handler('deriv', b)                    
+        YD = self._xd
+        for b in self.transferblocks:
+            try:
+                yd = b.deriv()
+                if not isinstance(yd, np.ndarray):
+                    raise AssertionError(f"deriv: block {b} did not return ndarray")
+                if yd.size != b.nstates:
+                    raise AssertionError(f"deriv: block {b} returns wrong shape {yd.shape}, should be ({b.nstates},)")
+                YD[b._xslice] = yd.reshape((-1,))
+            except:
+                self._error_handler('deriv', b)                    
         return YD
 
     def start(self, graphics=False, state=None, **kwargs):
@@ -985,6 +1853,13 @@ class BlockDiagram:
 
         """
         
+        # block parameters may have changed, so recompute the held outputs
+        self._heldstate = None
+
+        # algebraic loops are solved from zero again
+        for loop in self.loops:
+            loop.start(state=state)
+
         for c in self.clocklist:
             try:
                 c.start(state=state, **kwargs)
@@ -998,6 +1873,8 @@ class BlockDiagram:
             # print('starting block', b)
             try:
                 b.start(state=state, **kwargs)
+                if isinstance(b, EventSource) and state is not None:
+                    state.declare_events(b, b.events())
             except:
                 self._error_handler('block.start', b)
                 
@@ -153,6 +153,7 @@ class Mux(FunctionBlock):
 
     nin = -1
     nout = 1
+    pure = True
 
     def __init__(self, nin=1, **blockargs):
         """
@@ -187,6 +188,10 @@ class Mux(FunctionBlock):
                 out.extend(input.flatten().tolist())
         return [ np.array(out) ]
 
+    def jacobian(self, t=None):
+        n = sum([np.size(input) for input in self.inputs])
+        return None, None, None, np.eye(n)
+
 # ------------------------------------------------------------------------ #
 class DeMux(FunctionBlock):
     """
@@ -207,6 +212,7 @@ class DeMux(FunctionBlock):
 
     nin = 1
     nout = -1
+    pure = True
 
     def __init__(self, nout=1, **blockargs):
         """
@@ -231,6 +237,9 @@ class DeMux(FunctionBlock):
         assert len(self.inputs[0]) == self.nout, 'Input width not equal to number of output ports'
         return list(self.inputs[0])
 
+    def jacobian(self, t=None):
+        return None, None, None, np.eye(self.nout)
+
 # ------------------------------------------------------------------------ #
 
 class Index(FunctionBlock):
@@ -251,6 +260,7 @@ class Index(FunctionBlock):
 
     nin = 1
     nout = 1
+    pure = True
 
     def __init__(self, index=[], **blockargs):
         """
@@ -15,7 +15,7 @@ import math
 import inspect
 import spatialmath.base as smb
 
-from bdsim.components import FunctionBlock
+from bdsim.components import FunctionBlock, batch_align
 
 
 # PID
@@ -44,6 +44,9 @@ class Sum(FunctionBlock):
     
     nin = -1
     nout = 1
+    pure = True
+
+    batch = True
 
     _modefuncs = {
             'r': lambda x: x,
@@ -139,6 +142,47 @@ class Sum(FunctionBlock):
 
         return [sum]
 
+    def jacobian(self, t=None):
+        if self.mode is not None:
+            return None
+        n = max([np.size(input) for input in self.inputs])
+        D = []
+        for input, sign in zip(self.inputs, self.signs):
+            s = -1.0 if sign == '-' else 1.0
+            if np.size(input) == n:
+                D.append(s * np.eye(n))
+            elif np.size(input) == 1:
+                # broadcast scalar
+                D.append(s * np.ones((n, 1)))
+            else:
+                return None
+        return None, None, None, np.hstack(D)
+
+    def output_batch(self, t, N):
+        for i, input in enumerate(batch_align(*self.inputs)):
+            if self.signs[i] == '-':
+                if i == 0:
+                    sum = -input
+                else:
+                    sum = sum - input
+            else:
+                if i == 0:
+                    sum = input
+                else:
+                    sum = sum + input
+
+        if self.mode is not None:
+            if sum.ndim == 1:
+                sum = self._modefuncs[self.mode[0]](sum)
+            elif sum.ndim == 2:
+                if len(self.mode) != sum.shape[1]:
+                    raise ValueError('length of mode string doesnt match')
+                sum = np.column_stack([self._modefuncs[m](x) for (m, x) in zip(self.mode, sum.T)])
+            else:
+                raise ValueError('expecting scalar or 1D array')
+
+        return [sum]
+
 # ------------------------------------------------------------------------ #
 class Prod(FunctionBlock):
     """
@@ -160,6 +204,7 @@ class Prod(FunctionBlock):
     
     nin = -1
     nout = 1
+    pure = True
 
     def __init__(self, ops='**', matrix=False, **blockargs):
         """
@@ -244,6 +289,10 @@ class Gain(FunctionBlock):
 
     nin = 1
     nout = 1
+    pure = True
+
+    batch = True
+    batchparams = ('K',)
 
     def __init__(self, K=1, premul=False, **blockargs):
         """
@@ -290,6 +339,55 @@ class Gain(FunctionBlock):
                 return [input @ self.K]
         else:
             return [self.inputs[0] * self.K]
+
+    def jacobian(self, t=None):
+        input = self.inputs[0]
+        K = self.K
+        if isinstance(K, np.ndarray) and K.ndim == 0:
+            K = float(K)
+
+        if isinstance(input, np.ndarray) and isinstance(K, np.ndarray):
+            # array x array case
+            if input.ndim != 1:
+                return None
+            if K.ndim == 1:
+                D = K.reshape((1, -1))
+            elif self.premul:
+                D = K
+            else:
+                D = K.T
+        elif isinstance(K, np.ndarray):
+            # scalar input, array gain
+            D = K.reshape((-1, 1))
+        else:
+            D = K * np.eye(np.size(input))
+        return None, None, None, D
+
+    def output_batch(self, t, N):
+        input = np.asarray(self.inputs[0])
+        K = self.K
+        if 'K' in self._memberparams:
+            if K.ndim == 1:
+                # a scalar gain per member
+                input, K = batch_align(input, K)
+                return [input * K]
+            # a matrix gain per member, vector input
+            elif self.premul:
+                return [np.einsum('nij,nj->ni', K, input)]
+            else:
+                return [np.einsum('ni,nij->nj', input, K)]
+        elif isinstance(K, np.ndarray) and input.ndim > 1:
+            # array x array case
+            if self.premul:
+                # premultiply by gain
+                if input.ndim == 2:
+                    return [input @ K.T]
+                return [K @ input]
+            else:
+                # postmultiply by gain
+                return [input @ K]
+        else:
+            return [input.reshape(input.shape + (1,) * np.ndim(K)) * K]
         
 # ------------------------------------------------------------------------ #
 
@@ -313,6 +411,7 @@ class Clip(FunctionBlock):
 
     nin = 1
     nout = 1
+    pure = True
 
     def __init__(self, min=-math.inf, max=math.inf, **blockargs):
         """
@@ -328,6 +427,8 @@ class Clip(FunctionBlock):
         :rtype: Clip instance
         
         The input signal is clipped to the range from ``minimum`` to ``maximum`` inclusive.
+        The times at which the input reaches a limit are located by
+        zero-crossing detection, see :meth:`Block.guard`.
         
         The signal can be a 1D-array in which case each element is clipped.  The
         minimum and maximum values can be:
@@ -348,12 +449,38 @@ class Clip(FunctionBlock):
         
     def output(self, t=None):
         input = self.inputs[0]
-        
-        if isinstance(input, np.ndarray):
+
+        if self._sides is not None:
+            # limits reached at the zero crossings of the guards
+            out = np.array(input, dtype=float)
+            flat = out.reshape(-1)
+            sides = self._sides
+            for limit, side in ((self.min, -1), (self.max, 1)):
+                if np.any(np.isfinite(limit)):
+                    n = flat.shape[0]
+                    clipped = sides[:n] == side
+                    flat[clipped] = np.broadcast_to(limit, out.shape).reshape(-1)[clipped]
+                    sides = sides[n:]
+            if not isinstance(input, np.ndarray):
+                out = float(out)
+        elif isinstance(input, np.ndarray):
             out = np.clip(input, self.min, self.max)
         else:
             out = min(self.max, max(input, self.min))
         return [ out ]
+
+    def jacobian(self, t=None):
+        # unity gain for the elements not clipped
+        within = np.ravel(self.output(t)[0]) == np.ravel(self.inputs[0])
+        return None, None, None, np.diag(within.astype(float))
+
+    def guard(self, t=None):
+        # the input reaching either limit
+        limits = [limit for limit in (self.min, self.max) if np.any(np.isfinite(limit))]
+        if len(limits) == 0:
+            return None
+        input = np.array(self.inputs[0], dtype=float)
+        return np.concatenate([np.ravel(input - limit) for limit in limits])
 # ------------------------------------------------------------------------ #
 
 # TODO can have multiple outputs: pass in a tuple of functions, return a tuple
@@ -377,7 +504,7 @@ class Function(FunctionBlock):
     nin = -1
     nout = -1
 
-    def __init__(self, func=None, nin=1, nout=1, persistent=False, fargs=None, fkwargs=None, **blockargs):
+    def __init__(self, func=None, nin=1, nout=1, persistent=False, fargs=None, fkwargs=None, vectorized=False, guard=None, jacobian=None, pure=False, **blockargs):
     
         """
         Python function.
@@ -394,6 +521,14 @@ class Function(FunctionBlock):
         :type fargs: list, optional
         :param fkwargs: extra keyword arguments passed to the function, defaults to {}
         :type fkwargs: dict, optional
+        :param vectorized: function can evaluate all members of an ensemble, defaults to False
+        :type vectorized: bool, optional
+        :param guard: zero-crossing function of the inputs, defaults to None
+        :type guard: callable, optional
+        :param jacobian: partial derivatives of the output with respect to the inputs, defaults to None
+        :type jacobian: callable, optional
+        :param pure: the function depends only on its arguments, defaults to False
+        :type pure: bool, optional
         :param blockargs: |BlockOptions|
         :type blockargs: dict, optional
         :return: A FUNCTION block
@@ -456,6 +591,30 @@ class Function(FunctionBlock):
             func = bd.FUNCTION(myfun, args)
             bd.connect(block1, func[0])
             bd.connect(block2, func[1])
+
+        If the function is discontinuous, ``guard`` is a function with the
+        same arguments as ``func`` which returns a float or array whose sign
+        changes at the discontinuities, for example::
+
+            FUNCTION(lambda u: 1 if u > 0 else -1, guard=lambda u: u)
+
+        and the simulator locates the times of the discontinuities, see
+        :meth:`Block.guard`.
+
+        If the partial derivatives are known, ``jacobian`` is a function with
+        the same arguments as ``func`` which returns them as an array with a
+        row for each element of the outputs and a column for each element of
+        the inputs, for example::
+
+            FUNCTION(lambda u: np.sin(u), jacobian=lambda u: np.diag(np.cos(u)))
+
+        otherwise they are estimated by finite differences, see
+        :meth:`BlockDiagram.jacobian`.
+
+        If ``pure`` is True the function must not depend on time, on its
+        previous calls or on any value other than its arguments.  Its output
+        is then held between the ticks of the clocks that its inputs depend
+        on, see :meth:`BlockDiagram.hold`.
         """
         if func is None:
             raise ValueError('function is not defined')
@@ -503,6 +662,10 @@ class Function(FunctionBlock):
             self.userdata = None
         self.args = fargs
         self.kwargs = fkwargs
+        self.batch = vectorized
+        self.guardfunc = guard
+        self.jacobianfunc = jacobian
+        self.pure = pure
 
     def start(self, state=None):
         super().start()
@@ -536,6 +699,21 @@ class Function(FunctionBlock):
                 out.append(val)
             return out
 
+    def output_batch(self, t, N):
+        # a vectorized function takes and returns values with a leading
+        # member axis
+        return self.output(t)
+
+    def guard(self, t=None):
+        if self.guardfunc is None:
+            return None
+        return np.ravel(self.guardfunc(*self.inputs, *self.args, **self.kwargs)).astype(float)
+
+    def jacobian(self, t=None):
+        if self.jacobianfunc is None:
+            return None
+        return None, None, None, np.array(self.jacobianfunc(*self.inputs, *self.args, **self.kwargs), dtype=float)
+
 # ------------------------------------------------------------------------ #
 
 class Interpolate(FunctionBlock):
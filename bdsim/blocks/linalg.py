@@ -33,6 +33,7 @@ class Inverse(FunctionBlock):
 
     nin = 1
     nout = 2
+    pure = True
 
     onames = ('inv', 'cond')
 
@@ -104,6 +105,7 @@ class Transpose(FunctionBlock):
 
     nin = 1
     nout = 1
+    pure = True
 
     def __init__(self, **blockargs):
         """
@@ -158,6 +160,7 @@ class Norm(FunctionBlock):
 
     nin = 1
     nout = 1
+    pure = True
 
     def __init__(self, ord=None, axis=None, **blockargs):
         """
@@ -205,6 +208,7 @@ class Flatten(FunctionBlock):
 
     nin = 1
     nout = 1
+    pure = True
 
     def __init__(self, order='C', **blockargs):
         """
@@ -250,6 +254,7 @@ class Slice2(FunctionBlock):
 
     nin = 1
     nout = 1
+    pure = True
 
     def __init__(self, rows=None, cols=None, **blockargs):
         """
@@ -347,6 +352,7 @@ class Slice1(FunctionBlock):
 
     nin = 1
     nout = 1
+    pure = True
 
     def __init__(self, index, **blockargs):
         """
@@ -425,6 +431,7 @@ class Det(FunctionBlock):
 
     nin = 1
     nout = 1
+    pure = True
 
     def __init__(self, **blockargs):
         """
@@ -465,6 +472,7 @@ class Cond(FunctionBlock):
 
     nin = 1
     nout = 1
+    pure = True
 
     def __init__(self, **blockargs):
         """
@@ -150,6 +150,9 @@ class Stop(SinkBlock):
 
         If ``func`` is provided, then it is applied to the block input
         and if it returns True the simulation is stopped.
+
+        The time at which the condition becomes true is located by
+        zero-crossing detection, see :meth:`Block.guard`.
         """
         super().__init__(**blockargs)
 
@@ -176,6 +179,15 @@ class Stop(SinkBlock):
         if stop:
             state.stop = self
 
+    def guard(self, t=None):
+        # the stop condition becoming true
+        value = self.inputs[0]
+        if self.stopfunc is not None:
+            value = self.stopfunc(value)
+        if isinstance(value, (bool, np.bool_)):
+            return np.r_[1.0 if value else -1.0]
+        return np.ravel(value).astype(float)
+
 # ------------------------------------------------------------------------ #
 
 class Null(SinkBlock):
@@ -235,10 +247,12 @@ class Watch(SinkBlock):
     nin = 1
     nout = 0
 
-    def __init__(self, **blockargs):
+    def __init__(self, policy=None, **blockargs):
         """
         Watch a signal.
 
+        :param policy: recording policy, defaults to that of ``bdsim.run``
+        :type policy: Policy, optional
         :param blockargs: |BlockOptions|
         :type blockargs: dict
         :return: A NULL block
@@ -248,18 +262,25 @@ class Watch(SinkBlock):
         simulation run.  Equivalent to adding it as the ``watch=`` argument
         to ``bdsim.run``.
 
-        :seealso: :method:`BDSim.run`
+        The ``policy`` selects which values are recorded, for example::
+
+            bd.WATCH(policy=Policy(every=10, last=1000))
+
+        :seealso: :method:`BDSim.run` :class:`~bdsim.recording.Policy`
         """
         super().__init__(**blockargs)
+        self.policy = policy
 
     def start(self, state=None):
         # called at start of simulation, add this block to the watchlist
         plug = self.sources[0]  # start plug for input wire
 
         # append to the watchlist, bdsim.run() will do the rest
+        if self.policy is not None:
+            state.watchpolicies[len(state.watchlist)] = self.policy
         state.watchlist.append(plug)
         state.watchnamelist.append(str(plug))
-        
+
 
 if __name__ == "__main__":  # pragma: no cover
 
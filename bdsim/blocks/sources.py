@@ -32,6 +32,9 @@ class Constant(SourceBlock):
     nin = 0
     nout = 1
 
+    batch = True
+    batchparams = ('value',)
+
     def __init__(self, value=0, **blockargs):
         """
         Constant value.
@@ -57,6 +60,12 @@ class Constant(SourceBlock):
     def output(self, t=None):
         return [self.value]               
 
+    def output_batch(self, t, N):
+        if 'value' in self._memberparams:
+            return [self.value]
+        value = np.asarray(self.value)
+        return [np.broadcast_to(value, (N,) + value.shape)]
+
 # ------------------------------------------------------------------------ #
 
 class Time(SourceBlock):
@@ -115,6 +124,8 @@ class WaveForm(SourceBlock, EventSource):
     nin = 0
     nout = 1
 
+    batch = True
+
     def __init__(self, wave='square',
                  freq=1, unit='Hz', phase=0, amplitude=1, offset=0,
                  min=None, max=None, duty=0.5,
@@ -205,7 +216,7 @@ class WaveForm(SourceBlock, EventSource):
         self.amplitude = amplitude
         self.offset = offset
 
-    def start(self, state=None):
+    def events(self):
         if self.wave == 'square':
             t1 = self.phase / self.freq
             t2 = (self.duty + self.phase) / self.freq
@@ -215,11 +226,11 @@ class WaveForm(SourceBlock, EventSource):
         else:
             return
 
-        # t1 < t2
+        # t1 < t2, generate the discontinuities one period at a time
         T = 1.0 / self.freq
-        while t1 < self.bd.simstate.T:
-            self.bd.simstate.declare_event(self, t1)
-            self.bd.simstate.declare_event(self, t2)
+        while True:
+            yield t1
+            yield t2
             t1 += T
             t2 += T
 
@@ -250,6 +261,10 @@ class WaveForm(SourceBlock, EventSource):
         #print('waveform = ', out)
         return [out]
 
+    def output_batch(self, t, N):
+        # the waveform is the same for all members
+        return [np.full((N,), self.output(t)[0])]
+
 # ------------------------------------------------------------------------ #
 
 class Piecewise(SourceBlock, EventSource):
@@ -301,9 +316,8 @@ class Piecewise(SourceBlock, EventSource):
         self.t = [x[0] for x in seq]
         self.y = [x[1] for x in seq]
 
-    def start(self, state=None):
-        for t in self.t:
-            state.declare_event(self, t)
+    def events(self):
+        return iter(self.t)
 
     def output(self, t):
         i = sum([ 1 if t >= _t else 0  for _t in self.t]) - 1
@@ -362,8 +376,8 @@ class Step(SourceBlock, EventSource):
         self.off = off
         self.on = on
 
-    def start(self, state=None):
-        state.declare_event(self, self.T)
+    def events(self):
+        yield self.T
 
     def output(self, t=None):
         if t >= self.T:
@@ -426,8 +440,8 @@ class Ramp(SourceBlock, EventSource):
         self.off = off
         self.slope = slope
 
-    def start(self, state=None):
-        state.declare_event(self, self.T)
+    def events(self):
+        yield self.T
 
     def output(self, t=None):
         if t >= self.T:
@@ -37,6 +37,8 @@ class Integrator(TransferBlock):
     nin = 1
     nout = 1
 
+    batch = True
+
     def __init__(self, x0=0, gain=1.0, min=None, max=None, **blockargs):
         """
         Integrator.
@@ -66,7 +68,9 @@ class Integrator(TransferBlock):
               the state.
 
         .. note:: The minimum and maximum prevent integration outside the limits,
-            but assume that the initial state is within the limits.
+            but assume that the initial state is within the limits.  The
+            times at which the state reaches a limit are located by
+            zero-crossing detection, see :meth:`Block.guard`.
         """
         super().__init__(**blockargs)
 
@@ -101,6 +105,50 @@ class Integrator(TransferBlock):
 
     def deriv(self):
         xd = base.getvector(self.inputs[0])
+        if self.min is not None or self.max is not None:
+            xd[self._held()] = 0
+        return self.gain * xd
+
+    def _held(self):
+        # states held at a limit
+        held = np.zeros((self.nstates,), dtype=bool)
+        sides = self._sides
+        if sides is None:
+            if self.min is not None:
+                held |= self._x < self.min
+            if self.max is not None:
+                held |= self._x > self.max
+        else:
+            # limits reached at the zero crossings of the guards
+            if self.min is not None:
+                held |= sides[:self.nstates] < 0
+                sides = sides[self.nstates:]
+            if self.max is not None:
+                held |= sides > 0
+        return held
+
+    def jacobian(self, t=None):
+        n = self.nstates
+        if np.size(self.inputs[0]) == n:
+            B = self.gain * np.eye(n)
+        else:
+            # broadcast scalar
+            B = self.gain * np.ones((n, 1))
+        B[self._held(), :] = 0
+        return np.zeros((n, n)), B, np.eye(n), None
+
+    def guard(self, t=None):
+        # the state reaching either limit
+        limits = [limit for limit in (self.min, self.max) if limit is not None]
+        if len(limits) == 0:
+            return None
+        return np.concatenate([self._x - limit for limit in limits])
+
+    def output_batch(self, t, N):
+        return [self._x]
+
+    def deriv_batch(self, N):
+        xd = np.array(self.inputs[0], dtype=float).reshape((N, self.nstates))
         if self.min is not None:
             xd[self._x < self.min] = 0
         if self.max is not None:
@@ -185,6 +233,8 @@ class LTI_SS(TransferBlock):
     nin = 1
     nout = 1
 
+    batch = True
+
     def __init__(self, A=None, B=None, C=None, x0=None, **blockargs):
         r"""
         State-space LTI dynamics.
@@ -255,6 +305,16 @@ class LTI_SS(TransferBlock):
 
     def deriv(self):
         return self.A @ self._x + self.B @ np.array(self.inputs)
+
+    def jacobian(self, t=None):
+        return self.A, self.B, self.C, None
+
+    def output_batch(self, t, N):
+        return list((self._x @ self.C.T).T)
+
+    def deriv_batch(self, N):
+        u = np.reshape(self.inputs[0], (N, -1))
+        return self._x @ self.A.T + u @ self.B.T
 # ------------------------------------------------------------------------ #
 
 
@@ -0,0 +1,163 @@
+"""
+Python code generation for the evaluation loop
+
+The execution plan of a compiled block diagram is turned into the source
+code of a Python module whose function ``bind(bd)`` returns a derivative
+function ``ydot(t, y)`` specialised to that diagram.  Compared to
+:meth:`BlockDiagram.evaluate_plan`, the generated function:
+
+- calls the blocks in plan order with no dispatch over block classes
+- passes each block the outputs of its upstream blocks directly, rather
+  than having the block look them up through its wires
+- does not reset the blocks, log debug output, or check the block outputs
+- only evaluates the held blocks when a clock ticks, see
+  :meth:`BlockDiagram.hold`
+- only evaluates the blocks that the derivative depends on, see
+  :meth:`BlockDiagram.derivative_cone`
+
+The generated code is used when the diagram is compiled with
+``compile(codegen=True)``, and the module can be written to disk with
+:func:`save` and later imported and bound to the same block diagram.
+
+.. note:: The generated function returns the same derivative array on
+    every call, copy it if the value needs to be retained.
+"""
+
+import numpy as np
+
+_header = '''\
+"""
+Evaluation function for block diagram {name}
+
+Generated by bdsim.codegen, do not edit.
+"""
+
+import numpy as np
+
+def bind(bd):
+    """
+    Bind the evaluation function to the block diagram
+
+    :param bd: the compiled block diagram this code was generated from
+    :type bd: BlockDiagram
+    :return: derivative function ``ydot(t, y)``
+    :rtype: callable
+    """
+    blocks = bd.blocknames
+'''
+
+def generate(bd):
+    """
+    Generate evaluation code for a block diagram
+
+    :param bd: compiled block diagram
+    :type bd: BlockDiagram
+    :raises RuntimeError: the block diagram is not compiled
+    :return: source code of a Python module
+    :rtype: str
+    """
+    if not bd.compiled:
+        raise RuntimeError('block diagram has not been compiled')
+
+    # name of the variable holding each block, and its output list
+    var = {}
+    for i, b in enumerate(bd.blocklist + bd.fused + bd.loops):
+        var[b] = f"b{i}"
+
+    def inputs(b):
+        # list of upstream output slots
+        return '[' + ', '.join([f"o_{var[p.block]}[{p.port}]" for p in b.sources]) + ']'
+
+    lines = [_header.format(name=bd.name)]
+
+    # bind the blocks, clocks and buffers
+    for b in bd.blocklist + bd.fused + bd.loops:
+        if b.blockclass not in ('sink', 'graphics'):
+            lines.append(f"    {var[b]} = blocks[{b.name!r}]")
+    if bd.optimized is not None:
+        # the outputs of folded blocks are constant
+        for b in bd.optimized.folded:
+            lines.append(f"    o_{var[b]} = {var[b]}.output_values")
+    lines.append(f"    xd = np.zeros(({bd.nstates},))")
+    lines.append('')
+
+    lines.append('    def ydot(t, y):')
+
+    # give the stateful blocks views of the state vector
+    for b in bd.transferblocks:
+        sl = b._xslice
+        lines.append(f"        {var[b]}._x = y[{sl.start}:{sl.stop}]")
+    if len(bd.held) > 0:
+        lines.append("        bd.hold(t)")
+
+    # evaluate the blocks in plan order
+    plan = bd.cone if bd.cone is not None else bd.plan
+    for sequence, group in enumerate(plan):
+        lines.append('')
+        lines.append(f"        # group {sequence}")
+        for b in group:
+            v = var[b]
+            lines.append(f"        # {b.name}")
+            if b in bd.held:
+                # evaluated when its clock ticks
+                lines.append(f"        o_{v} = {v}.output_values")
+                continue
+            if b.nin > 0 and b.blockclass not in ('transfer', 'clocked'):
+                # the output of a stateful block does not depend on its
+                # inputs, which are computed later
+                lines.append(f"        {v}._inputs = {inputs(b)}")
+            lines.append(f"        {v}.output_values = o_{v} = {v}.output(t)")
+            for m in getattr(b, 'members', []):
+                # a fused evaluator writes the outputs of its blocks
+                lines.append(f"        o_{var[m]} = {var[m]}.output_values")
+
+    # gather the derivatives
+    lines.append('')
+    lines.append('        # state derivative')
+    for b in bd.transferblocks:
+        v = var[b]
+        sl = b._xslice
+        if b.nin > 0:
+            lines.append(f"        {v}._inputs = {inputs(b)}")
+        lines.append(f"        xd[{sl.start}:{sl.stop}] = {v}.deriv().reshape((-1,))")
+    lines.append('        return xd')
+    lines.append('')
+    lines.append('    return ydot')
+    lines.append('')
+
+    return '\n'.join(lines)
+
+def bind(bd, source=None):
+    """
+    Create an evaluation function for a block diagram
+
+    :param bd: compiled block diagram
+    :type bd: BlockDiagram
+    :param source: generated source code, defaults to generating it
+    :type source: str, optional
+    :return: derivative function ``ydot(t, y)``
+    :rtype: callable
+    """
+    if source is None:
+        source = generate(bd)
+    namespace = {}
+    exec(compile(source, f"<bdsim generated {bd.name}>", 'exec'), namespace)
+    return namespace['bind'](bd)
+
+def save(bd, filename):
+    """
+    Write evaluation code for a block diagram to a file
+
+    :param bd: compiled block diagram
+    :type bd: BlockDiagram
+    :param filename: name of the Python file to write
+    :type filename: str
+
+    The file is a standalone module that can be imported later, and its
+    ``bind`` function applied to the same block diagram, for example::
+
+        import mydiagram_eval
+        ydot = mydiagram_eval.bind(bd)
+    """
+    with open(filename, 'w') as f:
+        f.write(generate(bd))
@@ -5,6 +5,8 @@ Components of the simulation system, namely blocks, wires and plugs.
 """
 import types
 import math
+import fractions
+import functools
 from re import S
 import numpy as np
 import matplotlib.pyplot as plt
@@ -52,10 +54,11 @@ class BDStruct(UserDict):
         # some tricks to make this deepcopy safe
         # https://stackoverflow.com/questions/40583131/python-deepcopy-with-custom-getattr-and-setattr
         # https://stackoverflow.com/questions/25977996/supporting-the-deep-copy-operation-on-a-custom-class
-        try:
-            return self.data[name]
-        except AttributeError:
+        if name.startswith('__') or 'data' not in self.__dict__:
+            # special methods probed by copy and pickle, or data not yet
+            # restored by unpickling
             raise AttributeError('unknown attribute ' + name)
+        return self.data[name]
         
     def __repr__(self):
         return str(self)
@@ -732,6 +735,7 @@ class Clock:
         self.offset = offset
 
         self.blocklist = []
+        self.ndstates = 0
 
         self.x = []  # discrete state vector numpy.ndarray
         self.t = []
@@ -760,35 +764,47 @@ class Clock:
         return s
 
     def getstate0(self):
+        # allocate each stateful block on this clock a fixed slice of the
+        # clock's state vector
+        self.ndstates = 0
+        for b in self.blocklist:
+            b._xslice = slice(self.ndstates, self.ndstates + b.ndstates)
+            self.ndstates += b.ndstates
+
         # get the state from each stateful block on this clock
-        x0 = np.array([])
+        x0 = np.zeros((self.ndstates,))
         for b in self.blocklist:
-            x0 = np.r_[x0, b.getstate0()]
-            #print('x0', x0)
+            x0[b._xslice] = b.getstate0()
         return x0
 
     def getstate(self):
-
-        x = np.array([])
+        # get the next state from each stateful block on this clock
+        x = np.zeros((self.ndstates,))
         for b in self.blocklist:
             # update dstate
-            x = np.r_[x, b.next().flatten()]
+            x[b._xslice] = np.reshape(b.next(), (-1,))
 
         return x
 
     def setstate(self):
+        # give each stateful block a view of its slice of the clock state
         x = self._x
         for b in self.blocklist:
-            x = b.setstate(x)  # send it to blocks        
+            b._x = x[b._xslice]
 
     def start(self, state=None):
-        self.i = 1
-        state.declare_event(self, self.time(self.i))
-        self.i += 1
+        # clear the state history of any previous run
+        self.x = []
+        self.t = []
+        if getattr(state, 'schedule', None) is None:
+            state.declare_events(self, self.events())
 
-    def next_event(self, state=None):
-        state.declare_event(self, self.time(self.i))
-        self.i += 1
+    def events(self):
+        # generate the clock event times on demand
+        i = 1
+        while True:
+            yield self.time(i)
+            i += 1
 
     def time(self, i):
         # return (math.floor((t - self.offset) / self.T) + 1) * self.T + self.offset
@@ -799,6 +815,156 @@ class Clock:
         # save clock state at time t
         self.t.append(t)
         self.x.append(self.getstate())
+
+class ClockSchedule:
+    """
+    Precomputed firing table for a set of clocks
+
+    If the periods and offsets of all clocks are integer multiples of a base
+    tick, the clocks fire in a pattern that repeats every hyperperiod, the
+    least common multiple of their periods in ticks.  The table lists, for
+    each tick of the hyperperiod at which any clock fires, the clocks that
+    fire then.  Walking the table gives the clock events in time order with
+    constant work per event, and event times are computed from an integer
+    tick count, so they do not accumulate rounding error.
+
+    Created by :meth:`build`, and used by :meth:`BDSim.run` in place of the
+    event queue for the clocks.
+    """
+
+    maxticks = 100000  # largest hyperperiod, in base ticks, that is tabulated
+
+    def __init__(self, clocks, base, hyperperiod, rows, first):
+        """
+        :param clocks: the clocks
+        :type clocks: list of Clock
+        :param base: base tick in seconds
+        :type base: Fraction
+        :param hyperperiod: length of the table in base ticks
+        :type hyperperiod: int
+        :param rows: ticks in ``[1, hyperperiod]`` at which clocks fire, and the clocks
+        :type rows: list of (int, list of Clock)
+        :param first: tick of the first event of each clock
+        :type first: dict
+        """
+        self.clocks = clocks
+        self.base = base
+        self.hyperperiod = hyperperiod
+        self.rows = rows
+        self._first = first
+        self._start = max(first.values())  # all clocks have started
+        self.start()
+
+    @classmethod
+    def build(cls, clocks):
+        """
+        Build the schedule for a set of clocks
+
+        :param clocks: the clocks
+        :type clocks: list of Clock
+        :return: schedule, or None if the clocks have no common base tick, or
+            the hyperperiod is longer than ``maxticks``
+        :rtype: ClockSchedule or None
+        """
+        if len(clocks) == 0:
+            return None
+
+        def exact(value):
+            # rational value of a period or offset
+            f = fractions.Fraction(value).limit_denominator(10**9)
+            if value < 0 or float(f) != value:
+                return None
+            return f
+
+        periods = [exact(c.T) for c in clocks]
+        offsets = [exact(c.offset) for c in clocks]
+        if None in periods or None in offsets or 0 in periods:
+            return None
+
+        # greatest common divisor of the periods and nonzero offsets
+        base = None
+        for f in periods + [f for f in offsets if f != 0]:
+            if base is None:
+                base = f
+            else:
+                base = fractions.Fraction(
+                    math.gcd(base.numerator * f.denominator, f.numerator * base.denominator),
+                    base.denominator * f.denominator)
+
+        periods = [int(f / base) for f in periods]
+        offsets = [int(f / base) for f in offsets]
+        hyperperiod = functools.reduce(lambda a, b: a * b // math.gcd(a, b), periods)
+        if hyperperiod > cls.maxticks:
+            return None
+
+        # the ticks at which each clock fires, within one hyperperiod
+        table = {}
+        first = {}
+        for clock, period, offset in zip(clocks, periods, offsets):
+            first[clock] = offset + period
+            tick = (offset + period) % period or period
+            for k in range(tick, hyperperiod + 1, period):
+                table.setdefault(k, []).append(clock)
+        rows = sorted(table.items())
+        return cls(clocks, base, hyperperiod, rows, first)
+
+    def __str__(self):
+        return f"ClockSchedule: {len(self.clocks)} clocks, base tick {float(self.base):g}s, " \
+            f"{len(self.rows)} events in a hyperperiod of {self.hyperperiod} ticks"
+
+    def __repr__(self):
+        return str(self)
+
+    def start(self):
+        """
+        Rewind the schedule to time zero
+        """
+        self._cycle = 0  # hyperperiods completed
+        self._row = 0  # next row of the table
+        if len(self._started(self._tick())) == 0:
+            self._advance()
+
+    def _tick(self):
+        return self._cycle * self.hyperperiod + self.rows[self._row][0]
+
+    def _started(self, tick):
+        # the clocks of the current row that fire at this tick
+        clocks = self.rows[self._row][1]
+        if tick < self._start:
+            # some clocks have offsets and have not started yet
+            clocks = [c for c in clocks if tick >= self._first[c]]
+        return clocks
+
+    def _advance(self):
+        # move to the next row, and past any row where no clock has started
+        while True:
+            self._row += 1
+            if self._row == len(self.rows):
+                self._row = 0
+                self._cycle += 1
+            if len(self._started(self._tick())) > 0:
+                return
+
+    def peek(self):
+        """
+        Time of the next clock event
+
+        :return: time of the next event
+        :rtype: float
+        """
+        return self._tick() * self.base.numerator / self.base.denominator
+
+    def pop(self):
+        """
+        Take the next clock event
+
+        :return: time of the event and the clocks that fire
+        :rtype: float, list of Clock
+        """
+        tick = self._tick()
+        clocks = self._started(tick)
+        self._advance()
+        return tick * self.base.numerator / self.base.denominator, clocks
 # ------------------------------------------------------------------------- #
 
 class Block:
@@ -807,6 +973,20 @@ class Block:
     varinputs = False
     varoutputs = False
 
+    pure = False        # output depends only on the inputs and parameters
+
+    # a block that can evaluate all members of an ensemble at once sets batch
+    # True and defines output_batch(t, N), and if it has states deriv_batch(N)
+    # returning an array (N, nstates).  Its inputs, state and the parameters
+    # named in batchparams then have a leading axis of length N, see
+    # BDSim.run_ensemble
+    batch = False       # block can evaluate all members of an ensemble at once
+    batchparams = ()    # parameters that can differ between ensemble members
+    _memberparams = {}  # per-member parameter values during an ensemble run
+    _batched = False    # block is batch evaluated during an ensemble run
+    _sides = None       # sign of the guards while zero crossings are located
+    _inputs = None      # input values bound by generated code, see codegen
+
     __array_ufunc__ = None  # allow block operators with NumPy values
 
     def __new__(cls, *args, bd=None, **kwargs):
@@ -1053,6 +1233,9 @@ class Block:
 
         :seealso: :meth:`inputs`
         """
+        if self._inputs is not None:
+            # inputs bound directly, by generated code
+            return self._inputs[port]
         try:
             p = self.sources[port]  # get plug for source block output
             return p.block.output_values[p.port]
@@ -1073,6 +1256,9 @@ class Block:
 
         :seealso: :meth:`input`
         """
+        if self._inputs is not None:
+            # inputs bound directly, by generated code
+            return self._inputs
         return [self.input(i) for i in range(self.nin)]
 
     def __getitem__(self, port):
@@ -1646,6 +1832,7 @@ class Block:
     def reset(self):
         if self.nin > 0:
             self.inputs = [None] * self.nin
+        self._inputs = None
         self.updated = False
 
     def add_output_wire(self, w):
@@ -1696,6 +1883,68 @@ class Block:
     def step(self, **kwargs):  # valid
         pass
 
+    def guard(self, t=None):
+        """
+        Compute zero-crossing guard values
+
+        :param t: current time
+        :type t: float
+        :return: guard values, or None if the block has no guards
+        :rtype: ndarray(n) or None
+
+        A block whose behaviour changes discontinuously, for example when a
+        signal reaches a limit, overrides this to return values computed from
+        its inputs or state whose sign changes at the discontinuity.  The
+        simulator locates the time of each sign change on the solver's dense
+        output and restarts the solver there, so it does not need to take
+        small steps to resolve the discontinuity.
+
+        Whether a block has guards must not depend on its inputs, and the
+        number of guard values must not change during a simulation.
+
+        While zero crossings are being located, the attribute ``_sides`` is
+        an array holding the sign of each guard value at the start of the
+        solver step, which changes only at a crossing.  A block can switch
+        its behaviour on ``_sides``, rather than on its inputs or state, so
+        that its output is smooth within the step and the crossing is found
+        accurately.  Otherwise ``_sides`` is None.
+
+        :seealso: :meth:`BDSim.run`
+        """
+        return None
+
+    def jacobian(self, t=None):
+        """
+        Compute the partial derivatives of the block
+
+        :param t: current time
+        :type t: float
+        :return: matrices ``(A, B, C, D)``, or None if not known analytically
+        :rtype: tuple or None
+
+        The matrices are the partial derivatives, at the current inputs and
+        state, of the derivative :math:`\\dot{x}` and the output :math:`y`
+        with respect to the state :math:`x` and the input :math:`u`
+
+        .. math::
+
+            A = \\frac{\\partial \\dot{x}}{\\partial x}, \\quad
+            B = \\frac{\\partial \\dot{x}}{\\partial u}, \\quad
+            C = \\frac{\\partial y}{\\partial x}, \\quad
+            D = \\frac{\\partial y}{\\partial u}
+
+        where :math:`u` and :math:`y` are the concatenation of all input and
+        all output ports, each flattened.  For a function block ``A``, ``B``
+        and ``C`` are None, and any matrix may be None if it is zero.
+
+        Blocks whose partial derivatives are known in closed form override
+        this, for the others :meth:`BlockDiagram.jacobian` estimates them by
+        finite differences of this block alone.
+
+        :seealso: :meth:`BlockDiagram.jacobian`
+        """
+        return None
+
     def savefig(self, *pos, **kwargs):
         pass
 
@@ -1785,6 +2034,7 @@ class TransferBlock(Block):
     def check(self):
         assert len(self._x0) == self.nstates, 'incorrect length for initial state'
         assert self.nin > 0 or self.nout > 0, 'no inputs or outputs specified'
+
 class FunctionBlock(Block):
     """
     A FunctionBlock is a subclass of Block that represents a block that has inputs
@@ -1877,8 +2127,44 @@ class ClockedBlock(Block):
         assert self.nin > 0 or self.nout > 0, 'no inputs or outputs specified'
         self._x = self._x0
 
+def batch_align(*values):
+    """
+    Align the ranks of ensemble values
+
+    :param values: values with a leading member axis
+    :type values: array_like
+    :return: values reshaped to the same rank
+    :rtype: list of ndarray
+
+    Axes are inserted after the leading member axis, so that the
+    per-member values broadcast against each other as they would in a
+    single simulation, for example a scalar of shape ``(N,)`` and a
+    1-vector of shape ``(N,1)``.
+    """
+    values = [np.asarray(v) for v in values]
+    ndim = max(v.ndim for v in values)
+    return [v.reshape(v.shape[:1] + (1,) * (ndim - v.ndim) + v.shape[1:]) for v in values]
+
 class EventSource:
-    pass
+    """
+    Mixin class for blocks that declare simulation events
+
+    A block that has discontinuities at known times subclasses this and
+    overrides :meth:`events`.  When the simulation starts the generator is
+    passed to the event queue, which requests the next event time only when
+    the previous one has been popped.
+    """
+
+    def events(self):
+        """
+        Generate event times
+
+        :return: event times in ascending order
+        :rtype: iterator of float
+
+        The default implementation declares no events.
+        """
+        return iter(())
 
 # c = Clock(5)
 # c1 = Clock(5, 2)
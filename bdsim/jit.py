@@ -0,0 +1,728 @@
+"""
+Numba compiled simulation engine
+
+For a block diagram built only from simple numeric blocks, the execution
+plan is lowered to the source code of functions that Numba compiles to
+machine code:
+
+- ``signals(t, y, d, s)`` evaluates every block, in plan order, into the
+  flat signal vector ``s``, by calling ``stage`` then ``rest``, which
+  evaluate the blocks inside and outside the derivative cone
+- ``ydot(t, y, d, s, xd)`` evaluates the signals in the derivative cone and
+  the state derivative
+- ``integrate(t0, tf, h, y0, d, s, A, B, C)`` integrates over an interval
+  with an explicit Runge-Kutta method, given by its Butcher tableau, and
+  returns the time, state and signal vector at every step
+- ``discrete(t, masks, d, s)`` runs a diagram with no continuous states,
+  ticking the clocks given by ``masks`` after each event, and returns the
+  signal vector and discrete state at every event
+
+where ``y`` is the continuous state and ``d`` is the discrete state of all
+clocks, which is constant over an integration interval.  Every signal is
+stored in ``s`` as a float, or a slice for a 1D array.
+
+The engine is used when the diagram is compiled with ``compile(jit=True)``.
+Python then runs only at the boundaries of integration intervals, where
+clocked blocks are updated, and for the sink blocks, which are stepped with
+the recorded signal values.  With the native fixed-step solvers the whole
+interval is integrated in compiled code, with scipy's adaptive solvers only
+the derivative is compiled.  If there are no continuous states, the clocks
+are also ticked in compiled code, and Python only steps the sinks.
+
+If Numba is not installed, or any block in the plan is not supported, the
+interpreter is used instead and the reason, including the name of the
+offending block, is given by the block diagram's ``jit_fallback`` attribute.
+
+Supported blocks are: CONSTANT, TIME, STEP, RAMP, WAVEFORM, GAIN, SUM,
+PROD, CLIP, MUX, DEMUX, INDEX, INTEGRATOR, LTI_SS, LTI_SISO, ZOH and
+DINTEGRATOR, with scalar or 1D-array signals, and the fused linear
+sub-graphs created by ``compile(optimize=True)``.
+"""
+
+import math
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from bdsim import solvers
+
+
+class Unsupported(Exception):
+    """
+    Block cannot be lowered to compiled code
+    """
+    pass
+
+
+# lowering rules, indexed by block class name, each rule returns lines of
+# code for the block's output, state derivative or next discrete state
+_outputs = {}
+_derivs = {}
+_nexts = {}
+
+def _rule(table, *names):
+    def decorator(func):
+        for name in names:
+            table[name] = func
+        return func
+    return decorator
+
+
+class _Lowering:
+    # allocate signals in the flat signal vector and constants referenced by
+    # the generated code
+
+    def __init__(self, bd):
+        self.bd = bd
+        self.slots = {}  # (block, port) -> (offset, shape)
+        self.nsignals = 0
+        self.consts = {}
+        self.folded = []
+
+        # offset of each clock's state in the discrete state vector
+        self.doffset = {}
+        self.ndstates = 0
+        for clock in bd.clocklist:
+            self.doffset[clock] = self.ndstates
+            self.ndstates += clock.ndstates
+
+    def alloc(self, b, port, value):
+        # allocate the signal vector for an output port, given its value
+        if isinstance(value, (bool, int, float, np.integer, np.floating)):
+            shape = ()
+        elif isinstance(value, np.ndarray) and value.ndim <= 1 \
+                and np.issubdtype(value.dtype, np.number) \
+                and not np.issubdtype(value.dtype, np.complexfloating):
+            shape = value.shape
+        else:
+            raise Unsupported(f"output {port} has type {type(value).__name__}, "
+                "only scalar and 1D-array signals are supported")
+        self.slots[b, port] = (self.nsignals, shape)
+        self.nsignals += max(1, int(np.prod(shape)))
+
+    def shape(self, b, port):
+        return self.slots[b, port][1]
+
+    def width(self, b, port):
+        return max(1, int(np.prod(self.shape(b, port))))
+
+    def ref(self, b, port, i=None):
+        # expression for a signal, or element of it
+        offset, shape = self.slots[b, port]
+        if shape == ():
+            return f"s[{offset}]"
+        elif i is not None:
+            return f"s[{offset + i}]"
+        else:
+            return f"s[{offset}:{offset + shape[0]}]"
+
+    def input(self, b, i, element=None):
+        p = b.sources[i]
+        return self.ref(p.block, p.port, element)
+
+    def inshape(self, b, i):
+        p = b.sources[i]
+        return self.shape(p.block, p.port)
+
+    def output(self, b, port=0, element=None):
+        return self.ref(b, port, element)
+
+    def state(self, b):
+        sl = b._xslice
+        return f"y[{sl.start}:{sl.stop}]"
+
+    def deriv(self, b):
+        sl = b._xslice
+        return f"xd[{sl.start}:{sl.stop}]"
+
+    def dstate(self, b):
+        base = self.doffset[b.clock]
+        sl = b._xslice
+        return f"d[{base + sl.start}:{base + sl.stop}]"
+
+    def dnext(self, b):
+        base = self.doffset[b.clock]
+        sl = b._xslice
+        return f"dn[{base + sl.start}:{base + sl.stop}]"
+
+    def const(self, value):
+        # a constant array, bound to a global of the generated module
+        name = f"k{len(self.consts)}"
+        self.consts[name] = np.ascontiguousarray(value, dtype=float)
+        return name
+
+    def literal(self, value):
+        # a scalar constant, written into the generated code
+        if isinstance(value, np.ndarray):
+            if value.size != 1:
+                return self.const(value)
+            value = value.item()
+        value = float(value)
+        if math.isnan(value):
+            return 'math.nan'
+        elif math.isinf(value):
+            return 'math.inf' if value > 0 else '-math.inf'
+        return repr(value)
+
+    def value(self, value):
+        # a constant of any size
+        if np.ndim(value) == 0:
+            return self.literal(value)
+        return self.const(value)
+
+
+# ------------------------------------------------------------------------ #
+# sources
+
+@_rule(_outputs, 'Constant')
+def _constant(b, L):
+    return [f"{L.output(b)} = {L.value(b.value)}"]
+
+@_rule(_outputs, 'Time')
+def _time(b, L):
+    return [f"{L.output(b)} = t"]
+
+@_rule(_outputs, 'Step')
+def _step(b, L):
+    return [f"{L.output(b)} = {L.literal(b.on)} if t >= {L.literal(b.T)} else {L.literal(b.off)}"]
+
+@_rule(_outputs, 'Ramp')
+def _ramp(b, L):
+    T = L.literal(b.T)
+    off = L.literal(b.off)
+    return [f"{L.output(b)} = {off} + {L.literal(b.slope)} * (t - {T}) if t >= {T} else {off}"]
+
+@_rule(_outputs, 'WaveForm')
+def _waveform(b, L):
+    phase = f"ph_{L.slots[b, 0][0]}"
+    lines = [f"{phase} = (t * {L.literal(b.freq)} - {L.literal(b.phase)}) % 1.0"]
+    if b.wave == 'square':
+        wave = f"(1.0 if {phase} < {L.literal(b.duty)} else -1.0)"
+    elif b.wave == 'triangle':
+        wave = f"({phase} * 4 if {phase} < 0.25 else " \
+            f"(1 - 4 * ({phase} - 0.25) if {phase} < 0.75 else -1 + 4 * ({phase} - 0.75)))"
+    else:
+        wave = f"math.sin({phase} * 2 * math.pi)"
+    lines.append(f"{L.output(b)} = {wave} * {L.literal(b.amplitude)} + {L.literal(b.offset)}")
+    return lines
+
+# ------------------------------------------------------------------------ #
+# functions
+
+@_rule(_outputs, 'Gain')
+def _gain(b, L):
+    u = L.input(b, 0)
+    if isinstance(b.K, np.ndarray) and L.inshape(b, 0) != ():
+        # array x array case
+        if b.premul:
+            return [f"{L.output(b)} = np.dot({L.const(b.K)}, {u})"]
+        else:
+            return [f"{L.output(b)} = np.dot({u}, {L.const(b.K)})"]
+    else:
+        return [f"{L.output(b)} = {u} * {L.value(b.K)}"]
+
+@_rule(_outputs, 'Sum')
+def _sum(b, L):
+    if b.mode is not None:
+        raise Unsupported('angle wrapping mode is not supported')
+    expr = ''
+    for i, sign in enumerate(b.signs):
+        if i == 0:
+            expr = f"-{L.input(b, i)}" if sign == '-' else L.input(b, i)
+        else:
+            expr += f" {sign} {L.input(b, i)}"
+    return [f"{L.output(b)} = {expr}"]
+
+@_rule(_outputs, 'Prod')
+def _prod(b, L):
+    if b.matrix:
+        raise Unsupported('matrix products are not supported')
+    expr = ''
+    for i, op in enumerate(b.ops):
+        if i == 0:
+            expr = f"1.0 / {L.input(b, i)}" if op == '/' else L.input(b, i)
+        else:
+            expr += f" {op} {L.input(b, i)}"
+    return [f"{L.output(b)} = {expr}"]
+
+@_rule(_outputs, 'Clip')
+def _clip(b, L):
+    if L.shape(b, 0) == ():
+        return [f"{L.output(b)} = min({L.literal(b.max)}, max({L.input(b, 0)}, {L.literal(b.min)}))"]
+    else:
+        return [f"{L.output(b)} = np.minimum(np.maximum({L.input(b, 0)}, {L.value(b.min)}), {L.value(b.max)})"]
+
+# ------------------------------------------------------------------------ #
+# connections
+
+@_rule(_outputs, 'Mux')
+def _mux(b, L):
+    lines = []
+    offset = L.slots[b, 0][0]
+    for i in range(b.nin):
+        n = L.width(b.sources[i].block, b.sources[i].port)
+        if L.inshape(b, i) == ():
+            lines.append(f"s[{offset}] = {L.input(b, i)}")
+        else:
+            lines.append(f"s[{offset}:{offset + n}] = {L.input(b, i)}")
+        offset += n
+    if offset - L.slots[b, 0][0] != L.width(b, 0):
+        raise Unsupported('output width does not match the inputs')
+    return lines
+
+@_rule(_outputs, 'DeMux')
+def _demux(b, L):
+    if L.inshape(b, 0) != (b.nout,):
+        raise Unsupported('input width not equal to number of output ports')
+    lines = []
+    for i in range(b.nout):
+        if L.shape(b, i) != ():
+            raise Unsupported('elements of the input must be scalars')
+        lines.append(f"{L.output(b, i)} = {L.input(b, 0, i)}")
+    return lines
+
+@_rule(_outputs, 'Index')
+def _index(b, L):
+    shape = L.inshape(b, 0)
+    if not isinstance(b.index, (list, tuple)) or len(shape) != 1:
+        raise Unsupported('only a list of indices into a 1D-array is supported')
+    index = [int(i) % shape[0] for i in b.index]
+    if len(index) == 1:
+        return [f"{L.output(b)} = {L.input(b, 0, index[0])}"]
+    return [f"{L.output(b, 0, j)} = {L.input(b, 0, i)}" for j, i in enumerate(index)]
+
+# ------------------------------------------------------------------------ #
+# transfer functions
+
+@_rule(_outputs, 'Integrator')
+def _integrator(b, L):
+    return [f"{L.output(b)} = {L.state(b)}"]
+
+@_rule(_derivs, 'Integrator')
+def _integrator_deriv(b, L):
+    xd = L.deriv(b)
+    lines = [f"{xd} = {L.input(b, 0)}"]
+    if b.min is not None:
+        lines.append(f"{xd} = np.where({L.state(b)} < {L.const(b.min)}, 0.0, {xd})")
+    if b.max is not None:
+        lines.append(f"{xd} = np.where({L.state(b)} > {L.const(b.max)}, 0.0, {xd})")
+    lines.append(f"{xd} *= {L.literal(b.gain)}")
+    return lines
+
+@_rule(_outputs, 'LTI_SS', 'LTI_SISO')
+def _lti(b, L):
+    C = L.const(b.C)
+    return [f"{L.output(b, i)} = np.dot({C}[{i}], {L.state(b)})" for i in range(b.C.shape[0])]
+
+@_rule(_derivs, 'LTI_SS', 'LTI_SISO')
+def _lti_deriv(b, L):
+    if b.B.shape[1] != 1 or L.width(b.sources[0].block, b.sources[0].port) != 1:
+        raise Unsupported('only a scalar input is supported')
+    u = L.input(b, 0, 0)
+    return [f"{L.deriv(b)} = np.dot({L.const(b.A)}, {L.state(b)}) + {L.const(b.B[:, 0])} * {u}"]
+
+# ------------------------------------------------------------------------ #
+# discrete time
+
+@_rule(_outputs, 'ZOH', 'DIntegrator')
+def _clocked(b, L):
+    return [f"{L.output(b)} = {L.dstate(b)}"]
+
+@_rule(_nexts, 'ZOH')
+def _zoh_next(b, L):
+    return [f"{L.dnext(b)} = {L.input(b, 0)}"]
+
+@_rule(_nexts, 'DIntegrator')
+def _dintegrator_next(b, L):
+    x = f"{L.dstate(b)} + {L.value(b.gain * b.clock.T)} * {L.input(b, 0)}"
+    if b.min is not None:
+        x = f"np.maximum({x}, {L.value(b.min)})"
+    if b.max is not None:
+        x = f"np.minimum({x}, {L.value(b.max)})"
+    return [f"{L.dnext(b)} = {x}"]
+
+# ------------------------------------------------------------------------ #
+# fused linear sub-graphs, see bdsim.optimize
+
+def _fused_terms(b, L, M):
+    # terms of M @ u, where u are the external inputs of the evaluator
+    terms = []
+    for p, start, stop in b.external:
+        if not np.any(M[:, start:stop] != 0):
+            continue
+        elif stop - start == 1:
+            terms.append(f"{L.const(M[:, start])} * {L.ref(p.block, p.port, 0)}")
+        else:
+            terms.append(f"np.dot({L.const(M[:, start:stop])}, {L.ref(p.block, p.port)})")
+    return terms
+
+@_rule(_outputs, 'FusedLTI')
+def _fused(b, L):
+    start = L.slots[b.members[0], 0][0]
+    terms = _fused_terms(b, L, b.D)
+    if b.nstates > 0:
+        terms.insert(0, f"np.dot({L.const(b.C)}, {L.state(b)})")
+    if np.any(b.yoffset != 0):
+        terms.append(L.const(b.yoffset))
+    expr = ' + '.join(terms) if len(terms) > 0 else '0.0'
+    return [f"s[{start}:{start + b.C.shape[0]}] = {expr}"]
+
+@_rule(_derivs, 'FusedLTI')
+def _fused_deriv(b, L):
+    terms = [f"np.dot({L.const(b.A)}, {L.state(b)})"] + _fused_terms(b, L, b.B)
+    if np.any(b.xdoffset != 0):
+        terms.append(L.const(b.xdoffset))
+    return [f"{L.deriv(b)} = {' + '.join(terms)}"]
+
+# ------------------------------------------------------------------------ #
+
+_header = '''\
+"""
+Compiled evaluation functions for block diagram {name}
+
+Generated by bdsim.jit, do not edit.
+"""
+
+import math
+import numpy as np
+'''
+
+_integrate = '''
+@njit
+def integrate(t0, tf, h, y0, d, s, A, B, C):
+    # count the steps, the last is shortened to end at tf
+    n = 0
+    t = t0
+    while t < tf:
+        t = tf if t + h * (1 + 1e-9) >= tf else t + h
+        n += 1
+
+    nstages = B.shape[0]
+    ny = y0.shape[0]
+    tout = np.empty((n,))
+    yout = np.empty((n, ny))
+    sout = np.empty((n, s.shape[0]))
+    K = np.empty((nstages, ny))
+    xd = np.empty((ny,))
+    ytmp = np.empty((ny,))
+
+    y = y0.copy()
+    t = t0
+    K[0] = ydot(t, y, d, s, xd)
+    for i in range(n):
+        last = t + h * (1 + 1e-9) >= tf
+        hi = tf - t if last else h
+        for j in range(1, nstages):
+            ytmp[:] = y
+            for m in range(j):
+                ytmp += hi * A[j, m] * K[m]
+            K[j] = ydot(t + C[j] * hi, ytmp, d, s, xd)
+        for j in range(nstages):
+            y += hi * B[j] * K[j]
+        t = tf if last else t + h
+
+        # derivative at the end of the step, first stage of the next step,
+        # and the remaining signals leave all signals consistent with y
+        K[0] = ydot(t, y, d, s, xd)
+        rest(t, y, d, s)
+        tout[i] = t
+        yout[i] = y
+        sout[i] = s
+    return tout, yout, sout
+'''
+
+_discrete = '''
+@njit
+def discrete(t, masks, d, s):
+    # evaluate the signals at each event time, then tick the clocks given by
+    # the mask, return the signal vector and discrete state after each event
+    n = t.shape[0]
+    sout = np.empty((n, s.shape[0]))
+    dout = np.empty((n, d.shape[0]))
+    y = np.empty((0,))
+    dn = d.copy()
+    for i in range(n):
+        signals(t[i], y, d, s)
+        sout[i] = s
+        dn[:] = d
+        update(masks[i], d, s, dn)
+        d[:] = dn
+        dout[i] = d
+    return sout, dout
+'''
+
+def _generate(bd):
+    # lower the plan, return the source code and the lowering context
+    L = _Lowering(bd)
+
+    # the value of every output fixes its shape, evaluate once to find them
+    bd.evaluate_plan(bd.getstate0().copy(), 0.0, sinks=False)
+
+    plan = [b for group in bd.plan for b in group]
+    for b in plan:
+        name = type(b).__name__
+        where = f"block {b.name} ({b.type.upper()})"
+        if not type(b).__module__.startswith(('bdsim.blocks', 'bdsim.optimize')) \
+                or name not in _outputs \
+                or (b.blockclass == 'transfer' and name not in _derivs):
+            raise Unsupported(f"{where} is not supported")
+        try:
+            for port in range(b.nout):
+                L.alloc(b, port, b.output_values[port])
+            # a fused evaluator writes the outputs of its blocks
+            for m in getattr(b, 'members', []):
+                for port in range(m.nout):
+                    L.alloc(m, port, m.output_values[port])
+        except Unsupported as err:
+            raise Unsupported(f"{where}: {err}") from None
+
+    # the outputs of folded blocks are constant, written once into s
+    if bd.optimized is not None:
+        for b in bd.optimized.folded:
+            try:
+                for port in range(b.nout):
+                    L.alloc(b, port, b.output_values[port])
+            except Unsupported as err:
+                raise Unsupported(f"block {b.name} ({b.type.upper()}): {err}") from None
+            L.folded.append(b)
+
+    # the stages only compute the signals the derivative depends on, the
+    # rest are computed once per step
+    if bd.cone is None:
+        cone, rest = plan, []
+    else:
+        cone = [b for group in bd.cone for b in group]
+        rest = [b for group in bd.rest for b in group]
+
+    lines = [_header.format(name=bd.name)]
+    for function, blocks in (('stage', cone), ('rest', rest)):
+        lines.append('@njit')
+        lines.append(f"def {function}(t, y, d, s):")
+        for b in blocks:
+            try:
+                code = _outputs[type(b).__name__](b, L)
+            except Unsupported as err:
+                raise Unsupported(f"block {b.name} ({b.type.upper()}): {err}") from None
+            lines.append(f"    # {b.name}")
+            lines.extend(['    ' + line for line in code])
+        lines.append('    return s')
+        lines.append('')
+
+    lines.append('@njit')
+    lines.append('def signals(t, y, d, s):')
+    lines.append('    stage(t, y, d, s)')
+    lines.append('    return rest(t, y, d, s)')
+    lines.append('')
+
+    lines.append('@njit')
+    lines.append('def ydot(t, y, d, s, xd):')
+    lines.append('    stage(t, y, d, s)')
+    for b in bd.transferblocks:
+        try:
+            code = _derivs[type(b).__name__](b, L)
+        except Unsupported as err:
+            raise Unsupported(f"block {b.name} ({b.type.upper()}): {err}") from None
+        lines.append(f"    # {b.name}")
+        lines.extend(['    ' + line for line in code])
+    lines.append('    return xd')
+    lines.append('')
+
+    # next discrete state of the clocks that tick, given by mask
+    lines.append('@njit')
+    lines.append('def update(mask, d, s, dn):')
+    lines.append('    pass')
+    for i, clock in enumerate(bd.clocklist):
+        lines.append(f"    if mask[{i}]:")
+        lines.append(f"        # {clock.name}")
+        lines.append('        pass')
+        for b in clock.blocklist:
+            name = type(b).__name__
+            if not type(b).__module__.startswith('bdsim.blocks') or name not in _nexts:
+                raise Unsupported(f"block {b.name} ({b.type.upper()}) is not supported")
+            try:
+                code = _nexts[name](b, L)
+            except Unsupported as err:
+                raise Unsupported(f"block {b.name} ({b.type.upper()}): {err}") from None
+            lines.extend(['        ' + line for line in code])
+    lines.append(_integrate)
+    lines.append(_discrete)
+
+    return '\n'.join(lines), L
+
+
+class Engine:
+    """
+    Compiled simulation engine for a block diagram
+
+    Created by :func:`lower`.
+    """
+
+    def __init__(self, bd, source, L, namespace):
+        self.bd = bd
+        self.source = source  #: generated source code
+        self.slots = L.slots
+        self.nsignals = L.nsignals
+        self._doffset = L.doffset
+        self._signals = namespace['signals']
+        self._ydot = namespace['ydot']
+        self._integrate = namespace['integrate']
+        self._discrete = namespace['discrete']
+
+        self._s = np.zeros((L.nsignals,))
+        for b in L.folded:
+            for port in range(b.nout):
+                offset, shape = self.slots[b, port]
+                self._s[offset:offset + max(1, int(np.prod(shape)))] = b.output_values[port]
+        self._d = np.zeros((L.ndstates,))
+        self._xd = np.zeros((bd.nstates,))
+
+    def start_interval(self):
+        """
+        Gather the discrete state of all clocks
+
+        The discrete state is constant over an integration interval, and must
+        be gathered before the derivative is evaluated.
+        """
+        for clock, offset in self._doffset.items():
+            self._d[offset:offset + clock.ndstates] = clock._x
+
+    def ydot(self, t, y):
+        """
+        Evaluate the state derivative
+
+        :param t: time
+        :type t: float
+        :param y: continuous state
+        :type y: ndarray(n)
+        :return: state derivative
+        :rtype: ndarray(n)
+
+        .. note:: The same array is returned on every call.
+        """
+        return self._ydot(float(t), np.asarray(y, dtype=float), self._d, self._s, self._xd)
+
+    def signals(self, t, y):
+        """
+        Evaluate the signal vector
+
+        :param t: time
+        :type t: float
+        :param y: continuous state
+        :type y: ndarray(n)
+        :return: value of all signals
+        :rtype: ndarray(m)
+        """
+        return self._signals(float(t), np.asarray(y, dtype=float), self._d, self._s).copy()
+
+    def integrate(self, t0, tf, h, y0, solver):
+        """
+        Integrate over an interval with a fixed step
+
+        :param t0: initial time
+        :type t0: float
+        :param tf: final time
+        :type tf: float
+        :param h: step size
+        :type h: float
+        :param y0: initial state
+        :type y0: ndarray(n)
+        :param solver: fixed-step solver class providing the Butcher tableau
+        :type solver: subclass of :class:`~bdsim.solvers.FixedStepSolver`
+        :return: time, state and signal vector at the end of every step
+        :rtype: ndarray(k), ndarray(k,n), ndarray(k,m)
+        """
+        return self._integrate(float(t0), float(tf), float(h),
+            np.array(y0, dtype=float), self._d, self._s,
+            solver.A, solver.B, solver.C)
+
+    def discrete(self, t, masks):
+        """
+        Run a block diagram with only discrete states
+
+        :param t: time of each event
+        :type t: ndarray(k)
+        :param masks: clocks that tick after each event, by their index in
+            the block diagram's clock list
+        :type masks: ndarray(k,c) of bool
+        :return: signal vector at, and discrete state after, every event
+        :rtype: ndarray(k,m), ndarray(k,nd)
+
+        The discrete state starts from that of the clocks, see
+        :meth:`start_interval`.
+        """
+        return self._discrete(np.asarray(t, dtype=float), np.asarray(masks, dtype=np.bool_),
+            self._d.copy(), self._s)
+
+    def value(self, s, block, port):
+        """
+        Value of an output port
+
+        :param s: signal vector
+        :type s: ndarray(m)
+        :param block: block
+        :type block: Block
+        :param port: output port
+        :type port: int
+        :return: value of the signal
+        :rtype: float or ndarray(n)
+        """
+        offset, shape = self.slots[block, port]
+        if shape == ():
+            return float(s[offset])
+        return s[offset:offset + shape[0]].copy()
+
+    def setinputs(self, s, blocks):
+        """
+        Bind the inputs of blocks to the signal vector
+
+        :param s: signal vector
+        :type s: ndarray(m)
+        :param blocks: blocks, typically sinks, to bind
+        :type blocks: iterable of Block
+
+        The blocks' inputs are taken from ``s`` until :meth:`Block.reset` is
+        called.
+        """
+        for b in blocks:
+            b._inputs = [self.value(s, p.block, p.port) for p in b.sources]
+
+
+def lower(bd):
+    """
+    Create a compiled simulation engine for a block diagram
+
+    :param bd: compiled block diagram
+    :type bd: BlockDiagram
+    :raises Unsupported: the block diagram cannot be compiled, the message
+        names the first block that is not supported
+    :return: simulation engine
+    :rtype: Engine
+    """
+    if numba is None:
+        raise Unsupported('numba is not installed')
+    if not bd.compiled:
+        raise RuntimeError('block diagram has not been compiled')
+
+    source, L = _generate(bd)
+
+    namespace = dict(L.consts)
+    namespace['njit'] = numba.njit
+    exec(compile(source, f"<bdsim jit {bd.name}>", 'exec'), namespace)
+    engine = Engine(bd, source, L, namespace)
+
+    # compile now, typing errors are reported as a fallback
+    try:
+        engine.start_interval()
+        y0 = bd.getstate0().copy()
+        engine.ydot(0.0, y0)
+        engine.signals(0.0, y0)
+        engine.integrate(0.0, 0.0, 1.0, y0, solvers.Euler)
+        if bd.nstates == 0:
+            engine.discrete(np.zeros((0,)), np.zeros((0, len(bd.clocklist))))
+    except numba.core.errors.NumbaError as err:
+        raise Unsupported(f"numba could not compile the block diagram: {err}") from None
+
+    return engine
@@ -0,0 +1,691 @@
+"""
+Compile-time optimisation of block diagrams
+
+These passes are invoked, in this order, by ``compile(optimize=True)``.
+They change the execution plan but not the blocks or wires of the diagram,
+and the values they use are taken from the block parameters when the
+diagram is compiled, so it must be compiled again if parameters are changed.
+
+Constant folding
+----------------
+
+``CONSTANT`` blocks, and pure function blocks whose inputs are all constant,
+are evaluated once at compile time and removed from the plan.  Their output
+values remain valid for the whole simulation.
+
+Dead-block elimination
+----------------------
+
+Function blocks whose outputs reach no transfer, clocked or sink block are
+removed from the plan.  Blocks whose outputs are to be watched should be
+given to ``compile`` by its ``keep`` argument, otherwise ``run`` compiles the
+diagram again to keep them.
+
+Chain merging
+-------------
+
+Trees of SUM and GAIN blocks created by the overloaded operators of
+:class:`Block` and :class:`Plug`, such as ``2 * x + y - 1``, are replaced by
+a single affine evaluator for the root of the tree, with any constant
+inputs folded into its offset.  The output values of the other blocks of
+the tree are not computed.
+
+Linear fusion
+-------------
+
+Connected sub-graphs of linear blocks, ``LTI_SS``, ``LTI_SISO``,
+``INTEGRATOR`` without limits, ``GAIN``, ``SUM`` without angle wrapping,
+``MUX`` and ``DEMUX``, are replaced in the execution plan by a single
+:class:`FusedLTI` evaluator
+
+.. math::
+
+    \\dot{x} = A x + B u, \\quad y = C x + D u
+
+where :math:`x` is the concatenated state of the fused transfer blocks,
+:math:`u` the signals entering the sub-graph and :math:`y` every output port
+of the fused blocks.  The fused blocks remain in the block diagram, the
+evaluator writes their output values and gives the transfer blocks views of
+their state, so sinks, watched ports and ``statenames`` are unaffected.
+Constant inputs become offsets of the derivative and output.
+"""
+
+import numpy as np
+
+from bdsim.components import TransferBlock, BDStruct, Block, Plug
+
+
+# block models, indexed by block class name, each model returns the matrices
+# (A, B, C, D) of the block, or None if it is not linear, given the widths of
+# its input and output ports and whether each input is a scalar.  The inputs
+# and outputs are the concatenation of all ports
+
+def _gain(b, win, wout, scalar):
+    K = b.K
+    if isinstance(K, np.ndarray) and K.ndim == 0:
+        K = float(K)
+    if isinstance(K, np.ndarray) and not scalar[0]:
+        # array x array case
+        if K.ndim == 1:
+            D = K.reshape((1, -1))
+        elif b.premul:
+            D = K
+        else:
+            D = K.T
+    elif isinstance(K, np.ndarray):
+        # scalar input, array gain
+        if K.ndim != 1:
+            return None
+        D = K.reshape((-1, 1))
+    else:
+        D = K * np.eye(win[0])
+    return None, None, None, D
+
+def _sum(b, win, wout, scalar):
+    if b.mode is not None:
+        return None
+    D = []
+    for w, sign in zip(win, b.signs):
+        s = -1.0 if sign == '-' else 1.0
+        if w == wout[0]:
+            D.append(s * np.eye(w))
+        elif w == 1:
+            D.append(s * np.ones((wout[0], 1)))
+        else:
+            return None
+    return None, None, None, np.hstack(D)
+
+def _mux(b, win, wout, scalar):
+    if sum(win) != wout[0]:
+        return None
+    return None, None, None, np.eye(wout[0])
+
+def _demux(b, win, wout, scalar):
+    if win[0] != b.nout:
+        return None
+    return None, None, None, np.eye(b.nout)
+
+def _integrator(b, win, wout, scalar):
+    if b.min is not None or b.max is not None:
+        return None
+    n = b.nstates
+    if win[0] == n:
+        B = b.gain * np.eye(n)
+    elif win[0] == 1:
+        B = b.gain * np.ones((n, 1))
+    else:
+        return None
+    return np.zeros((n, n)), B, np.eye(n), np.zeros((n, win[0]))
+
+def _lti(b, win, wout, scalar):
+    if win[0] != 1 or b.B.shape[1] != 1 or b.C.shape[0] != b.nout:
+        return None
+    return b.A, b.B, b.C, np.zeros((b.C.shape[0], 1))
+
+models = {
+    'Gain': _gain,
+    'Sum': _sum,
+    'Mux': _mux,
+    'DeMux': _demux,
+    'Integrator': _integrator,
+    'LTI_SS': _lti,
+    'LTI_SISO': _lti,
+}
+
+
+# prefixes of the names of blocks created by the overloaded operators
+_auto = ('_sum.', '_gain.')
+
+
+def _shape(value):
+    # shape of a scalar or 1D-array signal, None if not numeric
+    if isinstance(value, (bool, int, float, np.integer, np.floating)):
+        return ()
+    if isinstance(value, np.ndarray) and value.ndim == 1 \
+            and np.issubdtype(value.dtype, np.number) \
+            and not np.issubdtype(value.dtype, np.complexfloating):
+        return value.shape
+    return None
+
+def _width(shape):
+    return 1 if shape == () else shape[0]
+
+
+class FusedLTI(TransferBlock):
+    """
+    Fused evaluator for a linear sub-graph
+
+    Created by :func:`fuse`, it is not a block of the diagram but replaces
+    the fused blocks in its execution plan.
+    """
+
+    nin = 0
+    nout = 0
+
+    def __init__(self, members, A, B, C, D, inputs, outputs, yoffset=None, xdoffset=None, blocks=None, **blockargs):
+        """
+        :param members: blocks whose outputs are computed, in plan order
+        :type members: list of Block
+        :param A: state matrix
+        :type A: ndarray(nx,nx)
+        :param B: input matrix
+        :type B: ndarray(nx,nu)
+        :param C: output matrix
+        :type C: ndarray(ny,nx)
+        :param D: feedthrough matrix
+        :type D: ndarray(ny,nu)
+        :param inputs: external signals and their offset in ``u``
+        :type inputs: list of (Plug, int, int)
+        :param outputs: output ports of the fused blocks and their offset in ``y``
+        :type outputs: list of (Block, int, int, int)
+        :param yoffset: constant added to the output, defaults to zero
+        :type yoffset: ndarray(ny), optional
+        :param xdoffset: constant added to the derivative, defaults to zero
+        :type xdoffset: ndarray(nx), optional
+        :param blocks: all blocks replaced by the evaluator, defaults to ``members``
+        :type blocks: list of Block, optional
+        :param blockargs: |BlockOptions|
+        :type blockargs: dict
+        """
+        nstates = A.shape[0]
+        super().__init__(nstates=nstates, **blockargs)
+        if nstates == 0:
+            self.blockclass = 'function'
+            self.pure = True
+
+        self.members = members
+        self.blocks = members if blocks is None else blocks
+        self.transfers = [b for b in members if b.blockclass == 'transfer']
+        self.A = A
+        self.B = B
+        self.C = C
+        self.D = D
+        self.external = inputs
+        self.internal = outputs
+        self.feedthrough = [np.any(D[:, start:stop] != 0) for _, start, stop in inputs]
+        self.yoffset = np.zeros((C.shape[0],)) if yoffset is None else yoffset
+        self.xdoffset = np.zeros((nstates,)) if xdoffset is None else xdoffset
+        self._u = np.zeros((D.shape[1],))
+
+    def getstate0(self):
+        if len(self.transfers) == 0:
+            return np.zeros((0,))
+        return np.concatenate([np.reshape(b.getstate0(), (-1,)) for b in self.transfers])
+
+    def _gather(self):
+        # gather the external inputs
+        u = self._u
+        for p, start, stop in self.external:
+            u[start:stop] = p.block.output_values[p.port]
+        return u
+
+    def output(self, t=None):
+        y = self.D @ self._gather() + self.yoffset
+        if self.nstates > 0:
+            y += self.C @ self._x
+            # the fused transfer blocks see their part of the state
+            for b in self.transfers:
+                b._x = self._x[b._fusedslice]
+
+        # write the output values of the fused blocks
+        values = {b: [None] * b.nout for b in self.members}
+        for b, port, start, stop in self.internal:
+            if stop is None:
+                values[b][port] = float(y[start])
+            else:
+                values[b][port] = y[start:stop]
+        for b, out in values.items():
+            b.output_values = out
+        return []
+
+    def deriv(self):
+        # inputs without feedthrough may be computed after the output
+        return self.A @ self._x + self.B @ self._gather() + self.xdoffset
+
+    def jacobian(self, t=None):
+        # over the external inputs and the outputs of the fused blocks
+        return self.A, self.B, self.C, self.D
+
+
+def _model(b):
+    # linear model of a block, its input and output widths, or None
+    if type(b).__name__ not in models or not type(b).__module__.startswith('bdsim.blocks'):
+        return None
+    sin = [_shape(p.block.output_values[p.port]) for p in b.sources]
+    sout = [_shape(v) for v in b.output_values]
+    if None in sin or None in sout:
+        return None
+    win = [_width(shape) for shape in sin]
+    wout = [_width(shape) for shape in sout]
+    model = models[type(b).__name__](b, win, wout, [shape == () for shape in sin])
+    if model is None:
+        return None
+    return model, win, wout
+
+def _components(bd):
+    # connected sub-graphs of linear blocks with more than one block
+
+    linear = {}
+    for group in bd.plan:
+        for b in group:
+            model = _model(b)
+            if model is not None:
+                linear[b] = model
+
+    # union find over the wires between linear blocks
+    parent = {b: b for b in linear}
+
+    def find(b):
+        while parent[b] is not b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+        return b
+
+    for b in linear:
+        for p in b.sources:
+            if p.block in linear:
+                parent[find(p.block)] = find(b)
+
+    components = {}
+    for group in bd.plan:
+        for b in group:
+            if b in linear:
+                components.setdefault(find(b), []).append(b)
+    return [c for c in components.values() if len(c) > 1], linear
+
+
+def _fuse_component(members, linear, constants=()):
+    # compute the fused state-space model of a component, inputs from
+    # constant blocks become offsets
+
+    # offsets of states, outputs and external inputs
+    xoffset = {}
+    nx = 0
+    for b in members:
+        if b.blockclass == 'transfer':
+            xoffset[b] = nx
+            nx += b.nstates
+    youtput = {}
+    outputs = []
+    ny = 0
+    for b in members:
+        wout = linear[b][2]
+        for port in range(b.nout):
+            w = wout[port]
+            youtput[b, port] = ny
+            scalar = _shape(b.output_values[port]) == ()
+            outputs.append((b, port, ny, None if scalar else ny + w))
+            ny += w
+    uinput = {}
+    inputs = []
+    nu = 0
+    members_set = set(members)
+    constant = {}
+    for b in members:
+        for p in b.sources:
+            if p.block in members_set or (p.block, p.port) in uinput:
+                continue
+            elif p.block in constants:
+                constant[p.block, p.port] = np.reshape(np.array(p.block.output_values[p.port], dtype=float), (-1,))
+                continue
+            w = _width(_shape(p.block.output_values[p.port]))
+            uinput[p.block, p.port] = nu
+            inputs.append((p, nu, nu + w))
+            nu += w
+
+    Abar = np.zeros((nx, nx))
+    Bxy = np.zeros((nx, ny))
+    Bxu = np.zeros((nx, nu))
+    Cbar = np.zeros((ny, nx))
+    Dyy = np.zeros((ny, ny))
+    Dyu = np.zeros((ny, nu))
+    ybar = np.zeros((ny,))   # constant inputs
+    xbar = np.zeros((nx,))
+
+    for b in members:
+        (A, B, C, D), win, wout = linear[b]
+        y0 = youtput[b, 0] if b.nout > 0 else 0
+        y1 = y0 + sum(wout)
+        if A is not None:
+            x0 = xoffset[b]
+            x1 = x0 + b.nstates
+            Abar[x0:x1, x0:x1] = A
+            Cbar[y0:y1, x0:x1] = C
+        # route the columns of each input port to its source
+        col = 0
+        for port, p in enumerate(b.sources):
+            w = win[port]
+            if p.block in members_set:
+                k = youtput[p.block, p.port]
+                Dyy[y0:y1, k:k + w] += D[:, col:col + w]
+                if B is not None:
+                    Bxy[x0:x1, k:k + w] += B[:, col:col + w]
+            elif (p.block, p.port) in constant:
+                value = constant[p.block, p.port]
+                ybar[y0:y1] += D[:, col:col + w] @ value
+                if B is not None:
+                    xbar[x0:x1] += B[:, col:col + w] @ value
+            else:
+                k = uinput[p.block, p.port]
+                Dyu[y0:y1, k:k + w] += D[:, col:col + w]
+                if B is not None:
+                    Bxu[x0:x1, k:k + w] += B[:, col:col + w]
+            col += w
+
+    # y = Cbar x + Dyy y + Dyu u + ybar, with no algebraic loops I - Dyy is
+    # invertible
+    M = np.eye(ny) - Dyy
+    C = np.linalg.solve(M, Cbar)
+    D = np.linalg.solve(M, Dyu)
+    yoffset = np.linalg.solve(M, ybar)
+    A = Abar + Bxy @ C
+    B = Bxu + Bxy @ D
+    xdoffset = xbar + Bxy @ yoffset
+
+    return A, B, C, D, inputs, outputs, yoffset, xdoffset
+
+
+def _replan(bd, plan):
+    # install a new plan, dropping empty groups
+    plan = [group for group in plan if len(group) > 0]
+    for sequence, group in enumerate(plan):
+        for b in group:
+            b._sequence = sequence
+    bd.plan = plan
+
+def _names(blocks):
+    return ', '.join([b.name for b in blocks])
+
+def _levels(units, owner):
+    # assign each plan unit a level as in BlockDiagram.execution_plan, return
+    # None if there is a cycle
+    level = {}
+    visiting = set()
+    unitset = set(units)
+
+    def visit(u):
+        if u not in unitset:
+            return -1  # folded block
+        if u in level:
+            return level[u]
+        if u in visiting:
+            raise ValueError('cycle')
+        visiting.add(u)
+        if isinstance(u, FusedLTI):
+            parents = [p for (p, _, _), f in zip(u.external, u.feedthrough) if f]
+        elif u.blockclass in ('source', 'transfer', 'clocked'):
+            parents = []
+        else:
+            parents = u.sources
+        lev = 0
+        for p in parents:
+            lev = max(lev, visit(owner.get(p.block, p.block)) + 1)
+        visiting.discard(u)
+        level[u] = lev
+        return lev
+
+    try:
+        for u in units:
+            visit(u)
+    except ValueError:
+        return None
+    return level
+
+
+def fuse(bd, constants=(), verbose=False):
+    """
+    Fuse linear sub-graphs of a compiled block diagram
+
+    :param bd: compiled block diagram
+    :type bd: BlockDiagram
+    :param constants: folded blocks, see :func:`fold`
+    :type constants: list of Block
+    :param verbose: print the fused blocks, defaults to False
+    :type verbose: bool, optional
+    :return: fused evaluators
+    :rtype: list of FusedLTI
+
+    The execution plan, transfer block list, state vector layout and
+    ``statenames`` of the block diagram are updated.  The states of each
+    fused evaluator are contiguous, so the state names may be reordered but
+    are all kept.
+
+    A sub-graph is not fused if its feedthrough would create a cycle in the
+    plan, for example a path out of the sub-graph through a function block
+    and back in again.
+    """
+    components, linear = _components(bd)
+
+    # names of the states of each transfer block
+    names = {b: bd.statenames[b._xslice] for b in bd.transferblocks}
+
+    units = [b for group in bd.plan for b in group]
+    owner = {b: u for u in units for b in getattr(u, 'blocks', [])}
+    fused = []
+    for members in components:
+        A, B, C, D, inputs, outputs, yoffset, xdoffset = _fuse_component(members, linear, set(constants))
+        f = FusedLTI(members, A, B, C, D, inputs, outputs, yoffset, xdoffset, name=f"fused.{len(fused)}")
+
+        # tentatively replace the members by the fused evaluator
+        trial_owner = dict(owner)
+        for b in members:
+            trial_owner[b] = f
+        trial_units = [u for u in units if u not in members]
+        trial_units.insert(units.index(members[0]), f)
+        if _levels(trial_units, trial_owner) is None:
+            if verbose:
+                print(f"  not fusing {', '.join([b.name for b in members])}: creates a cycle")
+            continue
+        owner = trial_owner
+        units = trial_units
+        fused.append(f)
+        bd.blocknames[f.name] = f
+        if verbose:
+            print(f"  fused {', '.join([b.name for b in members])} into {f.name}")
+
+    if len(fused) == 0:
+        return fused
+
+    # rebuild the plan
+    level = _levels(units, owner)
+    plan = [[] for i in range(max(level.values()) + 1)]
+    for u in units:
+        plan[level[u]].append(u)
+    _replan(bd, plan)
+
+    # reallocate the state vector, the fused states are contiguous
+    transfers = []
+    for b in bd.transferblocks:
+        f = owner.get(b)
+        if f is None:
+            transfers.append(b)
+        elif f.nstates > 0 and f not in transfers:
+            transfers.append(f)
+    bd.statenames = []
+    nstates = 0
+    for u in transfers:
+        u._xslice = slice(nstates, nstates + u.nstates)
+        if isinstance(u, FusedLTI):
+            offset = 0
+            for b in u.transfers:
+                b._fusedslice = slice(offset, offset + b.nstates)
+                b._xslice = slice(nstates + offset, nstates + offset + b.nstates)
+                bd.statenames.extend(names[b])
+                offset += b.nstates
+        else:
+            bd.statenames.extend(names[u])
+        nstates += u.nstates
+    bd.transferblocks = transfers
+
+    return fused
+
+
+def fold(bd, verbose=False):
+    """
+    Fold constant sub-graphs of a compiled block diagram
+
+    :param bd: compiled and evaluated block diagram
+    :type bd: BlockDiagram
+    :param verbose: print the folded blocks, defaults to False
+    :type verbose: bool, optional
+    :return: folded blocks
+    :rtype: list of Block
+
+    ``CONSTANT`` blocks, and pure function blocks whose inputs are all
+    folded, are removed from the plan.  Their output values, computed when
+    the block diagram was compiled, are used for the whole simulation.
+    """
+    folded = []
+    constant = set()
+    for group in bd.plan:
+        for b in group:
+            if not type(b).__module__.startswith('bdsim.blocks'):
+                continue
+            name = type(b).__name__
+            if name == 'Constant' or (b.pure and b.nin > 0 and all([p.block in constant for p in b.sources])):
+                constant.add(b)
+                folded.append(b)
+
+    _replan(bd, [[b for b in group if b not in constant] for group in bd.plan])
+    if verbose and len(folded) > 0:
+        print(f"  folded {_names(folded)}")
+    return folded
+
+
+def eliminate(bd, keep=(), verbose=False):
+    """
+    Eliminate dead function blocks of a compiled block diagram
+
+    :param bd: compiled block diagram
+    :type bd: BlockDiagram
+    :param keep: blocks whose outputs must be computed
+    :type keep: iterable of Block
+    :param verbose: print the eliminated blocks, defaults to False
+    :type verbose: bool, optional
+    :return: eliminated blocks
+    :rtype: list of Block
+
+    Function blocks whose outputs reach no transfer, clocked, sink or kept
+    block are removed from the plan.
+    """
+    live = set()
+    stack = [b for b in bd.blocklist
+        if b.blockclass in ('transfer', 'clocked', 'sink', 'graphics') or b in keep]
+    while len(stack) > 0:
+        b = stack.pop()
+        if b in live:
+            continue
+        live.add(b)
+        stack.extend([p.block for p in b.sources])
+
+    dead = [b for group in bd.plan for b in group if b.blockclass == 'function' and b not in live
+        and live.isdisjoint(getattr(b, 'blocks', []))]
+    deadset = set(dead)
+    _replan(bd, [[b for b in group if b not in deadset] for group in bd.plan])
+    if verbose and len(dead) > 0:
+        print(f"  eliminated {_names(dead)}")
+    return dead
+
+
+def merge(bd, keep=(), constants=(), verbose=False):
+    """
+    Merge trees of operator-created SUM and GAIN blocks
+
+    :param bd: compiled block diagram
+    :type bd: BlockDiagram
+    :param keep: blocks whose outputs must be computed
+    :type keep: iterable of Block
+    :param constants: folded blocks, see :func:`fold`
+    :type constants: list of Block
+    :param verbose: print the merged blocks, defaults to False
+    :type verbose: bool, optional
+    :return: merged evaluators
+    :rtype: list of FusedLTI
+
+    A SUM or GAIN block created by an overloaded operator, whose output
+    drives only another such block, is absorbed into that block.  Each tree
+    of absorbed blocks is replaced by an affine evaluator for its root, and
+    the output values of the absorbed blocks are no longer computed.
+    """
+    units = [b for group in bd.plan for b in group]
+    linear = {}
+    for b in units:
+        if b.name is not None and b.name.startswith(_auto):
+            model = _model(b)
+            if model is not None:
+                linear[b] = model
+
+    # a block is absorbed into its only consumer
+    absorbed = {}
+    for b in linear:
+        wires = b.output_wires[0]
+        if b not in keep and len(wires) == 1 and wires[0].end.block in linear:
+            absorbed[b] = wires[0].end.block
+
+    trees = {}
+    for b in units:
+        if b in absorbed:
+            root = b
+            while root in absorbed:
+                root = absorbed[root]
+            trees.setdefault(root, []).append(b)
+
+    merged = []
+    replace = {}
+    for root, blocks in trees.items():
+        blocks = blocks + [root]
+        A, B, C, D, inputs, outputs, yoffset, xdoffset = \
+            _fuse_component(blocks, linear, set(constants))
+
+        # only the output of the root is computed
+        _, _, start, stop = outputs[-1]
+        end = start + 1 if stop is None else stop
+        outputs = [(root, 0, 0, None if stop is None else end - start)]
+        f = FusedLTI([root], A, B, C[start:end], D[start:end], inputs, outputs,
+            yoffset[start:end], xdoffset, blocks=blocks, name=f"merged.{len(merged)}")
+        bd.blocknames[f.name] = f
+        replace[root] = f
+        merged.append(f)
+        if verbose:
+            print(f"  merged {_names(blocks)} into {f.name}")
+
+    _replan(bd, [[replace.get(b, b) for b in group if b not in absorbed] for group in bd.plan])
+    return merged
+
+
+def optimize(bd, keep=(), verbose=False):
+    """
+    Optimize the execution plan of a compiled block diagram
+
+    :param bd: compiled block diagram
+    :type bd: BlockDiagram
+    :param keep: blocks or ports whose outputs must be computed, for example
+        because they are watched, as a Block, Plug or block name
+    :type keep: iterable
+    :param verbose: print what was optimized, defaults to False
+    :type verbose: bool, optional
+    :return: optimization report
+    :rtype: BDStruct
+
+    Applies :func:`fold`, :func:`eliminate`, :func:`merge` and :func:`fuse`
+    in that order.  The report has the items ``folded`` and ``eliminated``,
+    lists of blocks, and ``merged`` and ``fused``, lists of evaluators whose
+    ``blocks`` attribute lists the blocks they replace.
+    """
+    blocks = set()
+    for k in keep:
+        if isinstance(k, Plug):
+            k = k.block
+        elif isinstance(k, str):
+            k = bd.blocknames[k.split('[')[0]]
+        blocks.add(k)
+
+    # the values of constant blocks are taken from an evaluation
+    bd.evaluate_plan(bd.getstate0().copy(), 0.0, sinks=False)
+
+    report = BDStruct('optimized')
+    report.folded = fold(bd, verbose=verbose)
+    report.eliminated = eliminate(bd, keep=blocks, verbose=verbose)
+    report.merged = merge(bd, keep=blocks, constants=report.folded, verbose=verbose)
+    report.fused = fuse(bd, constants=report.folded, verbose=verbose)
+    return report
@@ -0,0 +1,779 @@
+"""
+Recording of simulation results
+
+During a simulation the time, the continuous state and each watched signal
+are appended, one value per time step, to a :class:`Recorder`.  Numeric
+values of fixed shape are copied into a NumPy buffer whose capacity doubles
+as needed, rather than being kept as a list of Python objects that is
+converted to an array at the end of the run.  The buffer is trimmed in place
+when the results are collected, so the peak memory is close to the size of
+the final array.
+
+Values that are not numeric, or whose shape changes during the run, are kept
+in a list and converted by ``np.array`` as before.
+
+For long simulations a :class:`Policy` selects which values of a signal
+are recorded, for example every N'th value or only the last K values, and
+a :class:`Channel` records the signal and its own time history under that
+policy.  A :class:`Store` streams the results to files on disk while the
+simulation runs, and :func:`load` maps them back into memory.
+"""
+
+import collections
+import json
+from pathlib import Path
+
+import numpy as np
+
+from bdsim.components import BDStruct
+
+_scalars = (bool, int, float, np.number)
+
+def _numeric(value):
+    # value can be held in a numeric buffer
+    return isinstance(value, _scalars) or \
+        (isinstance(value, np.ndarray) and value.dtype.kind in 'biufc')
+
+
+class Recorder:
+    """
+    Growable buffer for the time history of a signal
+
+    The first value appended determines the shape of the buffer rows.  For
+    example::
+
+        r = Recorder()
+        for t in range(1000):
+            r.append(np.r_[t, 2 * t])
+        a = r.array()   # ndarray(1000, 2)
+    """
+
+    def __init__(self, capacity=256):
+        """
+        :param capacity: initial number of rows, defaults to 256
+        :type capacity: int, optional
+        """
+        self._capacity = capacity
+        self._buffer = None  # rows 0 to _n-1 are valid
+        self._shape = None  # shape of a row
+        self._list = None  # values that cannot be buffered
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def append(self, value):
+        """
+        Append a value
+
+        :param value: value of the signal at the next time step
+        :type value: any
+        """
+        if self._buffer is None:
+            if self._list is not None:
+                self._list.append(value)
+                self._n += 1
+                return
+            self._start(value)
+            return self.append(value)
+
+        if not _numeric(value) or np.shape(value) != self._shape:
+            self._unbuffer()
+            return self.append(value)
+        if self._n == self._buffer.shape[0]:
+            self._grow(self._n + 1)
+        try:
+            self._buffer[self._n] = value
+        except (TypeError, ValueError):
+            self._unbuffer()
+            return self.append(value)
+        self._n += 1
+
+    def extend(self, values):
+        """
+        Append a sequence of values
+
+        :param values: values of the signal at the next time steps
+        :type values: ndarray(N,...) or iterable
+        """
+        if _numeric(values) and values.ndim > 0 and values.shape[0] > 0:
+            if self._buffer is None and self._list is None:
+                self._start(values[0])
+            if self._buffer is not None and values.shape[1:] == self._shape:
+                k = values.shape[0]
+                if self._n + k > self._buffer.shape[0]:
+                    self._grow(self._n + k)
+                self._buffer[self._n:self._n + k] = values
+                self._n += k
+                return
+        for value in values:
+            self.append(value)
+
+    def array(self):
+        """
+        Recorded values as an array
+
+        :return: recorded values, the first axis is time
+        :rtype: ndarray(N,...)
+
+        The buffer is trimmed to the number of values and returned without
+        copying, after which the recorder is empty.
+        """
+        if self._list is not None:
+            a = np.array(self._list)
+        elif self._buffer is None:
+            a = np.array([])
+        else:
+            self._resize(self._n)
+            a = self._buffer
+        self.__init__(self._capacity)
+        return a
+
+    def _start(self, value):
+        # allocate a buffer for numeric values of fixed shape
+        if _numeric(value):
+            self._shape = np.shape(value)
+            dtype = complex if np.iscomplexobj(value) else float
+            self._buffer = np.empty((self._capacity,) + self._shape, dtype=dtype)
+        else:
+            self._list = []
+
+    def _unbuffer(self):
+        # keep the values in a list from now on
+        self._list = list(self._buffer[:self._n])
+        self._buffer = None
+
+    def _grow(self, n):
+        # double the capacity until there are at least n rows
+        capacity = self._buffer.shape[0]
+        while capacity < n:
+            capacity *= 2
+        self._resize(capacity)
+
+    def _resize(self, n):
+        # resize the buffer in place if possible, otherwise copy it
+        try:
+            self._buffer.resize((n,) + self._shape)
+        except ValueError:
+            buffer = np.empty((n,) + self._shape, dtype=self._buffer.dtype)
+            m = min(n, self._n)
+            buffer[:m] = self._buffer[:m]
+            self._buffer = buffer
+
+
+class Ring:
+    """
+    Buffer that keeps the last values of a time history
+
+    It has the same interface as :class:`Recorder`, but holds at most
+    ``size`` values, the oldest values are overwritten.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: maximum number of values
+        :type size: int
+        """
+        if size < 1:
+            raise ValueError('ring buffer size must be positive')
+        self._size = size
+        self._buffer = None
+        self._shape = None
+        self._list = None  # values that cannot be buffered
+        self._n = 0  # number of values appended
+
+    def __len__(self):
+        return min(self._n, self._size)
+
+    def append(self, value):
+        """
+        Append a value
+
+        :param value: value of the signal at the next time step
+        :type value: any
+        """
+        if self._buffer is None and self._list is None:
+            if _numeric(value):
+                self._shape = np.shape(value)
+                dtype = complex if np.iscomplexobj(value) else float
+                self._buffer = np.empty((self._size,) + self._shape, dtype=dtype)
+            else:
+                self._list = collections.deque(maxlen=self._size)
+
+        if self._buffer is not None and (not _numeric(value) or np.shape(value) != self._shape):
+            # keep the values in a list from now on
+            self._list = collections.deque(self._ordered(), maxlen=self._size)
+            self._buffer = None
+        if self._list is not None:
+            self._list.append(value)
+        else:
+            self._buffer[self._n % self._size] = value
+        self._n += 1
+
+    def extend(self, values):
+        """
+        Append a sequence of values
+
+        :param values: values of the signal at the next time steps
+        :type values: iterable
+        """
+        for value in values:
+            self.append(value)
+
+    def array(self):
+        """
+        Recorded values as an array
+
+        :return: the last values recorded, the first axis is time
+        :rtype: ndarray(N,...)
+
+        The recorder is then empty.
+        """
+        if self._list is not None:
+            a = np.array(list(self._list))
+        elif self._buffer is None:
+            a = np.array([])
+        else:
+            a = self._ordered()
+        self.__init__(self._size)
+        return a
+
+    def _ordered(self):
+        # the values in the buffer, oldest first
+        if self._n <= self._size:
+            return self._buffer[:self._n].copy()
+        return np.roll(self._buffer, -(self._n % self._size), axis=0)
+
+
+class Policy:
+    """
+    Recording policy for a signal
+
+    A policy selects which of the values of a signal, one per simulation
+    time step, are recorded.  The options are applied in this order:
+
+    - ``every`` records every N'th value
+    - ``spacing`` selects a value only if at least this much time has
+      passed since the last value selected
+    - ``deadband`` selects a value only if an element has changed by more
+      than this amount since the last value selected
+    - ``trigger`` is a function ``trigger(t, value)``, and the selected
+      values are recorded only while it returns True, together with up to
+      ``pre`` values selected before it became True and ``post`` values
+      selected after it became False
+    - ``last`` keeps only the last K values recorded in a ring buffer, so
+      that the memory used is bounded however long the simulation is
+
+    For example::
+
+        Policy(every=10, last=1000)
+        Policy(deadband=0.01)
+        Policy(trigger=lambda t, y: abs(y) > 1, pre=5, post=20)
+
+    A policy only describes the recording, the same instance can be used for
+    several signals and simulation runs.
+
+    :seealso: :meth:`BDSim.run`
+    """
+
+    def __init__(self, every=1, spacing=0, deadband=None, trigger=None, pre=0, post=0, last=None):
+        """
+        :param every: record every N'th value, defaults to 1
+        :type every: int, optional
+        :param spacing: minimum time between values, defaults to 0
+        :type spacing: float, optional
+        :param deadband: minimum change of value, defaults to None
+        :type deadband: float, optional
+        :param trigger: condition for recording, defaults to None
+        :type trigger: callable, optional
+        :param pre: number of values recorded before the trigger, defaults to 0
+        :type pre: int, optional
+        :param post: number of values recorded after the trigger, defaults to 0
+        :type post: int, optional
+        :param last: number of values kept, defaults to all
+        :type last: int, optional
+        :raises ValueError: invalid option
+        """
+        if every < 1:
+            raise ValueError('every must be at least 1')
+        if pre < 0 or post < 0:
+            raise ValueError('pre and post must not be negative')
+        if (pre > 0 or post > 0) and trigger is None:
+            raise ValueError('pre and post require a trigger')
+        if last is not None and last < 1:
+            raise ValueError('last must be at least 1')
+        self.every = every
+        self.spacing = spacing
+        self.deadband = deadband
+        self.trigger = trigger
+        self.pre = pre
+        self.post = post
+        self.last = last
+
+    def __repr__(self):
+        defaults = dict(every=1, spacing=0, deadband=None, trigger=None, pre=0, post=0, last=None)
+        options = [f"{name}={getattr(self, name)!r}" for name, default in defaults.items()
+            if getattr(self, name) != default]
+        return f"Policy({', '.join(options)})"
+
+
+class Channel:
+    """
+    Time history of a signal recorded under a policy
+
+    Used by :meth:`BDSim.run` to record the state and each watched signal.
+    A channel without a policy records every value, and if it is not
+    ``timed`` does not record the times, which are those of the simulation
+    time steps.
+    """
+
+    def __init__(self, policy=None, timed=True, recorder=None):
+        """
+        :param policy: recording policy, defaults to recording every value
+        :type policy: Policy, optional
+        :param timed: record the time of each value, defaults to True
+        :type timed: bool, optional
+        :param recorder: function that returns the recorder for the times,
+            ``recorder('t')``, or the values, ``recorder('y')``, defaults to
+            a :class:`Recorder`
+        :type recorder: callable, optional
+        """
+        self.policy = policy
+        if policy is not None and policy.last is not None:
+            self.times = Ring(policy.last)
+            self.values = Ring(policy.last)
+        else:
+            if recorder is None:
+                recorder = lambda part: Recorder()
+            self.times = recorder('t') if timed or policy is not None else None
+            self.values = recorder('y')
+        self.offered = 0  # number of values offered
+        self._count = 0
+        self._tlast = None  # time and value last recorded
+        self._ylast = None
+        self._pre = collections.deque(maxlen=policy.pre) if policy is not None and policy.pre > 0 else None
+        self._post = 0  # values still to record after the trigger
+
+    def __len__(self):
+        return len(self.times) if self.times is not None else len(self.values)
+
+    def append(self, t, value=None):
+        """
+        Offer a value for recording
+
+        :param t: simulation time
+        :type t: float
+        :param value: value of the signal, defaults to None, only the time
+            is recorded
+        :type value: any
+        """
+        self.offered += 1
+        policy = self.policy
+        if policy is None:
+            if self.times is not None:
+                self.times.append(t)
+            if value is not None:
+                self.values.append(value)
+            return
+
+        self._count += 1
+        if (self._count - 1) % policy.every != 0:
+            return
+        if self._tlast is not None:
+            if t - self._tlast < policy.spacing:
+                return
+            if policy.deadband is not None and value is not None and \
+                    np.all(np.abs(np.subtract(value, self._ylast)) <= policy.deadband):
+                return
+
+        if policy.trigger is not None:
+            if policy.trigger(t, value):
+                # record the values before the trigger, and from now on
+                if self._pre is not None:
+                    while len(self._pre) > 0:
+                        self._record(*self._pre.popleft())
+                self._post = policy.post
+            elif self._post > 0:
+                self._post -= 1
+            else:
+                if self._pre is not None:
+                    self._pre.append((t, _copy(value)))
+                self._tlast, self._ylast = t, _copy(value)
+                return
+
+        self._record(t, value)
+
+    def extend(self, times, values=None):
+        """
+        Offer a sequence of values for recording
+
+        :param times: simulation times
+        :type times: ndarray(N)
+        :param values: values of the signal, defaults to None
+        :type values: ndarray(N,...), optional
+        """
+        if self.policy is None:
+            self.offered += len(times)
+            if self.times is not None:
+                self.times.extend(times)
+            if values is not None:
+                self.values.extend(values)
+        elif values is None:
+            for t in times:
+                self.append(t)
+        else:
+            for t, value in zip(times, values):
+                self.append(t, value)
+
+    def arrays(self):
+        """
+        Recorded times and values
+
+        :return: times, or None if not timed, and values
+        :rtype: ndarray(N), ndarray(N,...)
+        """
+        t = self.times.array() if self.times is not None else None
+        return t, self.values.array()
+
+    def _record(self, t, value):
+        self.times.append(t)
+        if value is not None:
+            self.values.append(value)
+        self._tlast, self._ylast = t, _copy(value)
+
+
+def _copy(value):
+    # a value retained by a channel, which may be changed in place later
+    return value.copy() if isinstance(value, np.ndarray) else value
+
+
+class Column:
+    """
+    Time history of a signal written to a file
+
+    It has the same interface as :class:`Recorder`, but the values are
+    written to a raw binary file in chunks of ``chunk`` rows, so the memory
+    used does not grow with the length of the run.  Only numeric values of
+    fixed shape can be written.
+
+    :seealso: :class:`Store`
+    """
+
+    def __init__(self, filename, chunk=4096):
+        """
+        :param filename: name of the file, which is overwritten
+        :type filename: str or Path
+        :param chunk: number of rows written at a time, defaults to 4096
+        :type chunk: int, optional
+        """
+        self.filename = Path(filename)
+        self._chunk = chunk
+        self._buffer = None  # rows 0 to _k-1 are not yet written
+        self._shape = None  # shape of a row
+        self._file = None
+        self._array = None  # the completed column
+        self._k = 0
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def dtype(self):
+        return self._buffer.dtype if self._buffer is not None else np.dtype(float)
+
+    @property
+    def shape(self):
+        return (self._n,) + (self._shape or ())
+
+    def append(self, value):
+        """
+        Append a value
+
+        :param value: value of the signal at the next time step
+        :type value: int, float or ndarray
+        :raises ValueError: value is not numeric or its shape has changed
+        """
+        if self._buffer is None:
+            if not _numeric(value):
+                raise ValueError(f"{self.filename.name}: only numeric values can be stored")
+            self._shape = np.shape(value)
+            dtype = complex if np.iscomplexobj(value) else float
+            self._buffer = np.empty((self._chunk,) + self._shape, dtype=dtype)
+            self._file = open(self.filename, 'wb')
+        elif not _numeric(value) or np.shape(value) != self._shape:
+            raise ValueError(f"{self.filename.name}: only numeric values of fixed shape can be stored")
+        self._buffer[self._k] = value
+        self._k += 1
+        self._n += 1
+        if self._k == self._chunk:
+            self.flush()
+
+    def extend(self, values):
+        """
+        Append a sequence of values
+
+        :param values: values of the signal at the next time steps
+        :type values: ndarray(N,...) or iterable
+        """
+        for value in values:
+            self.append(value)
+
+    def flush(self):
+        """
+        Write the buffered values to the file
+        """
+        if self._k > 0:
+            self._file.write(self._buffer[:self._k].tobytes())
+            self._k = 0
+
+    def array(self):
+        """
+        Recorded values as an array
+
+        :return: recorded values, the first axis is time
+        :rtype: memmap(N,...)
+
+        The file is completed and opened read-only as a memory-mapped array,
+        no values are read until they are accessed.
+        """
+        if self._array is not None:
+            return self._array
+        if self._file is None:
+            open(self.filename, 'wb').close()
+        else:
+            self.flush()
+            self._file.close()
+            self._file = None
+        self._array = _memmap(self.filename, self.dtype, self.shape)
+        return self._array
+
+
+class Store:
+    """
+    On-disk store for simulation results
+
+    Given to :meth:`BDSim.run` as ``store=path``, the time, state, clock
+    states and watched signals are streamed to a directory while the
+    simulation runs, rather than held in memory.  Each array is a raw binary
+    file, one per column of the results, and ``index.json`` records their
+    data type and shape, together with the names of the states and watched
+    ports.
+
+    The results are returned by :func:`load` with the arrays mapped into
+    memory, so that a run larger than the available memory can be analysed
+    a slice at a time::
+
+        out = sim.run(bd, T=1e4, store='run1')
+        ...
+        out = load('run1')
+        out.column('plant.x0')[-1000:]
+
+    :seealso: :class:`Column`
+    """
+
+    def __init__(self, path, chunk=4096):
+        """
+        :param path: directory, created if it does not exist
+        :type path: str or Path
+        :param chunk: number of rows written at a time, defaults to 4096
+        :type chunk: int, optional
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._chunk = chunk
+        self._index = {}  # name -> index entry
+        self._columns = {}  # name -> Column still being written
+        self._arrays = {}  # id of stored array -> name
+        self._kept = []  # the stored arrays, so that their ids are unique
+
+    def column(self, name):
+        """
+        Column to write a signal to
+
+        :param name: name of the array, ``/`` separates the name of a
+            substructure, eg. ``'clock0/x'``
+        :type name: str
+        :return: column
+        :rtype: Column
+        """
+        column = Column(self._filename(name), chunk=self._chunk)
+        self._columns[name] = column
+        return column
+
+    def channel(self, name, policy=None, timed=True, tname=None):
+        """
+        Channel that records a signal to the store
+
+        :param name: name of the values
+        :type name: str
+        :param policy: recording policy, defaults to recording every value
+        :type policy: Policy, optional
+        :param timed: record the time of each value, defaults to True
+        :type timed: bool, optional
+        :param tname: name of the times, defaults to ``name + '_t'``
+        :type tname: str, optional
+        :return: channel
+        :rtype: Channel
+
+        The values kept by a policy with ``last`` are held in memory, and
+        written by :meth:`close`.
+        """
+        if tname is None:
+            tname = name + '_t'
+        return Channel(policy, timed,
+            recorder=lambda part: self.column(tname if part == 't' else name))
+
+    def write(self, name, array):
+        """
+        Write an array to the store
+
+        :param name: name of the array
+        :type name: str
+        :param array: values
+        :type array: array_like
+        """
+        array = np.asarray(array)
+        if array.dtype.kind not in 'biufc':
+            raise ValueError(f"{name}: only numeric values can be stored")
+        array.tofile(self._filename(name))
+        self._add(name, array)
+
+    def close(self, results):
+        """
+        Complete the store
+
+        :param results: results of the simulation
+        :type results: BDStruct
+        :return: results stored
+        :rtype: BDStruct
+
+        The arrays in ``results`` that were not streamed to the store are
+        written, and its other values, such as ``xnames``, are kept in the
+        index.  The results are then loaded from the store.
+        """
+        for name, column in self._columns.items():
+            self._add(name, column.array())
+        self._columns = {}
+
+        attrs = {}
+        aliases = {}
+
+        def save(prefix, struct):
+            for key, value in struct.items():
+                name = prefix + key
+                if isinstance(value, BDStruct):
+                    save(name + '/', value)
+                elif isinstance(value, np.ndarray):
+                    stored = self._arrays.get(id(value))
+                    if stored is None:
+                        self.write(name, value)
+                    elif stored != name:
+                        aliases[name] = stored
+                else:
+                    attrs[name] = value
+
+        save('', results)
+        index = dict(name=results.name, columns=self._index, aliases=aliases, attrs=attrs)
+        with open(self.path / 'index.json', 'w') as f:
+            json.dump(index, f, indent=1, default=_jsonable)
+        self._arrays = {}
+        self._kept = []
+        return load(self.path)
+
+    def _filename(self, name):
+        return self.path / (name.replace('/', '.') + '.dat')
+
+    def _add(self, name, array):
+        # record the array in the index
+        self._index[name] = dict(file=self._filename(name).name,
+            dtype=array.dtype.str, shape=list(array.shape))
+        self._arrays[id(array)] = name
+        self._kept.append(array)
+
+
+class StoredResults(BDStruct):
+    """
+    Simulation results loaded from a :class:`Store`
+
+    The arrays are memory-mapped, and :meth:`column` gives the time history
+    of a state or watched port by name.
+    """
+
+    def column(self, name):
+        """
+        Time history of a named signal
+
+        :param name: name of a state, in ``xnames``, or of a watched port,
+            in ``ynames``
+        :type name: str
+        :raises KeyError: unknown name
+        :return: time history, the times are ``t`` for a state and ``yN_t``
+            for a watched port
+        :rtype: memmap(N) or memmap(N,M)
+        """
+        xnames = self.data.get('xnames') or []
+        ynames = self.data.get('ynames') or []
+        if name in xnames:
+            return self.x[:, xnames.index(name)]
+        if name in ynames:
+            return self['y' + str(ynames.index(name))]
+        raise KeyError('unknown signal ' + name)
+
+
+def load(path):
+    """
+    Load simulation results from a store
+
+    :param path: directory of the store
+    :type path: str or Path
+    :return: results, with the arrays memory-mapped
+    :rtype: StoredResults
+
+    :seealso: :class:`Store`
+    """
+    path = Path(path)
+    with open(path / 'index.json') as f:
+        index = json.load(f)
+
+    out = StoredResults(name=index['name'])
+
+    def put(name, value):
+        # put the value in the substructure named by the path
+        *structs, key = name.split('/')
+        struct = out
+        for s in structs:
+            if s not in struct:
+                struct[s] = BDStruct(s)
+            struct = struct[s]
+        struct[key] = value
+
+    def get(name):
+        value = out
+        for s in name.split('/'):
+            value = value[s]
+        return value
+
+    for name, column in index['columns'].items():
+        put(name, _memmap(path / column['file'], np.dtype(column['dtype']), tuple(column['shape'])))
+    for name, stored in index['aliases'].items():
+        put(name, get(stored))
+    for name, value in index['attrs'].items():
+        put(name, value)
+    return out
+
+
+def _memmap(filename, dtype, shape):
+    # memory map a file, which cannot be done if it is empty
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=shape)
+
+
+def _jsonable(value):
+    # values in the index that are not JSON types
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (np.ndarray, tuple)):
+        return list(value)
+    return str(value)
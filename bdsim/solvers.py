@@ -0,0 +1,371 @@
+"""
+Native fixed-step ODE solvers
+
+These solvers integrate the block diagram with a fixed step size and no
+error control.  They present the subset of the ``scipy.integrate.OdeSolver``
+interface used by :meth:`BDSim.run_interval`, ie. the attributes ``t``,
+``y``, ``t_old``, ``status``, ``step_size``, ``nfev`` and the methods
+``step()`` and ``dense_output()``, so they can be used in place of a scipy
+solver, for example::
+
+    sim.run(bd, T=10, dt=0.01, solver='rk4')
+
+The stage buffers are allocated once, when the solver is created, and the
+derivative function may return the same array on every call, as
+:meth:`BlockDiagram.evaluate_plan` does.
+
+The derivative at the end of each step is evaluated at the new state, so
+that block outputs are consistent with ``y`` when the step returns, and it is
+reused as the first stage of the next step.
+
+A solver that has finished can be continued to a new final time by
+:func:`restart`, rather than creating a new solver, when the simulation
+is split into intervals by discrete events.
+
+For ``solver='auto'`` the :class:`Stiffness` detector chooses between an
+explicit and an implicit scipy solver as the simulation proceeds.
+"""
+
+import numpy as np
+from scipy.integrate import RK23, RK45, DOP853
+
+
+class FixedStepSolver:
+    """
+    Base class for fixed-step solvers
+
+    Subclasses set the Butcher tableau as the class attributes ``A``, ``B``
+    and ``C``, where the first stage is the derivative at the start of the
+    step.
+    """
+
+    A = np.zeros((1, 1))
+    B = np.r_[1.0]
+    C = np.r_[0.0]
+
+    def __init__(self, fun, t0, y0, t_bound, max_step=None, first_step=None, **unused):
+        """
+        :param fun: derivative function ``fun(t, y)``
+        :type fun: callable
+        :param t0: initial time
+        :type t0: float
+        :param y0: initial state
+        :type y0: array_like(n)
+        :param t_bound: final time
+        :type t_bound: float
+        :param max_step: integration step size
+        :type max_step: float
+        :param first_step: integration step size, overrides ``max_step``
+        :type first_step: float
+        :raises ValueError: no step size is given
+
+        Options for scipy's adaptive solvers, such as ``rtol`` and ``atol``,
+        are ignored.
+        """
+        h = first_step if first_step is not None else max_step
+        if h is None or not np.isfinite(h) or h <= 0:
+            raise ValueError(f"{self.__class__.__name__} solver requires a finite step size, set dt")
+
+        self.fun = fun
+        self.t = t0
+        self.t_old = None
+        self.t_bound = t_bound
+        self.y = np.array(y0, dtype=float)
+        self.h = h
+        self.step_size = None
+        self.status = 'running' if t_bound > t0 else 'finished'
+
+        n = self.y.shape[0]
+        self.nstages = len(self.B)
+        self.K = np.empty((self.nstages, n))  # stage derivatives
+        self._ytmp = np.empty((n,))  # stage state
+        self._fold = np.empty((n,))  # derivative at the start of the last step
+
+        self.K[0] = fun(t0, self.y)
+        self.nfev = 1
+
+    def step(self):
+        """
+        Take one integration step
+
+        :raises RuntimeError: the solver is not running
+        :return: None, for compatibility with ``OdeSolver.step()``
+
+        The last step is shortened so that it ends exactly at ``t_bound``.
+        """
+        if self.status != 'running':
+            raise RuntimeError('attempt to step a solver that has finished')
+
+        t = self.t
+        h = self.h
+        if t + h * (1 + 1e-9) >= self.t_bound:
+            h = self.t_bound - t
+
+        K = self.K
+        y = self.y
+        ytmp = self._ytmp
+        for i in range(1, self.nstages):
+            np.dot(self.A[i, :i], K[:i], out=ytmp)
+            ytmp *= h
+            ytmp += y
+            K[i] = self.fun(t + self.C[i] * h, ytmp)
+
+        # a new array, the caller may retain the previous state
+        self._fold[:] = K[0]
+        self._yold = y
+        self.t_old = t
+        y = y + h * (self.B @ K)
+        t = t + h
+
+        # derivative at the end of the step, first stage of the next step
+        K[0] = self.fun(t, y)
+        self.nfev += self.nstages
+
+        self.t = t
+        self.y = y
+        self.step_size = h
+        if t >= self.t_bound:
+            self.status = 'finished'
+        return None
+
+    def dense_output(self):
+        """
+        Interpolate the state over the last step
+
+        :raises RuntimeError: no step has been taken
+        :return: interpolant, called with a time to return the state
+        :rtype: HermiteOutput
+        """
+        if self.t_old is None:
+            raise RuntimeError('dense output is not available before the first step')
+        return HermiteOutput(self.t_old, self.t, self._yold, self.y, self._fold.copy(), self.K[0].copy())
+
+
+class HermiteOutput:
+    """
+    Cubic Hermite interpolant over a step
+
+    The interpolant matches the state and its derivative at both ends of the
+    step.  It is third order accurate, which is sufficient to locate events
+    for the native solvers, which take small steps of fixed size.
+    """
+
+    def __init__(self, t_old, t, y_old, y, f_old, f):
+        self.t_old = t_old
+        self.t = t
+        self.y_old = y_old
+        self.y = y
+        self.f_old = f_old
+        self.f = f
+
+    def __call__(self, t):
+        h = self.t - self.t_old
+        s = (t - self.t_old) / h
+        h00 = (1 + 2 * s) * (1 - s) ** 2
+        h10 = s * (1 - s) ** 2
+        h01 = s ** 2 * (3 - 2 * s)
+        h11 = s ** 2 * (s - 1)
+        return h00 * self.y_old + h10 * h * self.f_old + h01 * self.y + h11 * h * self.f
+
+
+class Euler(FixedStepSolver):
+    """
+    Explicit Euler method, first order
+    """
+    pass
+
+
+class Heun(FixedStepSolver):
+    """
+    Heun's method, second order
+    """
+    A = np.array([[0.0, 0.0],
+                  [1.0, 0.0]])
+    B = np.r_[0.5, 0.5]
+    C = np.r_[0.0, 1.0]
+
+
+class RK4(FixedStepSolver):
+    """
+    Classical Runge-Kutta method, fourth order
+    """
+    A = np.array([[0.0, 0.0, 0.0, 0.0],
+                  [0.5, 0.0, 0.0, 0.0],
+                  [0.0, 0.5, 0.0, 0.0],
+                  [0.0, 0.0, 1.0, 0.0]])
+    B = np.r_[1.0, 2.0, 2.0, 1.0] / 6
+    C = np.r_[0.0, 0.5, 0.5, 1.0]
+
+
+# native solvers, indexed by the name passed to BDSim.run
+fixedstep = {
+    'euler': Euler,
+    'heun': Heun,
+    'rk4': RK4,
+}
+
+# scipy solvers whose state is only the current point and step size
+warmstart = (RK23, RK45, DOP853)
+
+def restart(integrator, t_bound, h_abs=None):
+    """
+    Continue a finished solver to a new final time
+
+    :param integrator: solver that has reached its final time
+    :type integrator: FixedStepSolver or scipy.integrate.OdeSolver
+    :param t_bound: new final time
+    :type t_bound: float
+    :param h_abs: step size to continue with, defaults to the solver's
+    :type h_abs: float, optional
+    :return: the solver was restarted
+    :rtype: bool
+
+    The derivative at the current point is re-evaluated, since a discrete
+    event may have changed it, but the step size is kept, rather than
+    selected again as it would be for a new solver.  For an adaptive solver
+    ``h_abs`` is normally the step size proposed before the last step was
+    shortened to end at the previous final time.
+
+    Only the native fixed-step solvers and scipy's explicit Runge-Kutta
+    solvers can be restarted, the multistep and implicit solvers keep a
+    history that is invalidated by the event, and False is returned.
+    """
+    if isinstance(integrator, FixedStepSolver):
+        integrator.K[0] = integrator.fun(integrator.t, integrator.y)
+        integrator.nfev += 1
+    elif isinstance(integrator, warmstart):
+        # the wrapped derivative function counts evaluations
+        integrator.f = integrator.fun(integrator.t, integrator.y)
+        if h_abs is not None:
+            integrator.h_abs = min(h_abs, integrator.max_step)
+    else:
+        return False
+
+    integrator.t_bound = t_bound
+    integrator.status = 'running' if t_bound > integrator.t else 'finished'
+    return True
+
+
+class Stiffness:
+    """
+    Stiffness detector for automatic solver switching
+
+    Used by ``BDSim.run(solver='auto')``, which starts with the explicit
+    method ``RK45`` and switches to the implicit method ``BDF`` when the
+    problem becomes stiff, and back again when it is no longer stiff, in the
+    style of ``LSODA``.  After each step of the solver :meth:`update` is
+    called, and the simulator restarts the solver at that point if it
+    returns a new method.
+
+    The explicit method is limited by its stability rather than its accuracy
+    when :math:`h \\rho`, the step size times an estimate of the spectral
+    radius of the Jacobian, is at the stability boundary of the method.  The
+    estimate is taken from two stages of the last step, at no extra cost.
+    A step counts towards a switch if :math:`h \\rho` is within 10% of the
+    boundary, or within half of it if the step was preceded by rejected
+    steps or the step size has collapsed to a small fraction of the largest
+    step taken, which is how the step size control behaves at the boundary.
+
+    The implicit method estimates the spectral radius by power iteration on
+    its Jacobian.  A step counts towards a switch back if :math:`h \\rho` is
+    less than half of the boundary, when the explicit method could take the
+    same step.
+
+    A switch is made after ``steps`` consecutive steps that count towards
+    it, so that the method does not switch back and forth.
+    """
+
+    explicit = 'RK45'
+    implicit = 'BDF'
+    boundary = 3.3  # stability boundary of RK45 on the negative real axis
+    steps = 15  # consecutive steps before switching
+    collapse = 1e-3  # step size collapse, relative to the largest step
+
+    def __init__(self):
+        self.method = self.explicit
+        self.switches = []  # time of each switch and the new method
+        self._count = 0
+        self.start(None)
+
+    def start(self, integrator):
+        """
+        Start monitoring a new solver
+
+        :param integrator: solver that has not yet taken a step
+        :type integrator: scipy.integrate.OdeSolver
+        """
+        self._nfev = None if integrator is None else integrator.nfev
+        self._hmax = 0
+        self._J = None
+        self._rho = None
+
+    def update(self, integrator):
+        """
+        Test the last step of the solver for stiffness
+
+        :param integrator: solver that has just taken a step
+        :type integrator: scipy.integrate.OdeSolver
+        :return: the method to switch to, or None
+        :rtype: str or None
+
+        A solver created by the simulator, including one that replaces it
+        after a switch or a zero crossing, must be passed to :meth:`start`
+        before its first step.
+        """
+        h = integrator.step_size
+        if h is None:
+            return None
+        if self.method == self.explicit:
+            rho = self._stage_radius(integrator)
+            attempts = (integrator.nfev - self._nfev) / integrator.n_stages
+            self._nfev = integrator.nfev
+            self._hmax = max(self._hmax, h)
+            stiff = rho is not None and (h * rho > 0.9 * self.boundary
+                or (h * rho > 0.5 * self.boundary and (attempts > 1.5 or h < self.collapse * self._hmax)))
+        else:
+            stiff = not h * self._power_radius(integrator) < 0.5 * self.boundary
+
+        if stiff == (self.method == self.explicit):
+            self._count += 1
+        else:
+            self._count = 0
+        if self._count < self.steps:
+            return None
+
+        self.method = self.implicit if self.method == self.explicit else self.explicit
+        self.switches.append((integrator.t, self.method))
+        self._count = 0
+        return self.method
+
+    @staticmethod
+    def _stage_radius(integrator):
+        # the difference between the last stage, the derivative at the new
+        # point, and an earlier stage at the end of the step, is dominated by
+        # the stiff components, whose eigenvalue it gives
+        s = np.flatnonzero(integrator.C == 1)
+        if len(s) == 0:
+            return None
+        s = s[-1]
+        K = integrator.K
+        dy = integrator.h_previous * (integrator.B @ K[:-1] - integrator.A[s, :s] @ K[:s])
+        norm = np.linalg.norm(dy)
+        if norm == 0:
+            return 0.0
+        return np.linalg.norm(K[-1] - K[s]) / norm
+
+    def _power_radius(self, integrator):
+        # power iteration on the solver's Jacobian, repeated only when it
+        # has been evaluated again
+        J = integrator.J
+        if J is not self._J:
+            self._J = J
+            v = np.random.default_rng(0).standard_normal(J.shape[0])
+            rho = 0.0
+            for i in range(20):
+                v = v / np.linalg.norm(v)
+                v = J @ v
+                rho = np.linalg.norm(v)
+                if rho == 0:
+                    break
+            self._rho = rho
+        return self._rho
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Benchmark compiling large block diagrams
+
+Synthetic diagrams are built from a chain of diamonds, a block whose output
+feeds two gains that are summed, with an integrator every ``--every``
+diamonds.  The diagram is compiled headless, and the time taken to compile
+it, and to build the execution plan and check for algebraic loops alone, is
+reported for each size.
+
+Run with::
+
+    % python benchmarks/bench_compile.py [--sizes 10000,30000,100000] [--repeat N]
+"""
+
+import sys
+import io
+import argparse
+import contextlib
+import time
+
+args = sys.argv[1:]
+sys.argv = sys.argv[:1] + ['--no-graphics']  # bdsim options are taken from sys.argv
+
+import bdsim
+
+parser = argparse.ArgumentParser(description='benchmark compiling bdsim block diagrams')
+parser.add_argument('--sizes', default='10000,30000,100000', help='comma separated list of approximate numbers of blocks')
+parser.add_argument('--every', type=int, default=50, help='diamonds between integrators')
+parser.add_argument('--repeat', type=int, default=3, help='number of compiles per size, best is reported')
+options = parser.parse_args(args)
+
+
+def diagram(sim, nblocks):
+    bd = sim.blockdiagram()
+    x = bd.STEP(T=1)
+    for i in range(nblocks // 3):
+        if i % options.every == options.every - 1:
+            x = bd.INTEGRATOR(inputs=x)
+            continue
+        s = bd.SUM('++', inputs=(bd.GAIN(0.5, inputs=x), bd.GAIN(0.5, inputs=x)))
+        x = s
+    bd.connect(x, bd.NULL(1))
+    return bd
+
+
+sim = bdsim.BDSim(animation=False)
+sim.options.graphics = False
+sim.options.progress = False
+
+print(f"{'blocks':>8s} {'wires':>8s} {'compile (s)':>12s} {'plan (s)':>10s} {'loops (s)':>10s}")
+for size in [int(s) for s in options.sizes.split(',')]:
+    best = None
+    for i in range(options.repeat):
+        bd = diagram(sim, size)
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            bd.compile(verbose=False)
+            t1 = time.perf_counter()
+            bd.execution_plan()
+            t2 = time.perf_counter()
+            bd.algebraic_loops()
+            t3 = time.perf_counter()
+        times = (t1 - t0, t2 - t1, t3 - t2)
+        if best is None or times[0] < best[0]:
+            best = times
+    print(f"{len(bd.blocklist):8d} {len(bd.wirelist):8d} {best[0]:12.3f} {best[1]:10.3f} {best[2]:10.3f}")
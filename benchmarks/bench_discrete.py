@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Benchmark the discrete-time engine against the general event loop
+
+A saturated discrete controller for a discrete plant, clocked at 1 kHz with
+a second clock at 200 Hz, is run headless with:
+
+- the general event loop, ``BDSim.discrete_engine = False``
+- the discrete-time engine
+- the discrete-time engine with the diagram compiled by ``compile(jit=True)``,
+  which needs Numba
+
+and the number of clock ticks per second of wall time is reported.
+
+Run with::
+
+    % python benchmarks/bench_discrete.py [--T T] [--repeat N]
+"""
+
+import sys
+import io
+import argparse
+import contextlib
+import time
+
+args = sys.argv[1:]
+sys.argv = sys.argv[:1] + ['--no-graphics']  # bdsim options are taken from sys.argv
+
+import bdsim
+from bdsim import jit
+
+parser = argparse.ArgumentParser(description='benchmark the bdsim discrete-time engine')
+parser.add_argument('--T', type=float, default=2, help='simulation time')
+parser.add_argument('--repeat', type=int, default=3, help='number of runs per engine, best is reported')
+options = parser.parse_args(args)
+
+
+def diagram(sim, jit):
+    bd = sim.blockdiagram()
+    clock = bd.clock(0.001, 's')
+    slow = bd.clock(0.005, 's')
+    err = bd.SUM('+-')
+    control = bd.DINTEGRATOR(clock, gain=5, min=-1, max=1)
+    plant = bd.DINTEGRATOR(clock, gain=2)
+    zoh = bd.ZOH(slow)
+    bd.connect(bd.STEP(T=0.5), err[0])
+    bd.connect(plant, err[1])
+    bd.connect(bd.ZOH(clock, inputs=err), control)
+    bd.connect(bd.GAIN(3, inputs=control), plant)
+    bd.connect(plant, zoh)
+    bd.connect(zoh, bd.NULL(1))
+    bd.compile(verbose=False, jit=jit)
+    return bd, [err, zoh]
+
+
+sim = bdsim.BDSim(animation=False)
+sim.options.graphics = False
+sim.options.progress = False
+
+engines = [('event loop', False, False), ('discrete', True, False)]
+if jit.numba is not None:
+    engines.append(('discrete+jit', True, True))
+
+print(f"{'engine':14s} {'ticks':>8s} {'time (s)':>10s} {'ticks/sec':>12s}")
+for name, engine, usejit in engines:
+    bdsim.BDSim.discrete_engine = engine
+    bd, watch = diagram(sim, usejit)
+    best = None
+    for i in range(options.repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            out = sim.run(bd, T=options.T, watch=watch)
+            elapsed = time.perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    nticks = len(out.t)
+    print(f"{name:14s} {nticks:8d} {best:10.3f} {nticks / best:12.0f}")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Benchmark the native fixed-step solvers against scipy's RK45
+
+Each example script is executed with ``BDSim.run`` intercepted, so the
+compiled block diagram and the arguments it would be run with are
+captured.  The diagram is then run headless with each solver and the number
+of integration steps per second of wall time is reported.
+
+Run with::
+
+    % python benchmarks/bench_solvers.py [--dt DT] [--repeat N] [example.py ...]
+
+which defaults to the ``examples/rvc4_*.py`` diagrams.  These need the
+Robotics Toolbox for Python, which provides the ``BICYCLE`` and
+``VEHICLEPLOT`` blocks.
+"""
+
+import sys
+import os
+import io
+import argparse
+import contextlib
+import runpy
+import time
+from pathlib import Path
+
+args = sys.argv[1:]
+sys.argv = sys.argv[:1] + ['--no-graphics']  # bdsim options are taken from sys.argv
+
+import bdsim
+
+parser = argparse.ArgumentParser(description='benchmark bdsim solvers')
+parser.add_argument('examples', nargs='*', help='example scripts, defaults to examples/rvc4_*.py')
+parser.add_argument('--dt', type=float, default=0.01, help='step size')
+parser.add_argument('--repeat', type=int, default=3, help='number of runs per solver, best is reported')
+parser.add_argument('--solvers', default='RK45,euler,heun,rk4', help='comma separated list of solvers')
+options = parser.parse_args(args)
+
+examples = options.examples
+if len(examples) == 0:
+    examples = sorted(str(p) for p in (Path(__file__).parent.parent / 'examples').glob('rvc4_*.py'))
+
+
+def capture(path):
+    # execute the example, capture the block diagram and run arguments
+    captured = {}
+    run = bdsim.BDSim.run
+
+    def fake_run(self, bd, *pos, **kwargs):
+        captured['sim'] = self
+        captured['bd'] = bd
+        captured['pos'] = pos
+        captured['kwargs'] = kwargs
+        return None
+
+    bdsim.BDSim.run = fake_run
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            runpy.run_path(path, run_name='__main__')
+    finally:
+        bdsim.BDSim.run = run
+    return captured
+
+
+print(f"{'example':20s} {'solver':8s} {'steps':>8s} {'time (s)':>10s} {'steps/sec':>12s}")
+for example in examples:
+    name = os.path.basename(example)
+    try:
+        captured = capture(example)
+    except Exception as err:
+        print(f"{name:20s} skipped: {type(err).__name__}: {err}")
+        continue
+    if 'bd' not in captured:
+        print(f"{name:20s} skipped: does not call BDSim.run")
+        continue
+
+    sim = captured['sim']
+    bd = captured['bd']
+    sim.options.graphics = False
+    sim.options.animation = False
+    sim.options.progress = False
+
+    kwargs = dict(captured['kwargs'])
+    kwargs['dt'] = options.dt
+
+    for solver in options.solvers.split(','):
+        kwargs['solver'] = solver
+        kwargs['solver_args'] = {}
+        best = None
+        for i in range(options.repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                t0 = time.perf_counter()
+                out = sim.run(bd, *captured['pos'], **kwargs)
+                elapsed = time.perf_counter() - t0
+            if best is None or elapsed < best:
+                best = elapsed
+        nsteps = len(out.t)
+        print(f"{name:20s} {solver:8s} {nsteps:8d} {best:10.3f} {nsteps / best:12.0f}")
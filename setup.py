@@ -23,6 +23,8 @@ dev_req = [
     "flake8"
 ]
 
+jit_req = ["numba"]
+
 
 setup(
     name='bdsim', 
@@ -81,7 +83,8 @@ setup(
     
     extras_require={
         "docs": docs_req,
-        "dev": dev_req
+        "dev": dev_req,
+        "jit": jit_req
     },
 
     entry_points = {
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import bdsim
+from bdsim.algebraic import AlgebraicLoop, tear
+import unittest
+import numpy.testing as nt
+
+class AlgebraicLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = bdsim.BDSim(animation=False)
+        self.sim.options.graphics = False
+        self.sim.options.progress = False
+
+    def _diagram(self):
+        # dx/dt = -y where y + tanh(y) = x, an algebraic loop through a sum
+        bd = self.sim.blockdiagram()
+        x = bd.INTEGRATOR(x0=1)
+        s = bd.SUM('+-')
+        f = bd.FUNCTION(lambda y: np.tanh(y), inputs=s)
+        bd.connect(x, s[0])
+        bd.connect(f, s[1])
+        bd.connect(bd.GAIN(-1, inputs=s), x)
+        return bd, s
+
+    def test_tear(self):
+        a, b, c, d = 'abcd'
+        # two cycles through b, one tear suffices
+        self.assertEqual(tear([a, b, c], {a: [b], b: [a, c], c: [b]}), [b])
+        # a self loop
+        self.assertEqual(tear([a], {a: [a]}), [a])
+        # two disjoint cycles in one component are joined by d
+        edges = {a: [b], b: [a, d], c: [d], d: [c, a]}
+        torn = tear([a, b, c, d], edges)
+        self.assertEqual(len(torn), 2)
+
+    def test_compile(self):
+        bd, s = self._diagram()
+        with self.assertRaises(RuntimeError):
+            bd.compile(verbose=False)
+
+        bd.compile(verbose=False, algebraic=True)
+        self.assertEqual(len(bd.loops), 1)
+        loop = bd.loops[0]
+        self.assertIsInstance(loop, AlgebraicLoop)
+        self.assertEqual(len(loop.torn), 1)
+        self.assertEqual(len(bd.plan), 3)
+        self.assertIn(loop, bd.plan[1])
+
+        # the loop is solved when the plan is evaluated
+        bd.evaluate_plan(np.r_[2.0], 0)
+        y = s.output_values[0]
+        nt.assert_almost_equal(y + np.tanh(y), [2])
+
+    def test_run(self):
+        bd, s = self._diagram()
+        bd.compile(verbose=False, algebraic=True)
+        out = self.sim.run(bd, T=2, dt=0.1, watch=[s])
+        y = out.y0[:, 0]
+        nt.assert_allclose(y + np.tanh(y), out.x[:, 0], atol=1e-8)
+        # warm started, few iterations per solve
+        self.assertTrue(bd.loops[0].iterations < 10 * self.sim.state.count)
+
+    def test_jacobian(self):
+        # dx/dt = -y where y + tanh(y) = x, so d(dx/dt)/dx = -1 / (2 - tanh(y)^2)
+        bd, s = self._diagram()
+        bd.compile(verbose=False, algebraic=True)
+        J = bd.jacobian([2.0]).toarray()
+        y = s.output_values[0][0]
+        nt.assert_almost_equal(J, [[-1 / (2 - np.tanh(y) ** 2)]])
+
+    def test_vector(self):
+        # x = A x + b for a vector signal, solved in one Newton step
+        bd = self.sim.blockdiagram()
+        A = np.array([[0.2, 0.1], [0.1, 0.3]])
+        s = bd.SUM('++')
+        g = bd.GAIN(A, inputs=s, premul=True)
+        bd.connect(bd.CONSTANT(np.r_[1.0, 2.0]), s[0])
+        bd.connect(g, s[1])
+        bd.connect(s, bd.NULL(1))
+        for method in ('newton', 'fixed'):
+            bd.compile(verbose=False, algebraic=method)
+            bd.evaluate_plan([], 0)
+            nt.assert_almost_equal(s.output_values[0], np.linalg.solve(np.eye(2) - A, [1, 2]))
+        self.assertEqual(bd.loops[0].torn, [g])
+
+        # the loop gain exceeds one, fixed-point iteration diverges
+        bd.compile(verbose=False, algebraic='fixed')
+        g.K = 2 * np.eye(2)
+        with self.assertRaises(RuntimeError):
+            bd.evaluate_plan([], 0)
+
+# ---------------------------------------------------------------------------------------#
+if __name__ == '__main__':
+
+    unittest.main()
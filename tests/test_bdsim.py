@@ -32,6 +32,220 @@ class BDSimTest(unittest.TestCase):
         self.assertTrue(sim.options.graphics)
         self.assertTrue(sim.options.animation)
 
+    def test_ensemble(self):
+        sim = bdsim.BDSim()
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        # xdot = -2 K x, gain is batch evaluated, function is evaluated per member
+        bd = sim.blockdiagram()
+        x = bd.INTEGRATOR(x0=1, name='x')
+        gain = bd.GAIN(-1, name='gain')
+        func = bd.FUNCTION(lambda u: 2 * u, name='func')
+        bd.connect(x, gain)
+        bd.connect(gain, func)
+        bd.connect(func, x)
+        bd.compile(verbose=False)
+
+        # count the calls of the batch and per-member evaluation methods
+        calls = {}
+        def spy(block, method):
+            f = getattr(block, method)
+            def counted(*args, **kwargs):
+                calls[block.name, method] = calls.get((block.name, method), 0) + 1
+                return f(*args, **kwargs)
+            setattr(block, method, counted)
+        for block in (x, gain, func):
+            for method in ('output', 'output_batch'):
+                spy(block, method)
+        for method in ('deriv', 'deriv_batch'):
+            spy(x, method)
+
+        K = np.r_[0.5, 1, 2]
+        x0 = np.r_[1, 2, 3]
+        out = sim.run_ensemble(bd, x0_batch=x0.reshape((3, 1)),
+            params_batch={'gain.K': -K}, T=1, dt=0.01, solver='rk4', watch=[gain])
+
+        n = calls['gain', 'output_batch']
+        self.assertTrue(n > 0)
+        self.assertEqual(calls['x', 'output_batch'], n)
+        self.assertEqual(calls['x', 'deriv_batch'], n)
+        self.assertEqual(calls['func', 'output'], 3 * n)
+        for name, method in [('gain', 'output'), ('x', 'output'), ('x', 'deriv'), ('func', 'output_batch')]:
+            self.assertNotIn((name, method), calls)
+        self.assertEqual(gain.K, -1)  # parameter restored
+        self.assertEqual(out.x.shape, (100, 3, 1))
+        self.assertEqual(out.y0.shape, (100, 3, 1))
+        nt.assert_almost_equal(out.x[-1, :, 0], x0 * np.exp(-2 * K), decimal=6)
+        nt.assert_almost_equal(out.y0[-1, :, 0], -K * out.x[-1, :, 0])
+
+        with self.assertRaises(ValueError):
+            sim.run_ensemble(bd, x0_batch=np.zeros((3, 1)), params_batch={'gain.K': K[:2]})
+
+        # the gain is compiled into the fused plan
+        bd.compile(verbose=False, optimize=True)
+        with self.assertRaises(ValueError):
+            sim.run_ensemble(bd, x0_batch=x0.reshape((3, 1)), params_batch={'gain.K': -K})
+
+    def test_sweep(self):
+        sim = bdsim.BDSim()
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        # xdot = K x
+        bd = sim.blockdiagram()
+        x = bd.INTEGRATOR(x0=1, name='x')
+        gain = bd.GAIN(-1, name='gain')
+        bd.connect(x, gain)
+        bd.connect(gain, x)
+        bd.compile(verbose=False)
+
+        K = [-0.5, -1, -2]
+        for workers in (1, 2):
+            done = []
+            out = sim.sweep(bd, {'gain.K': K}, T=1, dt=0.01, solver='rk4', workers=workers,
+                callback=lambda i, params, result: done.append(i))
+
+            self.assertEqual(sorted(done), [0, 1, 2])
+            self.assertEqual(out.params, [{'gain.K': k} for k in K])
+            nt.assert_almost_equal([r.x[-1, 0] for r in out.results], np.exp(K), decimal=6)
+            self.assertEqual(gain.K, -1)  # parameter restored
+
+        with self.assertRaises(ValueError):
+            sim.sweep(bd, {'gain.X': K})
+
+        # the gain is compiled into the fused plan, which is compiled again
+        bd.compile(verbose=False, optimize=True)
+        self.assertTrue(len(bd.optimized.fused) > 0)
+        for workers in (1, 2):
+            out = sim.sweep(bd, {'gain.K': K}, T=1, dt=0.01, solver='rk4', workers=workers)
+            nt.assert_almost_equal([r.x[-1, 0] for r in out.results], np.exp(K), decimal=6)
+        out = sim.run(bd, T=1, dt=0.01, solver='rk4')
+        self.assertAlmostEqual(out.x[-1, 0], np.exp(-1), places=6)
+
+    def test_discrete_engine(self):
+        sim = bdsim.BDSim()
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        # a saturated discrete controller for a discrete plant, two clocks
+        results = []
+        for engine in (False, True):
+            bdsim.BDSim.discrete_engine = engine
+            bd = sim.blockdiagram()
+            clock = bd.clock(0.01, 's')
+            slow = bd.clock(0.05, 's')
+            err = bd.SUM('+-')
+            control = bd.DINTEGRATOR(clock, gain=5, min=-1, max=1)
+            plant = bd.DINTEGRATOR(clock, gain=2)
+            zoh = bd.ZOH(slow)
+            bd.connect(bd.STEP(T=0.5), err[0])
+            bd.connect(plant, err[1])
+            bd.connect(bd.ZOH(clock, inputs=err), control)
+            bd.connect(bd.GAIN(3, inputs=control), plant)
+            bd.connect(plant, zoh)
+            bd.connect(zoh, bd.NULL(1))
+            bd.compile(verbose=False)
+            results.append((sim.run(bd, T=2, watch=[err, zoh]), bd.clocklist))
+        bdsim.BDSim.discrete_engine = True
+
+        (out1, clocks1), (out2, clocks2) = results
+        nt.assert_array_almost_equal(out1.t, out2.t)
+        nt.assert_array_almost_equal(out1.y0, out2.y0)
+        nt.assert_array_almost_equal(out1.y1, out2.y1)
+        for c1, c2 in zip(clocks1, clocks2):
+            nt.assert_array_almost_equal(c1.t, c2.t)
+            nt.assert_array_almost_equal(c1.x, c2.x)
+
+    def test_zerocross(self):
+        sim = bdsim.BDSim()
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        # an integrator that reaches its limit at t=1, and a stop when it
+        # reaches 0.7 at t=0.7
+        bd = sim.blockdiagram()
+        x = bd.INTEGRATOR(x0=0, max=1, name='x')
+        bd.connect(bd.CONSTANT(1), x)
+        bd.connect(bd.CLIP(max=0.5, inputs=x), bd.NULL(1))
+        bd.compile(verbose=False)
+
+        out = sim.run(bd, T=3, dt=10, zerocross=True)
+        self.assertEqual(sim.state.zerocrossings, 2)
+        self.assertIn(0.5, np.round(out.t, 9))
+        self.assertIn(1.0, np.round(out.t, 9))
+        self.assertAlmostEqual(out.x[-1, 0], 1, places=9)
+
+        bd.STOP(inputs=x - 0.7)
+        bd.compile(verbose=False)
+        out = sim.run(bd, T=3, dt=0.3, solver='rk4', zerocross=True)
+        self.assertAlmostEqual(out.t[-1], 0.7, places=9)
+        self.assertAlmostEqual(out.x[-1, 0], 0.7, places=9)
+
+        # by default the solver steps over the stop
+        out = sim.run(bd, T=3, dt=0.3, solver='rk4')
+        self.assertAlmostEqual(out.t[-1], 0.9)
+
+        # a clipped sine, integrated over two periods with large steps
+        bd = sim.blockdiagram()
+        x = bd.INTEGRATOR(x0=0)
+        bd.connect(bd.CLIP(min=-0.5, max=0.5, inputs=bd.WAVEFORM('sine', freq=0.2)), x)
+        bd.connect(bd.FUNCTION(lambda u: np.sign(u), guard=lambda u: u, inputs=x), bd.NULL(1))
+        bd.compile(verbose=False)
+
+        out = sim.run(bd, T=10, dt=1, zerocross=True)
+        self.assertAlmostEqual(out.x[-1, 0], 0, places=3)
+        self.assertEqual(sim.state.zerocrossings, 8)
+        self.assertTrue(len(out.t) < 50)
+
+        # a guard that latches its sign change cannot be bracketed, it takes
+        # its value at the end of the step
+        latched = []
+        def guard(u):
+            if u > 0.5:
+                latched.append(True)
+            return -1 if latched else 1
+        bd = sim.blockdiagram()
+        x = bd.INTEGRATOR(x0=0)
+        bd.connect(bd.CONSTANT(1), x)
+        bd.connect(bd.FUNCTION(lambda u: u, guard=guard, inputs=x), bd.NULL(1))
+        bd.compile(verbose=False)
+
+        out = sim.run(bd, T=3, dt=1, solver='rk4', zerocross=True)
+        self.assertEqual(sim.state.zerocrossings, 0)
+        self.assertEqual(sim.state.crossings_missed, 1)
+        self.assertAlmostEqual(out.t[-1], 3)
+
+    def test_sample(self):
+        sim = bdsim.BDSim()
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        # xdot = -x
+        bd = sim.blockdiagram()
+        x = bd.INTEGRATOR(x0=1, name='x')
+        gain = bd.GAIN(-1, inputs=x)
+        bd.connect(gain, x)
+        bd.compile(verbose=False)
+
+        out = sim.run(bd, T=2, sample_dt=0.1, watch=[gain], solver_args=dict(rtol=1e-8))
+        nt.assert_almost_equal(out.t, np.linspace(0, 2, 21))
+        nt.assert_almost_equal(out.x[:, 0], np.exp(-out.t), decimal=6)
+        nt.assert_almost_equal(np.ravel(out.y0), -out.x[:, 0])
+
+        t_eval = [0.5, 0.75, 1.5]
+        for solver in ['RK45', 'rk4']:
+            out = sim.run(bd, T=2, t_eval=t_eval, solver=solver, dt=0.1)
+            nt.assert_almost_equal(out.t, t_eval)
+            nt.assert_almost_equal(out.x[:, 0], np.exp(-out.t), decimal=4)
+
+        with self.assertRaises(ValueError):
+            sim.run(bd, T=2, t_eval=[0.5, 0.2])
+        with self.assertRaises(ValueError):
+            sim.run(bd, T=2, t_eval=[0.5, 3])
+        with self.assertRaises(ValueError):
+            sim.run(bd, T=2, t_eval=[0.5], sample_dt=0.1)
+
 # ---------------------------------------------------------------------------------------#
 if __name__ == '__main__':
 
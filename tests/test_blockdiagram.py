@@ -3,6 +3,9 @@
 import numpy as np
 import scipy.interpolate
 import math
+import os
+import tempfile
+import importlib.util
 
 import bdsim
 import unittest
@@ -13,7 +16,241 @@ class BlockTest(unittest.TestCase):
     pass
 
 class BlockDiagramTest(unittest.TestCase):
-    pass
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = bdsim.BDSim(animation=False)  # create simulator
+
+    def test_state_vector(self):
+
+        bd = self.sim.blockdiagram()
+        int1 = bd.INTEGRATOR(x0=[3, 4])
+        int2 = bd.INTEGRATOR(x0=5)
+        bd.connect(bd.CONSTANT([1, 2]), int1)
+        bd.connect(bd.CONSTANT(1), int2)
+        bd.compile(verbose=False)
+
+        self.assertEqual(bd.nstates, 3)
+        self.assertEqual(int1._xslice, slice(0, 2))
+        self.assertEqual(int2._xslice, slice(2, 3))
+        nt.assert_equal(bd.getstate0(), [3, 4, 5])
+
+        # blocks see views of the state vector
+        x = np.r_[6.0, 7, 8]
+        xd = bd.evaluate_plan(x, t=0)
+        self.assertIs(int1._x.base, x)
+        nt.assert_equal(int2.output()[0], [8])
+        nt.assert_equal(xd, [1, 2, 1])
+
+        # the derivative buffer is reused
+        self.assertIs(bd.evaluate_plan(x, t=0), xd)
+
+    def test_parallel(self):
+
+        bd = self.sim.blockdiagram()
+        const = bd.CONSTANT(2)
+        gains = [bd.GAIN(k) for k in range(1, 5)]
+        sum = bd.SUM('++++')
+        dst = bd.NULL(1)
+        for i, gain in enumerate(gains):
+            bd.connect(const, gain)
+            bd.connect(gain, sum[i])
+        bd.connect(sum, dst)
+
+        bd.parallel_overhead = 0  # parallelise any group with several blocks
+        bd.compile(verbose=False, parallel=2)
+        self.assertEqual(bd._parallel, [False, True, False])
+
+        bd.evaluate_plan(x=[], t=0)
+        self.assertEqual(dst.inputs[0], 20)
+
+        # cheap blocks are not worth parallelising
+        bd.parallel_overhead = 1
+        bd.compile(verbose=False, parallel=2)
+        self.assertEqual(bd._parallel, [False, False, False])
+
+    def test_codegen(self):
+
+        bd = self.sim.blockdiagram()
+        int1 = bd.INTEGRATOR(x0=[3, 4])
+        gain = bd.GAIN(-2)
+        sum = bd.SUM('+-')
+        bd.connect(int1, gain)
+        bd.connect(gain, sum[0])
+        bd.connect(bd.CONSTANT([1, 2]), sum[1])
+        bd.connect(sum, int1)
+        bd.compile(verbose=False, codegen=True)
+
+        x = np.r_[6.0, 7]
+        xd = bd.evaluate_plan(x, t=0).copy()
+        nt.assert_equal(xd, [-13, -16])
+        nt.assert_equal(bd.generated(0, x), xd)
+
+        # a saved module can be imported and bound
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir, 'bd_eval.py')
+            bdsim.codegen.save(bd, filename)
+            spec = importlib.util.spec_from_file_location('bd_eval', filename)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            nt.assert_equal(module.bind(bd)(0, x), xd)
+
+    def test_cone(self):
+
+        bd = self.sim.blockdiagram()
+        int1 = bd.INTEGRATOR(x0=1)
+        gain = bd.GAIN(-1)
+        square = bd.FUNCTION(lambda u: u ** 2)
+        dst = bd.NULL(1)
+        bd.connect(int1, gain)
+        bd.connect(gain, int1)
+        bd.connect(gain, square)
+        bd.connect(square, dst)
+        bd.compile(verbose=False)
+
+        self.assertEqual(bd.cone, [[int1], [gain], []])
+        self.assertEqual(bd.rest, [[], [], [square]])
+
+        # the derivative does not need the sink-only block
+        x = np.r_[3.0]
+        nt.assert_equal(bd.evaluate_plan(x, t=0, cone=True), [-3])
+        self.assertEqual(dst.inputs[0], 1)
+        bd.evaluate_rest(t=0)
+        self.assertEqual(dst.inputs[0], 9)
+
+        # every block is needed
+        bd = self.sim.blockdiagram()
+        int1 = bd.INTEGRATOR(x0=1)
+        bd.connect(bd.GAIN(-1, inputs=int1), int1)
+        bd.compile(verbose=False)
+        self.assertIsNone(bd.cone)
+
+    def test_hold(self):
+
+        bd = self.sim.blockdiagram()
+        clock = bd.clock(0.5, 's')
+        calls = []
+        int1 = bd.INTEGRATOR(x0=1)
+        zoh = bd.ZOH(clock, x0=1)
+        control = bd.FUNCTION(lambda u: calls.append(u) or -u, pure=True)
+        bd.connect(int1, zoh)
+        bd.connect(zoh, control)
+        bd.connect(control, int1)
+        bd.compile(verbose=False)
+        self.assertEqual(bd.held, [zoh, control])
+
+        # the controller is evaluated at the start and at each clock tick
+        self.sim.options.progress = False
+        calls.clear()
+        out = self.sim.run(bd, T=2, dt=0.05)
+        self.assertEqual(len(calls), 4)
+        nt.assert_almost_equal(out.x[::10, 0], [0.95, 0.5, 0.25, 0.125, 0.0625])
+
+        # a function that depends on time, here the number of its calls, is
+        # not held unless it declares that it is pure
+        bd = self.sim.blockdiagram()
+        clock = bd.clock(0.5, 's')
+        calls = []
+        int1 = bd.INTEGRATOR(x0=1)
+        zoh = bd.ZOH(clock, x0=1)
+        control = bd.FUNCTION(lambda u: calls.append(u) or -len(calls) * u)
+        bd.connect(int1, zoh)
+        bd.connect(zoh, control)
+        bd.connect(control, int1)
+        bd.compile(verbose=False)
+        self.assertEqual(bd.held, [zoh])
+
+        calls.clear()
+        self.sim.run(bd, T=2, dt=0.05)
+        self.assertTrue(len(calls) > 4)
+
+    def test_plan(self):
+
+        # a long chain of diamonds
+        bd = self.sim.blockdiagram()
+        x = bd.CONSTANT(1)
+        for i in range(2000):
+            x = bd.SUM('++', inputs=(bd.GAIN(0.5, inputs=x), bd.GAIN(0.5, inputs=x)))
+        bd.connect(x, bd.NULL(1))
+        bd.compile(verbose=False)
+        self.assertEqual(len(bd.plan), 4001)
+        self.assertEqual(bd.plan[1], bd.blocklist[1:3])
+        self.assertAlmostEqual(x.output_values[0], 1)
+
+    def test_loops(self):
+
+        # two separate loops, and one with two cycles through a sum
+        bd = self.sim.blockdiagram()
+        g1 = bd.GAIN(1)
+        g2 = bd.GAIN(2, inputs=g1)
+        bd.connect(g2, g1)
+        s = bd.SUM('+++')
+        g3 = bd.GAIN(3, inputs=s)
+        g4 = bd.GAIN(4, inputs=s)
+        bd.connect(bd.CONSTANT(1), s[0])
+        bd.connect(g3, s[1])
+        bd.connect(g4, s[2])
+        g5 = bd.GAIN(5)
+        bd.connect(g5, g5)
+        bd.connect(g5, bd.NULL(1))
+
+        loops = bd.algebraic_loops()
+        self.assertEqual(len(loops), 3)
+        self.assertIn([g1, g2], loops)
+        self.assertIn([s, g3, g4], loops)
+        self.assertIn([g5], loops)
+        with self.assertRaises(RuntimeError):
+            bd.compile(verbose=False)
+
+    def test_sparsity(self):
+
+        # x0' = -x0 + x1, x1' = u(t), x2' = f(x2, x0) through a function block
+        bd = self.sim.blockdiagram()
+        int0 = bd.INTEGRATOR(x0=1)
+        int1 = bd.INTEGRATOR(x0=[1, 2])
+        int2 = bd.INTEGRATOR(x0=1)
+        sum = bd.SUM('-+', inputs=(int0, bd.INDEX([0], inputs=int1)))
+        bd.connect(sum, int0)
+        bd.connect(bd.CONSTANT([1, 1]), int1)
+        bd.connect(bd.FUNCTION(lambda a, b: a * b, nin=2, inputs=(int2, int0)), int2)
+        bd.compile(verbose=False)
+
+        nt.assert_equal(bd.sparsity.toarray(), [
+            [1, 1, 1, 0],
+            [0, 1, 1, 0],
+            [0, 1, 1, 0],
+            [1, 0, 0, 1]])
+
+    def test_jacobian(self):
+
+        def difference(bd, x):
+            # perturb the whole state
+            J = np.zeros((len(x), len(x)))
+            xd = bd.evaluate_plan(x, 0).copy()
+            for j in range(len(x)):
+                xh = x.copy()
+                xh[j] += 1e-7
+                J[:, j] = (bd.evaluate_plan(xh, 0) - xd) / 1e-7
+            return J
+
+        # analytic and estimated partial derivatives, with and without the
+        # optimizer fusing the linear blocks
+        for optimize in (False, True):
+            bd = self.sim.blockdiagram()
+            A = np.array([[0., 1], [-2, -3]])
+            lti = bd.LTI_SS(A=A, B=np.array([[0.], [1]]), C=np.array([1., 0]))
+            x = bd.INTEGRATOR(x0=[1, 2])
+            f = bd.FUNCTION(lambda u: np.sin(u) * u[::-1], inputs=x)
+            g = bd.GAIN(np.array([[1., 2], [3, 4]]), inputs=f)
+            bd.connect(bd.SUM('+-', inputs=(g, lti)), x)
+            h = bd.FUNCTION(lambda u: u[0] ** 2, jacobian=lambda u: [2 * u[0], 0], inputs=x)
+            bd.connect(bd.CLIP(min=-0.5, max=0.5, inputs=h), lti)
+            bd.compile(verbose=False, optimize=optimize)
+
+            x = np.r_[0.3, 0.2, 0.5, -0.4]
+            J = bd.jacobian(x)
+            self.assertEqual(J.shape, (4, 4))
+            nt.assert_array_almost_equal(J.toarray(), difference(bd, x), decimal=6)
 
 class WiringTest(unittest.TestCase):
 
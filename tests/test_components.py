@@ -1,4 +1,6 @@
 import unittest
+import itertools
+import fractions
 import numpy.testing as nt
 from bdsim.components import *
 from bdsim.blocks import *
@@ -144,6 +146,31 @@ class PriorityQTest(unittest.TestCase):
         x = q.pop_until(2.5)
         self.assertEqual(len(x), 0)
 
+    def test_source(self):
+        q = TimeQ()
+
+        q.push_source('a', itertools.count(1, 2))  # infinite event source
+        q.push_source('b', [2, 4])
+        q.push((3, 'c'))
+        self.assertEqual(len(q), 3)
+        self.assertEqual(q.peek(), 1)
+
+        x = q.pop()
+        self.assertEqual(x, (1, ['a']))
+        self.assertEqual(len(q), 3)  # next event from a has been queued
+
+        x = q.pop()
+        self.assertEqual(x, (2, ['b']))
+        x = q.pop(dt=0.1)
+        self.assertEqual(x, (3, ['c', 'a']))  # ties in order of queueing
+        x = q.pop()
+        self.assertEqual(x, (4, ['b']))
+        self.assertEqual(len(q), 1)  # only a remains
+
+        x = q.pop_until(9)
+        self.assertEqual(x, [(5, 'a'), (7, 'a'), (9, 'a')])
+        self.assertEqual(q.peek(), 11)
+
 
 class ClockTest(unittest.TestCase):
     def test_init(self):
@@ -221,6 +248,31 @@ class ClockTest(unittest.TestCase):
         # c.start()
         # t = c.next_event()
 
+    def test_schedule(self):
+        c1 = Clock(0.01)
+        c2 = Clock(0.025)
+        c3 = Clock(50, 'Hz', offset=0.005)
+        schedule = ClockSchedule.build([c1, c2, c3])
+        self.assertEqual(schedule.base, fractions.Fraction(1, 200))
+        self.assertEqual(schedule.hyperperiod, 20)
+
+        events = [schedule.pop() for i in range(8)]
+        self.assertEqual([t for t, _ in events], [0.01, 0.02, 0.025, 0.03, 0.04, 0.045, 0.05, 0.06])
+        self.assertEqual([len(clocks) for _, clocks in events], [1, 1, 2, 1, 1, 1, 2, 1])
+        self.assertEqual(events[2][1], [c2, c3])
+        self.assertEqual(events[5][1], [c3])
+
+        # the table repeats with event times computed from the tick count
+        for i in range(1000):
+            t, clocks = schedule.pop()
+            self.assertEqual(t, round(t, 3))
+
+        schedule.start()
+        self.assertEqual(schedule.peek(), 0.01)
+
+        # no common base tick
+        self.assertIsNone(ClockSchedule.build([Clock(0.1), Clock(2 ** -0.5)]))
+
 class StructTest(unittest.TestCase):
 
     def test_struct(self):
@@ -41,6 +41,51 @@ class FunctionBlockTest(unittest.TestCase):
         out = block._output(np.array([[5,6],[7,8]]))
         nt.assert_array_almost_equal(out[0], np.array([[23,34],[31,46]]))
 
+    def test_gain_batch(self):
+
+        K = np.array([[1,2],[3,4]])
+        u = np.array([[1,2],[5,6]])  # two members
+
+        block = Gain(K)
+        block.test_inputs = [u]
+        nt.assert_array_almost_equal(block.output_batch(0, 2)[0], np.array([u[0] @ K, u[1] @ K]))
+
+        block = Gain(K, premul=True)
+        block.test_inputs = [u]
+        nt.assert_array_almost_equal(block.output_batch(0, 2)[0], np.array([K @ u[0], K @ u[1]]))
+
+        # gain per member
+        block = Gain(np.r_[2, 3])
+        block._memberparams = {'K': block.K}
+        block.test_inputs = [u]
+        nt.assert_array_almost_equal(block.output_batch(0, 2)[0], np.array([2 * u[0], 3 * u[1]]))
+
+    def test_jacobian(self):
+
+        K = np.array([[1,2],[3,4]])
+        block = Gain(K, premul=True)
+        block.test_inputs = [np.r_[1,2]]
+        nt.assert_array_almost_equal(block.jacobian()[3], K)
+
+        block = Gain(K)
+        block.test_inputs = [np.r_[1,2]]
+        nt.assert_array_almost_equal(block.jacobian()[3], K.T)
+
+        block = Gain(np.r_[1,2,3])
+        block.test_inputs = [2]
+        nt.assert_array_almost_equal(block.jacobian()[3], [[1], [2], [3]])
+
+        block = Sum('+-')
+        block.test_inputs = [np.r_[1,2], 3]
+        nt.assert_array_almost_equal(block.jacobian()[3], [[1, 0, -1], [0, 1, -1]])
+
+        block = Sum('+-', mode='c')
+        self.assertIsNone(block.jacobian())
+
+        block = Clip(min=-1, max=1)
+        block.test_inputs = [np.r_[-2, 0.5, 2]]
+        nt.assert_array_almost_equal(block.jacobian()[3], np.diag([0, 1, 0]))
+
     def test_sum(self):
 
         block = Sum('++')
@@ -52,6 +97,10 @@ class FunctionBlockTest(unittest.TestCase):
         block = Sum('-+')
         self.assertEqual(block._output(10, 5)[0], -5)
 
+        block = Sum('+-')
+        block.test_inputs = [np.r_[10, 20], np.r_[[5], [6]]]  # scalar and 1-vector, two members
+        nt.assert_array_almost_equal(block.output_batch(0, 2)[0], np.r_[[5], [14]])
+
         block = Sum('-+', mode='r')
         self.assertEqual(block._output(10, 5)[0], -5)
 
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import bdsim
+from bdsim import jit
+import unittest
+import numpy.testing as nt
+
+@unittest.skipIf(jit.numba is None, 'numba is not installed')
+class JitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = bdsim.BDSim(animation=False)
+        self.sim.options.graphics = False
+        self.sim.options.progress = False
+
+    def _diagram(self, jit):
+        # discrete controller for a first order plant, and a 2D oscillator
+        bd = self.sim.blockdiagram()
+        clock = bd.clock(0.1, 's')
+        step = bd.STEP(T=1)
+        err = bd.SUM('+-')
+        zoh = bd.ZOH(clock)
+        dint = bd.DINTEGRATOR(clock)
+        plant = bd.LTI_SISO(0.5, [2, 1], name='plant')
+        osc = bd.INTEGRATOR(x0=[1, 0])
+        gain = bd.GAIN(np.array([[0, 1], [-1, -0.5]]), premul=True)
+        demux = bd.DEMUX(2)
+        mux = bd.MUX(2)
+        clip = bd.CLIP(-0.5, 0.5)
+        prod = bd.PROD('*/')
+        null = bd.NULL(1)
+
+        bd.connect(step, err[0])
+        bd.connect(plant, err[1])
+        bd.connect(err, zoh)
+        bd.connect(zoh, dint)
+        bd.connect(dint, plant)
+
+        bd.connect(osc, gain)
+        bd.connect(gain, osc)
+        bd.connect(osc, demux)
+        bd.connect(demux[0], mux[0])
+        bd.connect(bd.WAVEFORM('sine', freq=0.5), clip)
+        bd.connect(clip, mux[1])
+        bd.connect(bd.INDEX([1], inputs=mux), prod[0])
+        bd.connect(bd.CONSTANT(2), prod[1])
+        bd.connect(prod, null)
+        bd.connect(demux[1], bd.NULL(1))
+
+        bd.compile(verbose=False, jit=jit)
+        return bd, err, prod
+
+    def test_run(self):
+        diagrams = [self._diagram(False), self._diagram(True)]
+        self.assertIsNone(diagrams[0][0].jitted)
+        self.assertIsNotNone(diagrams[1][0].jitted)
+
+        for solver in ['rk4', 'RK45']:
+            results = []
+            for bd, err, prod in diagrams:
+                out = self.sim.run(bd, T=3, dt=0.05, solver=solver, watch=[err, prod])
+                results.append((out, np.array(bd.clocklist[0].x)))
+
+            (out1, d1), (out2, d2) = results
+            nt.assert_array_almost_equal(out1.t, out2.t)
+            nt.assert_array_almost_equal(out1.x, out2.x)
+            nt.assert_array_almost_equal(out1.y0, out2.y0)
+            nt.assert_array_almost_equal(out1.y1, out2.y1)
+            nt.assert_array_almost_equal(d1, d2)
+
+    def test_discrete(self):
+        # a diagram with no continuous states runs entirely compiled
+        results = []
+        for jit in (False, True):
+            bd = self.sim.blockdiagram()
+            clock = bd.clock(0.01, 's')
+            err = bd.SUM('+-')
+            control = bd.DINTEGRATOR(clock, gain=5, min=-1, max=1)
+            plant = bd.DINTEGRATOR(clock, gain=2)
+            bd.connect(bd.STEP(T=0.5), err[0])
+            bd.connect(plant, err[1])
+            bd.connect(bd.ZOH(clock, inputs=err), control)
+            bd.connect(bd.GAIN(3, inputs=control), plant)
+            bd.connect(plant, bd.NULL(1))
+            bd.compile(verbose=False, jit=jit)
+            out = self.sim.run(bd, T=2, watch=[err, plant])
+            results.append((out, np.array(clock.x)))
+
+        (out1, d1), (out2, d2) = results
+        nt.assert_array_almost_equal(out1.t, out2.t)
+        nt.assert_array_almost_equal(out1.y0, out2.y0)
+        nt.assert_array_almost_equal(out1.y1, out2.y1)
+        nt.assert_array_almost_equal(d1, d2)
+
+    def test_fallback(self):
+        bd = self.sim.blockdiagram()
+        int = bd.INTEGRATOR()
+        bd.connect(bd.FUNCTION(lambda u: -u, name='func', inputs=int), int)
+        bd.compile(verbose=False, jit=True)
+
+        self.assertIsNone(bd.jitted)
+        self.assertIn('func', bd.jit_fallback)
+
+        # the interpreter is used
+        out = self.sim.run(bd, T=1, dt=0.1, solver='rk4')
+        self.assertEqual(len(out.t), 10)
+
+# ---------------------------------------------------------------------------------------#
+if __name__ == '__main__':
+
+    unittest.main()
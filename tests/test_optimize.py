@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import bdsim
+from bdsim.optimize import FusedLTI
+import unittest
+import numpy.testing as nt
+
+class FusionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = bdsim.BDSim(animation=False)
+        self.sim.options.graphics = False
+        self.sim.options.progress = False
+
+    def _diagram(self, optimize):
+        # a loop closed through a nonlinear block, and a linear oscillator
+        bd = self.sim.blockdiagram()
+        demand = bd.STEP(T=1)
+        err = bd.SUM('+-')
+        controller = bd.LTI_SISO(2, [1, 3], name='controller')
+        plant = bd.LTI_SISO(1, [2, 3, 1], name='plant')
+        sat = bd.FUNCTION(lambda u: np.tanh(u))
+        bd.connect(demand, err[0])
+        bd.connect(plant, err[1])
+        bd.connect(err, controller)
+        bd.connect(controller, sat)
+        bd.connect(sat, plant)
+
+        osc = bd.INTEGRATOR(x0=[1, 0], name='osc')
+        K = bd.GAIN(np.array([[0, 1], [-1, -0.2]]), premul=True)
+        demux = bd.DEMUX(2)
+        sum = bd.SUM('++')
+        bd.connect(osc, K)
+        bd.connect(K, osc)
+        bd.connect(osc, demux)
+        bd.connect(demux[0], bd.GAIN(2), sum[0])
+        bd.connect(demux[1], sum[1])
+        bd.connect(sum, bd.NULL(1))
+
+        bd.compile(verbose=False, optimize=optimize)
+        return bd, [plant, sum, controller]
+
+    def test_fuse(self):
+        bd, _ = self._diagram(True)
+
+        self.assertEqual(len(bd.fused), 2)
+        plan = [b for group in bd.plan for b in group]
+        self.assertTrue(all([isinstance(b, FusedLTI) or b.type in ('step', 'function') for b in plan]))
+        self.assertEqual(bd.statenames, ['controllerx0', 'plantx0', 'plantx1', 'oscx0', 'oscx1'])
+
+        # the oscillator state matrix is the gain
+        osc = bd.fused[1]
+        nt.assert_array_almost_equal(osc.A, [[0, 1], [-1, -0.2]])
+
+    def test_run(self):
+        results = []
+        for optimize in (False, True):
+            bd, watch = self._diagram(optimize)
+            results.append(self.sim.run(bd, T=5, dt=0.05, solver='rk4', watch=watch))
+
+        out1, out2 = results
+        nt.assert_array_almost_equal(out1.x, out2.x)
+        for y in ['y0', 'y1', 'y2']:
+            nt.assert_array_almost_equal(out1[y], out2[y])
+
+class PassesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = bdsim.BDSim(animation=False)
+        self.sim.options.graphics = False
+        self.sim.options.progress = False
+
+    def _diagram(self, optimize, keep=[]):
+        # an operator expression, a constant fragment and a dead branch
+        bd = self.sim.blockdiagram()
+        integ = bd.INTEGRATOR(x0=1, name='integ')
+        gain = bd.GAIN(0.5, name='gain')
+        offset = bd.GAIN(3, inputs=bd.CONSTANT(2), name='offset')
+        bd.connect(integ, gain)
+        y = 2 * integ + offset - gain
+        bd.connect(-y, integ)
+        bd.GAIN(4, inputs=gain, name='dead')
+
+        bd.compile(verbose=False, optimize=optimize, keep=keep)
+        return bd, [integ, gain]
+
+    def test_passes(self):
+        bd, _ = self._diagram(True)
+
+        names = lambda blocks: [b.name for b in blocks]
+        self.assertIn('offset', names(bd.optimized.folded))
+        self.assertEqual(names(bd.optimized.eliminated), ['dead'])
+        self.assertTrue(len(bd.optimized.merged) > 0)
+        plan = [b for group in bd.plan for b in group]
+        self.assertFalse(any([b.name.startswith('_') for b in plan]))
+
+        # a kept block is not eliminated
+        bd, _ = self._diagram(True, keep=['dead'])
+        self.assertEqual(bd.optimized.eliminated, [])
+
+    def test_run(self):
+        results = []
+        for optimize in (False, True):
+            bd, watch = self._diagram(optimize)
+            results.append(self.sim.run(bd, T=2, dt=0.05, solver='rk4', watch=watch))
+
+        out1, out2 = results
+        nt.assert_array_almost_equal(out1.x, out2.x)
+        nt.assert_array_almost_equal(out1.y1, out2.y1)
+
+    def test_watch(self):
+        # watched blocks that the optimizer eliminated, a dead chain, or
+        # absorbed into a merged evaluator, are computed
+        results = []
+        for optimize in (False, True):
+            bd = self.sim.blockdiagram()
+            x = bd.INTEGRATOR(x0=1)
+            dead = bd.GAIN(3, inputs=bd.GAIN(2, inputs=x))
+            a = 2 * x
+            b = a + 1
+            bd.connect(-(3 * b), x)
+            bd.compile(verbose=False, optimize=optimize)
+            if optimize:
+                self.assertIn(dead, bd.optimized.eliminated)
+                self.assertTrue(any([b in f.blocks and b not in f.members for f in bd.optimized.merged]))
+            results.append(self.sim.run(bd, T=1, dt=0.05, solver='rk4', watch=[dead, b]))
+
+        out1, out2 = results
+        nt.assert_array_almost_equal(out1.x, out2.x)
+        nt.assert_array_almost_equal(out1.y0, out2.y0)
+        nt.assert_array_almost_equal(out1.y1, out2.y1)
+        nt.assert_array_almost_equal(out2.y0[:, 0], 6 * out2.x[:, 0])
+
+    def test_discrete(self):
+        # a diagram driven only by a clock, the operator expression is merged
+        results = []
+        for optimize in (False, True):
+            bd = self.sim.blockdiagram()
+            clock = bd.clock(0.1, 's')
+            plant = bd.DINTEGRATOR(clock, x0=0)
+            e = 2 * bd.STEP(T=0.3) - plant
+            bd.connect(bd.ZOH(clock, inputs=0.5 * e), plant)
+            bd.compile(verbose=False, optimize=optimize)
+            if optimize:
+                self.assertTrue(len(bd.optimized.merged) > 0)
+            results.append(self.sim.run(bd, T=2, watch=[plant]))
+
+        out1, out2 = results
+        nt.assert_array_almost_equal(out1.y0, out2.y0)
+        self.assertTrue(out2.y0[-1, 0] > 1)
+
+# ---------------------------------------------------------------------------------------#
+if __name__ == '__main__':
+
+    unittest.main()
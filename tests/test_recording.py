@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+import tempfile
+
+import numpy as np
+
+import bdsim
+from bdsim.recording import Recorder, Ring, Policy, Channel, Column, Store, load
+import unittest
+import numpy.testing as nt
+
+class RecorderTest(unittest.TestCase):
+
+    def test_append(self):
+        r = Recorder(capacity=4)
+        for i in range(100):
+            r.append(np.r_[i, 2 * i])
+        self.assertEqual(len(r), 100)
+        a = r.array()
+        self.assertEqual(a.shape, (100, 2))
+        nt.assert_equal(a[:, 1], 2 * np.arange(100))
+        self.assertEqual(len(r), 0)
+
+        # scalars
+        r = Recorder(capacity=4)
+        r.extend(np.arange(10))
+        r.append(10)
+        r.extend([11, 12])
+        nt.assert_equal(r.array(), np.arange(13))
+
+        # nothing recorded
+        self.assertEqual(r.array().shape, (0,))
+
+    def test_unbuffered(self):
+        # values that are not numeric, or change shape, are kept in a list
+        r = Recorder()
+        r.append('a')
+        r.append('b')
+        nt.assert_equal(r.array(), ['a', 'b'])
+
+        r = Recorder()
+        r.append(1)
+        r.append(None)
+        a = r.array()
+        self.assertEqual(a.dtype, object)
+        self.assertEqual(a[0], 1)
+        self.assertIsNone(a[1])
+
+    def test_ring(self):
+        r = Ring(4)
+        for i in range(3):
+            r.append(np.r_[i, -i])
+        nt.assert_equal(r.array()[:, 0], [0, 1, 2])
+        for i in range(10):
+            r.append(i)
+        self.assertEqual(len(r), 4)
+        nt.assert_equal(r.array(), [6, 7, 8, 9])
+
+    def test_watch(self):
+        sim = bdsim.BDSim(animation=False)
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        # the watched function block is evaluated only by the plan
+        calls = []
+
+        def func(x):
+            calls.append(x)
+            return 2 * x
+
+        bd = sim.blockdiagram()
+        x = bd.INTEGRATOR(x0=1)
+        f = bd.FUNCTION(func, inputs=x)
+        bd.connect(bd.GAIN(-1, inputs=x), x)
+        bd.connect(f, bd.NULL(1))
+        bd.compile(verbose=False)
+
+        calls.clear()
+        out = sim.run(bd, T=1, dt=0.1, solver='euler', watch=[f])
+        # once per step, when the blocks outside the derivative cone are
+        # evaluated, and not again to record it
+        self.assertTrue(len(calls) <= 1 + len(out.t))
+        nt.assert_almost_equal(out.y0[:, 0], 2 * out.x[:, 0])
+
+class PolicyTest(unittest.TestCase):
+
+    def _record(self, policy, y):
+        # record y[i] at time i
+        channel = Channel(policy)
+        for t, value in enumerate(y):
+            channel.append(float(t), value)
+        self.assertEqual(channel.offered, len(y))
+        return channel.arrays()
+
+    def test_policies(self):
+        y = np.sin(np.arange(100) * 0.1)
+
+        t, v = self._record(Policy(every=10), y)
+        nt.assert_equal(t, np.arange(0, 100, 10))
+        nt.assert_equal(v, y[::10])
+
+        t, v = self._record(Policy(spacing=2.5), y)
+        nt.assert_equal(t, np.arange(0, 100, 3))
+
+        t, v = self._record(Policy(deadband=0.5), y)
+        self.assertTrue(np.all(np.abs(np.diff(v)) > 0.5))
+        self.assertEqual(t[0], 0)
+
+        t, v = self._record(Policy(last=5), y)
+        nt.assert_equal(t, np.arange(95, 100))
+        nt.assert_equal(v, y[95:])
+
+        # y > 0.99 from t=15 to 17
+        t, v = self._record(Policy(trigger=lambda t, y: y > 0.99, pre=2, post=1), y[:50])
+        nt.assert_equal(t, np.arange(13, 19))
+
+        with self.assertRaises(ValueError):
+            Policy(pre=2)
+
+    def test_run(self):
+        sim = bdsim.BDSim(animation=False)
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        bd = sim.blockdiagram()
+        x = bd.INTEGRATOR(x0=1)
+        gain = bd.GAIN(-1, inputs=x)
+        bd.connect(gain, x)
+        bd.WATCH(inputs=x, policy=Policy(last=3))
+        bd.compile(verbose=False)
+
+        out = sim.run(bd, T=1, dt=0.01, solver='rk4', watch=[gain, (x, Policy(every=10))])
+        self.assertEqual(len(out.t), 100)
+        self.assertIs(out.y0_t, out.t)
+        nt.assert_almost_equal(out.y1_t, out.t[::10])
+        nt.assert_almost_equal(out.y1[:, 0], out.x[::10, 0])
+        nt.assert_almost_equal(out.y2_t, out.t[-3:])
+
+        # the state history has a policy, which the watched ports share
+        out = sim.run(bd, T=1, dt=0.01, solver='rk4', watch=[gain], record=Policy(last=10))
+        self.assertEqual(out.x.shape, (10, 1))
+        nt.assert_almost_equal(out.y0_t, out.t)
+        self.assertEqual(len(out.y1), 3)
+
+class StoreTest(unittest.TestCase):
+
+    def test_column(self):
+        with tempfile.TemporaryDirectory() as path:
+            c = Column(path + '/a.dat', chunk=4)
+            for i in range(10):
+                c.append(np.r_[i, -i])
+            self.assertEqual(len(c), 10)
+            a = c.array()
+            self.assertIsInstance(a, np.memmap)
+            nt.assert_equal(a[:, 1], -np.arange(10))
+            del a
+
+            c = Column(path + '/b.dat')
+            self.assertEqual(c.array().shape, (0,))
+            c = Column(path + '/c.dat')
+            with self.assertRaises(ValueError):
+                c.append('a')
+
+    def test_run(self):
+        sim = bdsim.BDSim(animation=False)
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        bd = sim.blockdiagram()
+        clock = bd.clock(0.1, 's', name='sampler')
+        x = bd.INTEGRATOR(x0=1, name='plant')
+        gain = bd.GAIN(-1, inputs=x)
+        bd.connect(gain, x)
+        zoh = bd.ZOH(clock, inputs=x)
+        bd.connect(zoh, bd.NULL(1))
+        bd.compile(verbose=False)
+
+        ref = sim.run(bd, T=1, dt=0.01, solver='rk4', watch=[gain, (zoh, Policy(last=3))])
+        with tempfile.TemporaryDirectory() as path:
+            out = sim.run(bd, T=1, dt=0.01, solver='rk4', watch=[gain, (zoh, Policy(last=3))],
+                store=Store(path, chunk=16))
+            self.assertIsInstance(out.x, np.memmap)
+            nt.assert_equal(out.t, ref.t)
+            nt.assert_equal(out.x, ref.x)
+            nt.assert_equal(out.y0, ref.y0)
+            nt.assert_equal(out.y1_t, ref.y1_t)
+            nt.assert_equal(out.sampler.x, ref.sampler.x)
+            self.assertEqual(out.xnames, ref.xnames)
+
+            # loaded again, and signals by name
+            out = load(path)
+            nt.assert_equal(out.y0_t, ref.t)
+            nt.assert_equal(out.column(ref.xnames[0]), ref.x[:, 0])
+            nt.assert_equal(out.column(ref.ynames[0]), ref.y0)
+            with self.assertRaises(KeyError):
+                out.column('nonexistent')
+            del out
+
+# ---------------------------------------------------------------------------------------#
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import math
+import io
+import contextlib
+
+import bdsim
+from bdsim.solvers import Euler, Heun, RK4, restart, Stiffness
+import scipy.integrate
+import unittest
+import numpy.testing as nt
+
+class SolverTest(unittest.TestCase):
+
+    def _solve(self, solver, h):
+        # xdot = -x, x(0) = 1, integrate to t=1
+        integrator = solver(lambda t, y: -y, t0=0, y0=[1.0], t_bound=1.0, max_step=h)
+        while integrator.status == 'running':
+            integrator.step()
+        self.assertEqual(integrator.t, 1.0)
+        return integrator.y[0]
+
+    def test_order(self):
+        # halving the step reduces the error by 2^order
+        for solver, order in [(Euler, 1), (Heun, 2), (RK4, 4)]:
+            e1 = abs(self._solve(solver, 0.01) - math.exp(-1))
+            e2 = abs(self._solve(solver, 0.005) - math.exp(-1))
+            self.assertAlmostEqual(math.log2(e1 / e2), order, delta=0.1)
+
+    def test_nostep(self):
+        with self.assertRaises(ValueError):
+            RK4(lambda t, y: -y, t0=0, y0=[1.0], t_bound=1.0)
+
+    def test_lastep(self):
+        # final step is shortened to land on t_bound
+        integrator = Euler(lambda t, y: np.r_[1.0], t0=0, y0=[0.0], t_bound=0.25, max_step=0.1)
+        t = []
+        while integrator.status == 'running':
+            integrator.step()
+            t.append(integrator.t)
+        nt.assert_almost_equal(t, [0.1, 0.2, 0.25])
+        nt.assert_almost_equal(integrator.y, [0.25])
+        self.assertEqual(integrator.nfev, 4)
+
+    def test_run(self):
+        sim = bdsim.BDSim(animation=False)
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        bd = sim.blockdiagram()
+        integrator = bd.INTEGRATOR(x0=1)
+        gain = bd.GAIN(-1)
+        bd.connect(integrator, gain)
+        bd.connect(gain, integrator)
+        bd.compile(verbose=False)
+
+        out = sim.run(bd, T=1, dt=0.01, solver='rk4')
+        nt.assert_almost_equal(np.diff(out.t), 0.01)
+        self.assertAlmostEqual(out.x[-1, 0], math.exp(-1), places=8)
+
+    def test_dense(self):
+        # interpolated state over the last step
+        integrator = RK4(lambda t, y: -y, t0=0, y0=[1.0], t_bound=1.0, max_step=0.1)
+        with self.assertRaises(RuntimeError):
+            integrator.dense_output()
+        integrator.step()
+        integrator.step()
+        sol = integrator.dense_output()
+        self.assertAlmostEqual(integrator.t_old, 0.1)
+        nt.assert_almost_equal(sol(0.2), integrator.y)
+        for t in [0.1, 0.13, 0.15, 0.19]:
+            self.assertAlmostEqual(sol(t)[0], math.exp(-t), places=5)
+
+    def test_restart(self):
+        # continuing to a new final time keeps the step size
+        for solver in [RK4, scipy.integrate.RK45]:
+            integrator = solver(lambda t, y: -y, t0=0, y0=[1.0], t_bound=0.5, max_step=0.01)
+            while integrator.status == 'running':
+                integrator.step()
+            self.assertTrue(restart(integrator, 1.0, h_abs=0.01))
+            self.assertEqual(integrator.status, 'running')
+            while integrator.status == 'running':
+                integrator.step()
+            self.assertEqual(integrator.t, 1.0)
+            self.assertAlmostEqual(integrator.y[0], math.exp(-1), places=6)
+
+        # a multistep solver cannot be restarted
+        integrator = scipy.integrate.BDF(lambda t, y: -y, t0=0, y0=[1.0], t_bound=0.5)
+        self.assertFalse(restart(integrator, 1.0))
+
+    def test_warmstart(self):
+        sim = bdsim.BDSim(animation=False)
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        bd = sim.blockdiagram()
+        clock = bd.clock(0.1, 's')
+        integrator = bd.INTEGRATOR(x0=1)
+        bd.connect(bd.GAIN(-1, inputs=integrator), integrator)
+        bd.connect(integrator, bd.ZOH(clock), bd.NULL(1))
+        bd.compile(verbose=False)
+
+        for solver in ['rk4', 'RK45']:
+            out1 = sim.run(bd, T=1, dt=0.01, solver=solver)
+            out2 = sim.run(bd, T=1, dt=0.01, solver=solver, warmstart=True)
+            self.assertEqual(sim.state.restarts_avoided, 9)
+            self.assertAlmostEqual(out2.x[-1, 0], math.exp(-1), places=6)
+            self.assertAlmostEqual(out1.x[-1, 0], out2.x[-1, 0], places=6)
+
+    def test_sparsity(self):
+        sim = bdsim.BDSim(animation=False)
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        # a stiff chain of first order lags
+        bd = sim.blockdiagram()
+        x = bd.STEP(T=0.1)
+        for i in range(20):
+            err = bd.SUM('+-')
+            lag = bd.INTEGRATOR(x0=0, inputs=bd.GAIN(1000 * (1 + i % 3), inputs=err))
+            bd.connect(x, err[0])
+            bd.connect(lag, err[1])
+            x = lag
+        bd.compile(verbose=False)
+        self.assertEqual(bd.sparsity.nnz, 39)
+
+        evaluate = bd.evaluate_plan
+        counts = []
+        for solver_args in [{}, {'jac_sparsity': None}]:
+            calls = []
+            bd.evaluate_plan = lambda *args, **kwargs: calls.append(1) or evaluate(*args, **kwargs)
+            out = sim.run(bd, T=1, solver='BDF', solver_args=solver_args)
+            self.assertAlmostEqual(out.x[-1, -1], 1, places=3)
+            counts.append(len(calls))
+        del bd.evaluate_plan
+        self.assertTrue(counts[0] < counts[1])
+
+        # the Jacobian assembled from the blocks, one evaluation each
+        calls = []
+        jacobian = bd.jacobian
+        bd.jacobian = lambda *args, **kwargs: calls.append(1) or jacobian(*args, **kwargs)
+        out = sim.run(bd, T=1, solver='BDF', jacobian=True)
+        del bd.jacobian
+        self.assertAlmostEqual(out.x[-1, -1], 1, places=3)
+        self.assertTrue(len(calls) > 0)
+        nt.assert_array_equal(jacobian(out.x[-1]).toarray() != 0, bd.sparsity.toarray())
+
+    def test_stiffness(self):
+        # the explicit solver is limited by the stability of the fast mode
+        A = np.diag([-1.0, -500.0])
+        detector = Stiffness()
+        integrator = scipy.integrate.RK45(lambda t, y: A @ y, t0=0, y0=[1.0, 1.0], t_bound=10)
+        detector.start(integrator)
+        for i in range(100):
+            integrator.step()
+            if detector.update(integrator) is not None:
+                break
+        self.assertEqual(detector.method, 'BDF')
+        self.assertEqual(detector.switches, [(integrator.t, 'BDF')])
+
+        # the fast mode has decayed, and the implicit solver continues with a
+        # large step, but without it the explicit solver could take the step
+        for A, method in [(A, 'BDF'), (np.diag([-1.0, -2.0]), 'RK45')]:
+            detector.method = 'BDF'
+            integrator = scipy.integrate.BDF(lambda t, y: A @ y, t0=1, y0=[1.0, 0.0], t_bound=10)
+            detector.start(integrator)
+            while integrator.status == 'running':
+                integrator.step()
+                if detector.update(integrator) is not None:
+                    break
+            self.assertEqual(detector.method, method)
+
+    def test_auto(self):
+        sim = bdsim.BDSim(animation=False)
+        sim.options.graphics = False
+        sim.options.progress = False
+
+        # a stiff chain of first order lags, driven by a step at t=0.1
+        bd = sim.blockdiagram()
+        x = bd.STEP(T=0.1)
+        for i in range(20):
+            err = bd.SUM('+-')
+            lag = bd.INTEGRATOR(x0=0, inputs=bd.GAIN(1000 * (1 + i % 3), inputs=err))
+            bd.connect(x, err[0])
+            bd.connect(lag, err[1])
+            x = lag
+        bd.compile(verbose=False)
+
+        # the switches are reported at the end of the run, not as they happen
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            out = sim.run(bd, T=1, solver='auto')
+        self.assertNotIn('switching', stdout.getvalue())
+        switches = sim.state.stiffness.switches
+        self.assertEqual(switches[0][1], 'BDF')
+        self.assertIn(switches[0][0], out.t)
+        self.assertTrue(np.all(np.diff(out.t) > 0))
+        self.assertTrue(len(out.t) < 300)  # RK45 takes about 900 steps
+        nt.assert_almost_equal(out.x[-1], np.ones(20), decimal=3)
+
+        with self.assertRaises(ValueError):
+            sim.run_ensemble(bd, x0_batch=np.zeros((2, 20)), solver='auto')
+
+# ---------------------------------------------------------------------------------------#
+if __name__ == '__main__':
+
+    unittest.main()
@@ -101,6 +101,16 @@ class TransferTest(unittest.TestCase):
         block.test_inputs = [u]
         nt.assert_equal(block.deriv(), 0)
 
+    def test_integrator_jacobian(self):
+        block = Integrator(x0=[5, 6], gain=2, min=[-5, -10], max=[5, 10])
+        block.setstate(np.r_[6, 0])  # first state beyond its maximum
+        block.test_inputs = [np.r_[2, 3]]
+        A, B, C, D = block.jacobian()
+        nt.assert_equal(A, np.zeros((2, 2)))
+        nt.assert_equal(B, [[0, 0], [0, 2]])
+        nt.assert_equal(C, np.eye(2))
+        self.assertIsNone(D)
+
     def test_dintegrator_vec(self):
 
         block = Integrator(x0=[5, 6])  # state is vector